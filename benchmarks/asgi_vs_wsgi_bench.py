@@ -0,0 +1,243 @@
+"""chat_api の WSGI 版 (main.py) と ASGI 版 (asgi_app.py) を同じ負荷で比較するベンチマーク
+
+chat_api_bench.py と同じワークロード (インメモリバックエンド、トークン検証のスタブ) を使い、
+--concurrency 人のクライアントが応答を待っては次のリクエストを送る (クローズドループ) 負荷を両方に掛ける。
+
+- WSGI 版: サーバーのスレッド数 (--wsgi-threads。gunicorn の workers × threads に相当) までしか同時に処理しない。
+  レイテンシには空きスレッドを待つ時間も含める。
+- ASGI 版: 1 つのイベントループで全リクエストを同時に処理する。
+
+インメモリバックエンドには I/O の待ちがないため、--storage-latency-ms で保存先の操作ごとに
+Firestore の往復に相当する待ち時間を入れる (WSGI 版は time.sleep、ASGI 版は asyncio.sleep)。
+
+    python benchmarks/asgi_vs_wsgi_bench.py --concurrency 64 --wsgi-threads 8 --storage-latency-ms 20 --room-cache-ttl 0
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from chat_api_bench import ACCEPT_HEADERS, Workload, git_revision, load_app, summarize
+
+DEFAULT_ACTIONS = ['get_messages', 'send_message', 'list_rooms', 'batch']
+# 待ち時間を入れる保存先の読み込み操作 (書き込みはバッチの commit に入れる)
+DELAYED_OPERATIONS = ('get_messages', 'get_message', 'list_rooms', 'mark_room_read')
+
+
+class DelayedStorage:
+    """MessageStorage の操作ごとに delay 秒待つラッパー (WSGI 版用)"""
+
+    def __init__(self, inner, delay):
+        self.inner = inner
+        self.delay = delay
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if name in DELAYED_OPERATIONS:
+            def delayed(*args, **kwargs):
+                time.sleep(self.delay)
+                return attr(*args, **kwargs)
+            return delayed
+        return attr
+
+    def batch(self):
+        write_batch = self.inner.batch()
+        commit = write_batch.commit
+
+        def delayed_commit():
+            time.sleep(self.delay)
+            commit()
+        write_batch.commit = delayed_commit
+        return write_batch
+
+
+class AsyncDelayedStorage(DelayedStorage):
+    """AsyncMessageStorage の操作ごとに delay 秒待つラッパー (ASGI 版用)"""
+
+    def __getattr__(self, name):
+        attr = getattr(self.inner, name)
+        if name in DELAYED_OPERATIONS:
+            async def delayed(*args, **kwargs):
+                await asyncio.sleep(self.delay)
+                return await attr(*args, **kwargs)
+            return delayed
+        return attr
+
+    def batch(self):
+        write_batch = self.inner.batch()
+        commit = write_batch.commit
+
+        async def delayed_commit():
+            await asyncio.sleep(self.delay)
+            await commit()
+        write_batch.commit = delayed_commit
+        return write_batch
+
+
+def run_wsgi(app, requests_to_send, concurrency, wsgi_threads, accept):
+    """concurrency 並列のクライアントから、wsgi_threads 本のスレッドで処理する WSGI 版に送る"""
+    server_slots = threading.Semaphore(wsgi_threads)
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(item):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        user, body = item
+        started_at = time.perf_counter()
+        with server_slots:
+            response = client.post('/', json=body, headers={'Authorization': f'Bearer {user}', 'Accept': accept})
+            response.get_data()
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        with lock:
+            latencies.append(elapsed_ms)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, requests_to_send))
+    return summarize(latencies, errors, len(requests_to_send), time.perf_counter() - started_at)
+
+
+async def _call_asgi(app, user, body, accept):
+    """ASGI アプリを直接呼び出し、(ステータス, ボディ) を返す"""
+    scope = {
+        'type': 'http', 'method': 'POST', 'path': '/',
+        'headers': [(b'authorization', f'Bearer {user}'.encode()), (b'accept', accept.encode()),
+                    (b'content-type', b'application/json')],
+    }
+    request_body = json.dumps(body).encode('utf-8')
+    received = False
+    response = {}
+
+    async def receive():
+        nonlocal received
+        if received:
+            return {'type': 'http.disconnect'}
+        received = True
+        return {'type': 'http.request', 'body': request_body, 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        else:
+            response['body'] = message.get('body', b'')
+
+    await app(scope, receive, send)
+    return response['status'], response['body']
+
+
+async def _run_asgi(app, requests_to_send, concurrency, accept):
+    latencies = []
+    errors = []
+    pending = iter(requests_to_send)
+
+    async def client():
+        for user, body in pending:
+            started_at = time.perf_counter()
+            status, _ = await _call_asgi(app, user, body, accept)
+            latencies.append((time.perf_counter() - started_at) * 1000)
+            if status >= 400:
+                errors.append(status)
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return summarize(latencies, errors, len(requests_to_send), time.perf_counter() - started_at)
+
+
+def run_asgi(app, requests_to_send, concurrency, accept):
+    """concurrency 並列のクライアントから ASGI 版に送る (1 つのイベントループで処理する)"""
+    return asyncio.run(_run_asgi(app, requests_to_send, concurrency, accept))
+
+
+def print_comparison(results):
+    print(f"{'action':<16}{'wsgi rps':>10}{'p50':>9}{'p99':>9}{'asgi rps':>10}{'p50':>9}{'p99':>9}{'rps x':>8}")
+    for action, modes in results['actions'].items():
+        wsgi, asgi = modes['wsgi'], modes['asgi']
+        ratio = asgi['throughput_rps'] / wsgi['throughput_rps'] if wsgi['throughput_rps'] else 0.0
+        print(f"{action:<16}{wsgi['throughput_rps']:>10.1f}{wsgi['p50_ms']:>9.2f}{wsgi['p99_ms']:>9.2f}"
+              f"{asgi['throughput_rps']:>10.1f}{asgi['p50_ms']:>9.2f}{asgi['p99_ms']:>9.2f}{ratio:>8.2f}")
+        for mode in ('wsgi', 'asgi'):
+            if modes[mode]['errors']:
+                print(f"{'':<16}{mode} errors: {modes[mode]['errors']} (statuses {modes[mode]['error_statuses']})")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--actions', default=','.join(DEFAULT_ACTIONS),
+                        help=f"計測するアクション (カンマ区切り。既定: {','.join(DEFAULT_ACTIONS)})")
+    parser.add_argument('--concurrency', type=int, default=64, help='同時に応答を待つクライアント数')
+    parser.add_argument('--wsgi-threads', type=int, default=8, help='WSGI 版のサーバーのスレッド数')
+    parser.add_argument('--requests', type=int, default=1000, help='アクション・モードごとのリクエスト数')
+    parser.add_argument('--warmup', type=int, default=50, help='計測前にアクション・モードごとに送るリクエスト数')
+    parser.add_argument('--storage-latency-ms', type=float, default=20.0, help='保存先の操作ごとに入れる待ち時間 (ミリ秒)')
+    parser.add_argument('--rooms', type=int, default=20, help='ルーム数')
+    parser.add_argument('--seed-messages', type=int, default=200, help='ルームごとに事前に保存するメッセージ数')
+    parser.add_argument('--message-size', type=int, default=100, help='メッセージ本文の文字数')
+    parser.add_argument('--format', choices=sorted(ACCEPT_HEADERS), default='json', help='要求するレスポンス形式')
+    parser.add_argument('--room-cache-ttl', type=float, default=None,
+                        help='ROOM_CACHE_TTL_SECONDS を上書きする (0 で毎回保存先を読む)')
+    parser.add_argument('--seed', type=int, default=1, help='乱数のシード')
+    parser.add_argument('--output', help='結果を保存する JSON ファイル')
+    args = parser.parse_args(argv)
+    args.rate_limit = False # load_app 用 (全リクエストを 1 人のユーザーから送るため、レート制限は外す)
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    actions = [action.strip() for action in args.actions.split(',') if action.strip()]
+    chat_api = load_app(args)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import asgi_app
+
+    async def verify_stub(auth_header):
+        return {'email': auth_header.split(' ', 1)[1]}
+    asgi_app.verify_id_token_async = verify_stub
+
+    rng = random.Random(args.seed)
+    accept = ACCEPT_HEADERS[args.format]
+    with contextlib.redirect_stdout(io.StringIO()):
+        # 事前データは待ち時間なしで投入する
+        workload = Workload(chat_api, args.rooms, args.seed_messages, args.message_size, rng)
+        delay = args.storage_latency_ms / 1000
+        chat_api.storage = DelayedStorage(chat_api.storage, delay)
+        asgi_app.storage = AsyncDelayedStorage(asgi_app.storage, delay)
+
+        action_results = {}
+        for action in actions:
+            modes = {}
+            for mode in ('wsgi', 'asgi'):
+                for total_requests in ([args.warmup] if args.warmup else []) + [args.requests]:
+                    requests_to_send = [workload.build(action) for _ in range(total_requests)]
+                    if mode == 'wsgi':
+                        modes[mode] = run_wsgi(chat_api.app, requests_to_send, args.concurrency, args.wsgi_threads, accept)
+                    else:
+                        modes[mode] = run_asgi(asgi_app.app, requests_to_send, args.concurrency, accept)
+            action_results[action] = modes
+
+    results = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_revision': git_revision(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'rate_limit')},
+        'actions': action_results,
+    }
+    print_comparison(results)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.output}")
+    return results
+
+
+if __name__ == '__main__':
+    main()
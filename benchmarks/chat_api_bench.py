@@ -0,0 +1,240 @@
+"""Cloud Functions (chat_api) のアクションごとのスループットとレイテンシを計測するベンチマーク
+
+Flask のテストクライアントで handle_request を直接呼び出すため、GCP や HTTP サーバーは不要。
+ID トークンの検証はスタブに置き換え (トークン文字列をそのままメールアドレスとして扱う)、
+保存先はインメモリバックエンド (CHAT_STORAGE_BACKEND=memory) を使う。
+
+    python benchmarks/chat_api_bench.py --concurrency 8 --requests 2000 --rooms 50
+    python benchmarks/chat_api_bench.py --output after.json --baseline before.json
+
+結果は JSON で保存し、--baseline に以前の結果を渡すと p50/p95/p99 とスループットの差分を表示する。
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+CHAT_API_DIR = Path(__file__).resolve().parent.parent / 'cloud_functions' / 'chat_api'
+DEFAULT_ACTIONS = ['get_messages', 'get_messages_since', 'send_message', 'list_rooms', 'batch']
+ACCEPT_HEADERS = {
+    'json': 'application/json',
+    'compact': 'application/vnd.securechat.compact+json',
+    'msgpack': 'application/x-msgpack',
+}
+# batch ワークロードで 1 回にまとめる get_messages の数
+BATCH_ROOMS = 5
+
+
+def load_app(args):
+    """計測用の設定で chat_api の main モジュールを読み込む (設定は import 時に環境変数から読まれる)"""
+    os.environ['CHAT_STORAGE_BACKEND'] = 'memory'
+    os.environ.setdefault('GOOGLE_OAUTH_CLIENT_ID', 'benchmark')
+    if args.room_cache_ttl is not None:
+        os.environ['ROOM_CACHE_TTL_SECONDS'] = str(args.room_cache_ttl)
+    # 全リクエストを 1 人のユーザーから送るため、既定ではユーザーごとのレート制限を外す
+    os.environ['RATE_LIMIT_ENABLED'] = '1' if args.rate_limit else '0'
+    sys.path.insert(0, str(CHAT_API_DIR))
+    with contextlib.redirect_stdout(io.StringIO()):
+        import main
+    # トークンの検証はスタブにする ("Bearer <email>" をそのまま検証済みのユーザーとして扱う)
+    main.verify_id_token = lambda auth_header: {'email': auth_header.split(' ', 1)[1]}
+    return main
+
+
+class Workload:
+    """ルームとメッセージを用意し、アクションごとのリクエストを作る"""
+
+    def __init__(self, main, rooms, seed_messages, message_size, rng):
+        self.main = main
+        self.rng = rng
+        self.message_size = message_size
+        self.owner = 'owner@bench.local'
+        # owner と各相手の 1 対 1 のルーム (list_rooms は owner から見て rooms 件になる)
+        self.partners = [f'user{i}@bench.local' for i in range(rooms)]
+        self.room_ids = ['_'.join(sorted([self.owner, partner])) for partner in self.partners]
+        self.cursors = {}
+        for partner, room_id in zip(self.partners, self.room_ids):
+            for i in range(seed_messages):
+                sender, receiver = (self.owner, partner) if i % 2 else (partner, self.owner)
+                main.send_message_to_db(room_id, sender, receiver, self._content())
+            # 差分取得 (since) 用に、最新の数件前のカーソルを覚えておく
+            recent = main.get_messages_from_db(room_id, limit=5)
+            self.cursors[room_id] = main.message_cursor(recent[0]) if recent else None
+
+    def _content(self):
+        return ''.join(self.rng.choices('abcdefghijklmnopqrstuvwxyz ', k=self.message_size))
+
+    def _pick(self):
+        index = self.rng.randrange(len(self.partners))
+        return self.partners[index], self.room_ids[index]
+
+    def build(self, action):
+        """(ユーザー, リクエストボディ) を返す"""
+        partner, room_id = self._pick()
+        if action == 'get_messages':
+            return self.owner, {'action': 'get_messages', 'room_id': room_id}
+        if action == 'get_messages_since':
+            return self.owner, {'action': 'get_messages', 'room_id': room_id, 'since': self.cursors[room_id]}
+        if action == 'send_message':
+            return self.owner, {
+                'action': 'send_message', 'room_id': room_id, 'receiver_email': partner,
+                'content': self._content(), 'message_id': f'{self.rng.getrandbits(64):016x}',
+            }
+        if action == 'list_rooms':
+            return self.owner, {'action': 'list_rooms'}
+        if action == 'batch':
+            room_ids = self.rng.sample(self.room_ids, min(BATCH_ROOMS, len(self.room_ids)))
+            return self.owner, {'action': 'batch', 'requests': [
+                {'action': 'get_messages', 'room_id': batch_room_id} for batch_room_id in room_ids
+            ]}
+        raise ValueError(f'Unknown benchmark action: {action}')
+
+
+def percentile(sorted_values, fraction):
+    """ソート済みのリストの nearest-rank パーセンタイル"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run_action(app, workload, action, total_requests, concurrency, accept):
+    """1 つのアクションを total_requests 回、concurrency 並列で実行し、集計結果を返す"""
+    # リクエストの組み立ては計測の外で行う (乱数生成のロック競合を計測に含めない)
+    requests_to_send = [workload.build(action) for _ in range(total_requests)]
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    local = threading.local()
+
+    def send(item):
+        client = getattr(local, 'client', None)
+        if client is None:
+            client = local.client = app.test_client()
+        user, body = item
+        started_at = time.perf_counter()
+        response = client.post('/', json=body, headers={'Authorization': f'Bearer {user}', 'Accept': accept})
+        response.get_data() # レスポンスの本体 (シリアライズ・圧縮) まで計測に含める
+        elapsed_ms = (time.perf_counter() - started_at) * 1000
+        with lock:
+            latencies.append(elapsed_ms)
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+    started_at = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(send, requests_to_send))
+    elapsed = time.perf_counter() - started_at
+
+    return summarize(latencies, errors, total_requests, elapsed)
+
+
+def summarize(latencies, errors, total_requests, elapsed):
+    """リクエストごとのレイテンシ (ms) とエラーのステータスから集計結果を作る"""
+    latencies = sorted(latencies)
+    return {
+        'requests': total_requests,
+        'errors': len(errors),
+        'error_statuses': sorted(set(errors)),
+        'elapsed_seconds': round(elapsed, 4),
+        'throughput_rps': round(total_requests / elapsed, 2) if elapsed else 0.0,
+        'mean_ms': round(sum(latencies) / len(latencies), 3) if latencies else 0.0,
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'max_ms': round(latencies[-1], 3) if latencies else 0.0,
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=CHAT_API_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    baseline_actions = (baseline or {}).get('actions', {})
+    print(f"{'action':<20}{'rps':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for action, stat in results['actions'].items():
+        print(f"{action:<20}{stat['throughput_rps']:>10.1f}{stat['p50_ms']:>10.3f}"
+              f"{stat['p95_ms']:>10.3f}{stat['p99_ms']:>10.3f}{stat['errors']:>8}")
+        before = baseline_actions.get(action)
+        if before:
+            deltas = []
+            for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+                if before.get(key):
+                    deltas.append(f"{key} {(stat[key] - before[key]) / before[key] * 100:+.1f}%")
+            print(f"{'':<20}vs baseline: {', '.join(deltas)}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--actions', default=','.join(DEFAULT_ACTIONS),
+                        help=f"計測するアクション (カンマ区切り。既定: {','.join(DEFAULT_ACTIONS)})")
+    parser.add_argument('--concurrency', type=int, default=8, help='並列数')
+    parser.add_argument('--requests', type=int, default=1000, help='アクションごとのリクエスト数')
+    parser.add_argument('--warmup', type=int, default=50, help='計測前にアクションごとに送るリクエスト数')
+    parser.add_argument('--rooms', type=int, default=20, help='ルーム数')
+    parser.add_argument('--seed-messages', type=int, default=200, help='ルームごとに事前に保存するメッセージ数')
+    parser.add_argument('--message-size', type=int, default=100, help='メッセージ本文の文字数')
+    parser.add_argument('--format', choices=sorted(ACCEPT_HEADERS), default='json', help='要求するレスポンス形式')
+    parser.add_argument('--room-cache-ttl', type=float, default=None,
+                        help='ROOM_CACHE_TTL_SECONDS を上書きする (0 でキャッシュを常に期限切れにする)')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='ユーザーごとのレート制限を有効にしたまま計測する (429 がエラーとして数えられる)')
+    parser.add_argument('--seed', type=int, default=1, help='乱数のシード')
+    parser.add_argument('--output', help='結果を保存する JSON ファイル')
+    parser.add_argument('--baseline', help='比較する以前の結果 (JSON ファイル)')
+    parser.add_argument('--verbose', action='store_true', help='chat_api のログ出力を表示する')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    actions = [action.strip() for action in args.actions.split(',') if action.strip()]
+    chat_api = load_app(args)
+    rng = random.Random(args.seed)
+    accept = ACCEPT_HEADERS[args.format]
+
+    # chat_api はリクエストごとにログを print するため、既定では計測中の出力を捨てる
+    log_sink = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    with log_sink:
+        workload = Workload(chat_api, args.rooms, args.seed_messages, args.message_size, rng)
+        action_results = {}
+        for action in actions:
+            if args.warmup:
+                run_action(chat_api.app, workload, action, args.warmup, args.concurrency, accept)
+            action_results[action] = run_action(chat_api.app, workload, action, args.requests, args.concurrency, accept)
+
+    results = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('output', 'baseline', 'verbose')},
+        'actions': action_results,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.output}")
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Cloud Functions (chat_api) の main モジュールの import 時間が予算内に収まっているか確認する
+
+import 時間はそのままコールドスタートの遅延になる。新しいプロセスで main を import し、
+-X importtime で計測した累積時間 (複数回の最小値) が予算を超えた場合、または初回の利用まで
+遅らせているはずの重いモジュールが import 時に読み込まれていた場合は終了コード 1 で失敗する。
+
+    python benchmarks/import_time_check.py --budget-ms 250 --runs 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+CHAT_API_DIR = Path(__file__).resolve().parent.parent / 'cloud_functions' / 'chat_api'
+DEFAULT_BUDGET_MS = 250
+# import 時には読み込まず、初回の利用 (またはウォームアップ) で読み込むモジュール
+DEFERRED_MODULES = ['google.cloud.firestore', 'google.auth.jwt', 'requests', 'pytz']
+
+PROBE = """
+import json, sys
+import main
+print(json.dumps([name for name in {deferred!r} if name in sys.modules]))
+"""
+
+
+def measure_once(deferred_modules):
+    """新しいプロセスで main を import し、(main の累積 import 時間 ms, import 時に読み込まれた重いモジュール) を返す"""
+    env = {**os.environ, 'GOOGLE_OAUTH_CLIENT_ID': os.environ.get('GOOGLE_OAUTH_CLIENT_ID', 'import-time-check')}
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', PROBE.format(deferred=deferred_modules)],
+        cwd=CHAT_API_DIR, env=env, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        # import 時に例外 (認証情報のないクライアント作成など) が起きた場合
+        errors = [line for line in result.stderr.splitlines() if not line.startswith('import time:')]
+        raise RuntimeError("import main failed:\n" + '\n'.join(errors[-20:]))
+    main_us = None
+    for line in result.stderr.splitlines():
+        # "import time: self [us] | cumulative | imported package"
+        if line.startswith('import time:') and line.rstrip().endswith('| main'):
+            main_us = int(line.split('|')[1])
+    if main_us is None:
+        raise RuntimeError(f"Could not find main in -X importtime output:\n{result.stderr[-2000:]}")
+    return main_us / 1000, json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget-ms', type=float, default=float(os.environ.get('IMPORT_TIME_BUDGET_MS', DEFAULT_BUDGET_MS)),
+                        help=f'main の import 時間の予算 (ミリ秒。既定: {DEFAULT_BUDGET_MS})')
+    parser.add_argument('--runs', type=int, default=5, help='計測回数 (最小値を使う)')
+    args = parser.parse_args(argv)
+
+    timings = []
+    eager_modules = set()
+    for _ in range(args.runs):
+        elapsed_ms, eager = measure_once(DEFERRED_MODULES)
+        timings.append(elapsed_ms)
+        eager_modules.update(eager)
+    best_ms = min(timings)
+    print(f"import main: best {best_ms:.1f} ms, runs {', '.join(f'{t:.1f}' for t in timings)} ms (budget {args.budget_ms:.0f} ms)")
+
+    failed = False
+    if eager_modules:
+        print(f"FAIL: modules that should be loaded lazily were imported at startup: {', '.join(sorted(eager_modules))}")
+        failed = True
+    if best_ms > args.budget_ms:
+        print(f"FAIL: import time {best_ms:.1f} ms exceeds the budget of {args.budget_ms:.0f} ms")
+        failed = True
+    if not failed:
+        print("OK")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
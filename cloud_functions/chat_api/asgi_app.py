@@ -0,0 +1,433 @@
+"""chat_api の ASGI エントリーポイント (firestore.AsyncClient を使う非同期版)
+
+main.py (Flask / WSGI) と同じアクションのプロトコル (POST / の JSON ボディ、Accept による形式の選択、
+ETag / 304、圧縮、Server-Timing、レート制限と負荷制限) を asyncio で処理する。トークン検証と保存先への
+アクセスを await するため、1 つのインスタンスで多数のリクエストの I/O を重ねられる
+(WSGI 版の同時処理数は ワーカー数 × スレッド数 が上限)。
+メッセージストリーム (/stream) とルームの書き出し (/export) は提供しない。これらが必要な場合は WSGI 版を使う。
+保存先 (CHAT_STORAGE_BACKEND) は storage.ASYNC_STORAGE_BACKENDS にあるもの ('firestore', 'firestore_buckets', 'memory') を使える。
+
+Cloud Functions (2nd gen) の Python ランタイムは WSGI のため、ASGI 版は Cloud Run などで uvicorn を使って起動する:
+
+    uvicorn asgi_app:app --host 0.0.0.0 --port $PORT
+"""
+import asyncio
+import contextlib
+import contextvars
+import json
+import math
+import os
+import time
+import uuid
+
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+
+import main
+from main import (
+    COMPRESS_MIN_BYTES, CONTENT_TYPE_JSON, ROOM_CACHE_MAX_MESSAGES, ROOMS_MAX_PAGE_SIZE, ROOMS_PAGE_SIZE,
+    SERVER_TIMING_ENABLED, admit_request, decode_cursor, encode_body, error_response_for_exception, messages_etag,
+    parse_page_size, room_cache, send_result_body, token_cache,
+)
+from storage import (
+    ASYNC_STORAGE_BACKENDS, InMemoryStorage, AsyncInMemoryStorage, MessageAlreadyExists, create_async_storage,
+)
+
+# --- 定数 ---
+# イベントループ 1 つで同時に処理するリクエスト数の上限 (WSGI 版の SHED_MAX_CONCURRENT に相当)
+ASYNC_SHED_MAX_CONCURRENT = int(os.environ.get('ASYNC_SHED_MAX_CONCURRENT', 1000))
+# 受け付けるリクエストボディの上限 (バイト)
+ASGI_MAX_BODY_BYTES = int(os.environ.get('ASGI_MAX_BODY_BYTES', 1024 * 1024))
+
+# インメモリバックエンドでは WSGI 版 (main.storage) と同じデータを共有する (同じプロセスで両方を動かす負荷試験用)
+if isinstance(main.storage, InMemoryStorage):
+    storage = AsyncInMemoryStorage(main.storage)
+elif main.CHAT_STORAGE_BACKEND not in ASYNC_STORAGE_BACKENDS:
+    # 非同期版のない保存先では起動しない (リクエストごとに失敗させるより、起動時に設定の誤りを示す)
+    raise RuntimeError(
+        f"CHAT_STORAGE_BACKEND={main.CHAT_STORAGE_BACKEND!r} is not supported by the ASGI entry point "
+        f"(supported: {', '.join(ASYNC_STORAGE_BACKENDS)})"
+    )
+else:
+    storage = create_async_storage(main.CHAT_STORAGE_BACKEND)
+
+# 同時処理数の上限はイベントループ単位で持つ (レート制限・キャッシュ・重複排除は WSGI 版と共有)
+load_shedder = main.LoadShedder(max_concurrent=ASYNC_SHED_MAX_CONCURRENT)
+
+# --- リクエスト / レスポンス ---
+class AsgiRequest:
+    """ASGI の 1 リクエスト (ヘッダー、ボディの読み込み、計測の状態)"""
+
+    def __init__(self, scope, receive):
+        self.path = scope['path']
+        self.method = scope['method']
+        self.headers = {} # 小文字のヘッダー名 -> 値 (同じヘッダーが複数あれば ", " で結合)
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').lower()
+            value = value.decode('latin-1')
+            self.headers[name] = f"{self.headers[name]}, {value}" if name in self.headers else value
+        self._receive = receive
+        self.timer = main.RequestTimer()
+        # クライアントのログと突き合わせるための ID (クライアントが送らなければ生成する)
+        self.request_id = self.headers.get('x-request-id') or uuid.uuid4().hex
+        self.action = None
+
+    async def body(self):
+        chunks = []
+        size = 0
+        while True:
+            message = await self._receive()
+            if message['type'] == 'http.disconnect':
+                raise ConnectionAbortedError("Client disconnected before sending the request body")
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > ASGI_MAX_BODY_BYTES:
+                raise ValueError(f"Invalid request: body exceeds {ASGI_MAX_BODY_BYTES} bytes")
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                return b''.join(chunks)
+
+    async def json(self):
+        """JSON ボディを辞書で返す (ボディがなければ None)"""
+        body = await self.body()
+        if not body:
+            return None
+        try:
+            return json.loads(body)
+        except ValueError:
+            raise ValueError("Invalid request: body is not valid JSON")
+
+
+class AsgiResponse:
+
+    def __init__(self, body=b'', status=200, content_type=CONTENT_TYPE_JSON, headers=None):
+        self.body = body
+        self.status = status
+        self.headers = {'Content-Type': content_type} if content_type else {}
+        self.headers.update(headers or {})
+
+    async def send(self, send):
+        headers = [(name.lower().encode('latin-1'), str(value).encode('latin-1')) for name, value in self.headers.items()]
+        headers.append((b'content-length', str(len(self.body)).encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': self.status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+def json_response(body, status=200, headers=None):
+    return AsgiResponse(json.dumps(body, separators=(',', ':')).encode('utf-8'), status, headers=headers)
+
+def rate_limited_response(retry_after):
+    """429 Too Many Requests (main.rate_limited_response と同じ内容)"""
+    return json_response({"error": "Too many requests", "retry_after": round(retry_after, 3)}, 429,
+                         headers={'Retry-After': max(1, math.ceil(retry_after))})
+
+def overloaded_response():
+    return json_response({"error": "Server is overloaded, please retry"}, 503, headers={'Retry-After': 1})
+
+# --- リクエストの計測 ---
+_request_timer = contextvars.ContextVar('request_timer', default=None)
+
+def request_phase(name):
+    """現在のリクエストの計測にフェーズを記録するコンテキストマネージャ (main.request_phase の ASGI 版)"""
+    timer = _request_timer.get()
+    return timer.phase(name) if timer is not None else contextlib.nullcontext()
+
+def finish_response(req, response):
+    """圧縮と Server-Timing / 構造化ログ (WSGI 版の after_request に相当) を適用する"""
+    if response.status == 200 and len(response.body) >= COMPRESS_MIN_BYTES:
+        with request_phase('compress'):
+            compressed, encoding = main.compress_body(response.body, parse_accept_header(req.headers.get('accept-encoding')))
+        if encoding is not None:
+            response.body = compressed
+            response.headers['Content-Encoding'] = encoding
+            response.headers['Vary'] = 'Accept-Encoding'
+    total_ms = req.timer.total_ms()
+    response.headers['X-Request-ID'] = req.request_id
+    if SERVER_TIMING_ENABLED:
+        response.headers['Server-Timing'] = req.timer.server_timing(total_ms)
+    if main.should_log_request(response.status, total_ms):
+        main.log_request_timing(req.request_id, req.path, req.action, response.status, req.timer, total_ms,
+                                len(response.body))
+    return response
+
+# --- 認証 ---
+async def verify_id_token_async(auth_header):
+    """main.verify_id_token の非同期版
+
+    検証済みトークンのキャッシュにあればその場で返す。なければ証明書の取得 (通信) を含む検証を
+    スレッドで実行し、イベントループを止めない。
+    """
+    token = main.parse_bearer_token(auth_header)
+    cached_idinfo = token_cache.get(token)
+    if cached_idinfo is not None:
+        return cached_idinfo
+    return await asyncio.to_thread(main.verify_uncached_token, token)
+
+# --- 保存先の操作関数 (main.py の同名の関数の非同期版) ---
+async def get_messages_from_db(room_id, limit=50, since=None, before=None):
+    if since and before:
+        raise ValueError("'since' and 'before' cannot be specified together")
+    since_position = decode_cursor(since) if since else None
+    before_position = decode_cursor(before) if before else None
+    with request_phase('db'):
+        return await storage.get_messages(room_id, limit, since=since_position, before=before_position)
+
+async def get_messages_cached(room_id, limit=50, since=None, before=None):
+    """インスタンス内のルームキャッシュを優先してメッセージを取得 (キャッシュは WSGI 版と同じ規則で更新する)"""
+    if before:
+        return await get_messages_from_db(room_id, limit=limit, before=before)
+    cached = room_cache.get(room_id, limit, since)
+    if cached is not None:
+        return cached
+
+    fetched_through = room_cache.fetched_through(room_id)
+    if fetched_through:
+        delta = await get_messages_from_db(room_id, limit=ROOM_CACHE_MAX_MESSAGES, since=fetched_through)
+        if len(delta) < ROOM_CACHE_MAX_MESSAGES and room_cache.refresh(room_id, delta):
+            cached = room_cache.lookup(room_id, limit, since)
+            if cached is not None:
+                return cached
+
+    if since:
+        return await get_messages_from_db(room_id, limit=limit, since=since)
+    messages = await get_messages_from_db(room_id, limit=limit)
+    room_cache.store(room_id, messages, complete=len(messages) < limit)
+    return messages
+
+async def send_message_to_db(room_id, sender_email, receiver_email, content, message_id=None):
+    """メッセージを保存する (重複排除・ルームキャッシュの扱いは main.send_message_to_db と同じ)"""
+    write_batch = storage.batch()
+    saved_message = main.send_message_to_db(room_id, sender_email, receiver_email, content, message_id, batch=write_batch)
+    if saved_message.get('duplicate'):
+        return saved_message
+    try:
+        with request_phase('db'):
+            await write_batch.commit()
+    except MessageAlreadyExists:
+        with request_phase('db'):
+            existing = await storage.get_message(room_id, message_id)
+        return main.accept_existing_message(room_id, existing, sender_email)
+    main.record_sent_message(room_id, saved_message, message_id)
+    print(f"Message saved to room {room_id} by {sender_email}")
+    return saved_message
+
+# --- アクション処理 (main.py の同名のアクションの非同期版) ---
+async def action_get_messages(user_email, req_data):
+    room_id, limit, since, before = main.parse_get_messages(user_email, req_data)
+    messages = await get_messages_cached(room_id, limit=limit, since=since, before=before)
+    return main.messages_page_body(messages, limit, since, before), 200
+
+async def action_send_message(user_email, req_data):
+    saved_message = await send_message_to_db(*main.validate_send_message(user_email, req_data))
+    return send_result_body(saved_message), 200
+
+async def _run_batch_item(handler, user_email, item):
+    try:
+        body, status = await handler(user_email, item)
+    except Exception as e:
+        body, status = error_response_for_exception(e)
+    return {"status": status, "body": body}
+
+async def action_batch(user_email, req_data):
+    """batch: 書き込みを 1 つのバッチでコミットした後、読み込みを並行に await する"""
+    results, read_items, write_items = main.split_batch_items(req_data)
+
+    if write_items:
+        write_batch = storage.batch()
+        committed, repeated = main.stage_batch_writes(user_email, write_items, write_batch, results)
+        if committed:
+            try:
+                with request_phase('db'):
+                    await write_batch.commit()
+                main.finish_batch_writes(user_email, committed, results)
+            except MessageAlreadyExists:
+                print(f"Batch commit hit an existing message_id, retrying {len(committed)} write(s) individually")
+                for index, send_args, _ in committed:
+                    try:
+                        saved_message = await send_message_to_db(*send_args)
+                        results[index] = {"status": 200, "body": send_result_body(saved_message)}
+                    except Exception as e:
+                        body, status = error_response_for_exception(e)
+                        results[index] = {"status": status, "body": body}
+            except Exception as e:
+                main.fail_batch_writes(e, committed, results)
+        main.resolve_repeated_writes(repeated, results)
+
+    read_results = await asyncio.gather(*(
+        _run_batch_item(action_get_messages, user_email, item) for _, item in read_items
+    ))
+    for (index, _), result in zip(read_items, read_results):
+        results[index] = result
+    return {"results": results}, 200
+
+async def action_list_rooms(user_email, req_data):
+    limit = parse_page_size(req_data.get('limit'), default=ROOMS_PAGE_SIZE, maximum=ROOMS_MAX_PAGE_SIZE)
+    with request_phase('db'):
+        summaries = await storage.list_rooms(user_email, limit)
+    return {"rooms": [main.room_for_user(summary, user_email) for summary in summaries]}, 200
+
+async def action_mark_room_read(user_email, req_data):
+    room_id = req_data.get('room_id')
+    main.require_room_member(user_email, room_id)
+    with request_phase('db'):
+        await storage.mark_room_read(room_id, user_email)
+    return {"success": True}, 200
+
+async def action_search_messages(user_email, req_data):
+    room_id, query, limit, before = main.parse_search_messages(user_email, req_data)
+    scan = main.SearchScan(query, limit, before)
+    while True:
+        page_size = scan.next_page_size()
+        if not page_size:
+            return scan.body(), 200
+        with request_phase('db'):
+            candidates = await storage.search_messages(room_id, scan.lookup_term, page_size, before=scan.position)
+        scan.feed(candidates, page_size)
+
+async def action_stats(user_email, req_data):
+    body, status_code = main.action_stats(user_email, req_data)
+    return {**body, "load_shedder": load_shedder.stats()}, status_code
+
+ACTION_HANDLERS = {
+    'get_messages': action_get_messages,
+    'send_message': action_send_message,
+    'batch': action_batch,
+    'list_rooms': action_list_rooms,
+    'mark_room_read': action_mark_room_read,
+    'search_messages': action_search_messages,
+    'stats': action_stats,
+}
+
+# --- 条件付きリクエスト (ETag / 304) ---
+def negotiate_response_format(req):
+    accept = parse_accept_header(req.headers.get('accept'), MIMEAccept)
+    return accept.best_match(main.offered_response_formats(), default=CONTENT_TYPE_JSON)
+
+def not_modified_response(req, etag):
+    if etag is not None and parse_etags(req.headers.get('if-none-match')).contains(etag):
+        return AsgiResponse(status=304, content_type=None, headers={'ETag': f'"{etag}"'})
+    return None
+
+def precheck_get_messages_etag(req, user_email, req_data, response_format):
+    """ルームキャッシュが有効な間は、保存先もレスポンス作成も通さずに 304 で応答できるか確認する"""
+    if not req.headers.get('if-none-match'):
+        return None
+    main.require_room_member(user_email, req_data.get('room_id'))
+    version = room_cache.fresh_version(req_data.get('room_id'))
+    if version is None and not req_data.get('before'):
+        return None
+    return not_modified_response(req, messages_etag(req_data, version, response_format))
+
+# --- HTTP リクエストハンドラ ---
+async def handle_request(req):
+    """POST / (main.handle_request と同じプロトコル)"""
+    if not load_shedder.try_enter():
+        return overloaded_response()
+    started_at = time.perf_counter()
+    try:
+        return await process_request(req)
+    finally:
+        load_shedder.exit((time.perf_counter() - started_at) * 1000)
+
+async def process_request(req):
+    try:
+        with request_phase('auth'):
+            user_info = await verify_id_token_async(req.headers.get('authorization'))
+        user_email = user_info.get('email')
+        if not user_email:
+            return json_response({"error": "Email not found in verified token"}, 403)
+
+        with request_phase('parse'):
+            req_data = await req.json()
+        if not req_data:
+            return json_response({"error": "Invalid request: Missing JSON body"}, 400)
+        if not isinstance(req_data, dict) or 'action' not in req_data:
+            return json_response({"error": "Invalid request: Missing 'action' in JSON body"}, 400)
+
+        action = req.action = req_data.get('action')
+        handler = ACTION_HANDLERS.get(action)
+        if handler is None:
+            return json_response({"error": f"Unknown action: {action}"}, 400)
+        retry_after = admit_request(user_email, action, req_data)
+        if retry_after:
+            return rate_limited_response(retry_after)
+        response_format = negotiate_response_format(req)
+        if action == 'get_messages':
+            precheck = precheck_get_messages_etag(req, user_email, req_data, response_format)
+            if precheck is not None:
+                return precheck
+        with request_phase('action'):
+            body, status_code = await handler(user_email, req_data)
+        etag = None
+        if action == 'get_messages' and status_code == 200:
+            etag = messages_etag(req_data, body.get('cursor') or '', response_format)
+            not_modified = not_modified_response(req, etag)
+            if not_modified is not None:
+                return not_modified
+        with request_phase('serialize'):
+            response = AsgiResponse(encode_body(body, response_format), status_code, content_type=response_format)
+        if etag is not None:
+            response.headers['ETag'] = f'"{etag}"'
+        return response
+
+    except Exception as e:
+        body, status_code = error_response_for_exception(e)
+        return json_response(body, status_code)
+
+_warmup_lock = asyncio.Lock()
+_warmup_done = False
+
+async def handle_warmup(req):
+    """GET /warmup (main.handle_warmup と同じ。google.auth の読み込みと証明書の取得はスレッドで行う)"""
+    global _warmup_done
+    if _warmup_done:
+        return json_response({"warm": True})
+    started_at = time.perf_counter()
+    async with _warmup_lock:
+        if not _warmup_done:
+            try:
+                with request_phase('auth'):
+                    await asyncio.to_thread(main.google_jwt_module.get)
+                    await asyncio.to_thread(main.cert_store.get_certs)
+                with request_phase('db'):
+                    await storage.warmup()
+            except Exception as e:
+                print(f"Warmup failed: {e}")
+                return json_response({"warm": False, "error": "Warmup failed"}, 503)
+            _warmup_done = True
+    return json_response({"warm": True, "elapsed_ms": round((time.perf_counter() - started_at) * 1000, 2)})
+
+ROUTES = {
+    ('POST', '/'): handle_request,
+    ('GET', '/warmup'): handle_warmup,
+}
+
+async def _handle_lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    """ASGI アプリケーション"""
+    if scope['type'] == 'lifespan':
+        await _handle_lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+    req = AsgiRequest(scope, receive)
+    handler = ROUTES.get((req.method, req.path))
+    if handler is None:
+        allowed = any(path == req.path for _, path in ROUTES)
+        response = json_response({"error": "Method Not Allowed" if allowed else "Not Found"}, 405 if allowed else 404)
+        await response.send(send)
+        return
+    timer_token = _request_timer.set(req.timer)
+    try:
+        response = finish_response(req, await handler(req))
+    finally:
+        _request_timer.reset(timer_token)
+    await response.send(send)
@@ -1,13 +1,42 @@
 # (内容は変更なし)
 import os
+import bisect
+import contextlib
 import datetime
-import pytz
-from flask import Flask, request, jsonify
-from google.cloud import firestore
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
+import gzip
+import hashlib
+import json
+import math
+import queue
+import random
+import re
+import threading
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, g, has_request_context, request, jsonify, stream_with_context
 import traceback # エラー詳細表示用
 
+import search_index
+from storage import MessageAlreadyExists, create_storage
+
+# brotli 圧縮用 (任意。インストールされていなければ gzip のみ)
+try:
+    import brotli
+except ImportError:
+    brotli = None
+# compact 形式のレスポンス用 (任意。インストールされていなければ標準の json を使う / msgpack 形式は提供しない)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # --- 定数 ---
 # 環境変数から OAuth クライアント ID を取得 (デプロイ時に .env.yaml から設定される)
 GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_OAUTH_CLIENT_ID')
@@ -16,16 +45,335 @@ if not GOOGLE_CLIENT_ID:
     # ローカルテスト用にデフォルト値を設定する場合（推奨しません）
     # if os.environ.get('FUNCTIONS_EMULATOR'): GOOGLE_CLIENT_ID = "YOUR_LOCAL_TEST_CLIENT_ID"
 
-# Firestore クライアント初期化 (Functions の実行環境のSAを使用)
-db = firestore.Client()
-jst = pytz.timezone('Asia/Tokyo')
+# 検証済みトークンキャッシュの設定
+TOKEN_CACHE_MAX_ENTRIES = int(os.environ.get('TOKEN_CACHE_MAX_ENTRIES', 1024))
+# exp の何秒前にキャッシュを失効させるか (時計のずれ・通信遅延を吸収するためのマージン)
+TOKEN_CACHE_EXP_SKEW_SECONDS = int(os.environ.get('TOKEN_CACHE_EXP_SKEW_SECONDS', 30))
+
+# Google の ID トークン署名用証明書 (PEM 形式) の取得先
+# テスト時は環境変数でローカルのダミーエンドポイントに差し替えられる
+GOOGLE_CERTS_URL = os.environ.get('GOOGLE_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs')
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+# Cache-Control に max-age が無い場合の証明書の有効期間 (秒)
+CERT_DEFAULT_MAX_AGE_SECONDS = int(os.environ.get('CERT_DEFAULT_MAX_AGE_SECONDS', 3600))
+# 失効の何秒前からバックグラウンドで証明書を再取得するか
+CERT_REFRESH_AHEAD_SECONDS = int(os.environ.get('CERT_REFRESH_AHEAD_SECONDS', 300))
+# 未知の kid を受け取った際の強制再取得の最短間隔 (秒)。不正なトークンによる連続取得を防ぐ
+CERT_MIN_FORCED_REFRESH_INTERVAL_SECONDS = 30
+# 証明書取得時のタイムアウト (接続, 読み込み)
+CERT_FETCH_TIMEOUT = (3.05, 10)
+
+# get_messages で 1 回に返すメッセージ数 (デフォルトと、クライアントが指定できる上限)
+MESSAGES_PAGE_SIZE = 50
+MESSAGES_MAX_PAGE_SIZE = int(os.environ.get('MESSAGES_MAX_PAGE_SIZE', 200))
+
+# インスタンス内のルームメッセージキャッシュの設定
+# TTL を短くして、他インスタンスからの書き込みもこの秒数以内に見えるようにする
+ROOM_CACHE_TTL_SECONDS = float(os.environ.get('ROOM_CACHE_TTL_SECONDS', 5))
+ROOM_CACHE_MAX_BYTES = int(os.environ.get('ROOM_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+ROOM_CACHE_MAX_MESSAGES = int(os.environ.get('ROOM_CACHE_MAX_MESSAGES', 200))
+
+# メッセージストリーム (Server-Sent Events) の設定
+# 1 本のストリームを開いておく最大秒数 (Functions のタイムアウトより短くする。クライアントは最後のカーソルで再接続する)
+STREAM_MAX_SECONDS = float(os.environ.get('STREAM_MAX_SECONDS', 55))
+# 新着がない間に送るハートビートの間隔 (プロキシによる切断を防ぐ)
+STREAM_HEARTBEAT_SECONDS = float(os.environ.get('STREAM_HEARTBEAT_SECONDS', 15))
+# インスタンスで同時に開いておくストリームの上限 (1 本がスレッドとリスナーを最大 STREAM_MAX_SECONDS 秒占有する)
+STREAM_MAX_CONCURRENT = int(os.environ.get('STREAM_MAX_CONCURRENT', 40))
+
+# ルームの書き出し (/export) の設定: 1 回のクエリで読むメッセージ数と、1 本のレスポンスで書き出す最大秒数
+# (Functions のタイムアウトより短くする。途中で打ち切った場合、クライアントは最後の行のカーソルから再開する)
+EXPORT_PAGE_SIZE = int(os.environ.get('EXPORT_PAGE_SIZE', 500))
+EXPORT_MAX_SECONDS = float(os.environ.get('EXPORT_MAX_SECONDS', 50))
+
+# レスポンス圧縮の設定 (この バイト数未満のボディは圧縮しない)
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+GZIP_COMPRESS_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# batch アクションで 1 回に受け付けるサブアクション数の上限と、読み込みの並列数
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 20))
+BATCH_READ_WORKERS = int(os.environ.get('BATCH_READ_WORKERS', 8))
+# send_message の冪等キー (クライアントが生成するメッセージ ID) の形式と、重複排除のためにインスタンス内で覚えておく期間・件数
+MESSAGE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{8,64}$')
+SEND_DEDUP_WINDOW_SECONDS = float(os.environ.get('SEND_DEDUP_WINDOW_SECONDS', 600))
+SEND_DEDUP_MAX_ENTRIES = int(os.environ.get('SEND_DEDUP_MAX_ENTRIES', 10000))
+# list_rooms で返すルーム数
+ROOMS_PAGE_SIZE = 50
+ROOMS_MAX_PAGE_SIZE = 100
+# search_messages で返すヒット数 (デフォルトと上限)、検索語の最大文字数と、
+# 1 回の検索で索引から読む候補の件数 (1 回のクエリで読む件数と、1 リクエストで読む合計の上限)
+SEARCH_PAGE_SIZE = 20
+SEARCH_MAX_PAGE_SIZE = 50
+SEARCH_QUERY_MAX_CHARS = 100
+SEARCH_SCAN_PAGE_SIZE = int(os.environ.get('SEARCH_SCAN_PAGE_SIZE', 100))
+SEARCH_MAX_SCANNED = int(os.environ.get('SEARCH_MAX_SCANNED', 500))
+# リクエストの計測: Server-Timing ヘッダーを付けるか、構造化ログを出すリクエストの割合と、
+# 割合に関わらず必ずログを出す遅いリクエストのしきい値 (ミリ秒。5xx も必ず出す)
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING_ENABLED', '1') == '1'
+REQUEST_LOG_SAMPLE_RATE = float(os.environ.get('REQUEST_LOG_SAMPLE_RATE', 0.1))
+REQUEST_LOG_SLOW_MS = float(os.environ.get('REQUEST_LOG_SLOW_MS', 1000))
+# ユーザーごとのレート制限 (トークンバケット)。読み込みと書き込みで別の予算 (1 秒あたりの補充数と上限) を持つ
+RATE_LIMIT_ENABLED = os.environ.get('RATE_LIMIT_ENABLED', '1') == '1'
+RATE_LIMIT_READ_PER_SECOND = float(os.environ.get('RATE_LIMIT_READ_PER_SECOND', 10))
+RATE_LIMIT_READ_BURST = float(os.environ.get('RATE_LIMIT_READ_BURST', 30))
+RATE_LIMIT_WRITE_PER_SECOND = float(os.environ.get('RATE_LIMIT_WRITE_PER_SECOND', 2))
+RATE_LIMIT_WRITE_BURST = float(os.environ.get('RATE_LIMIT_WRITE_BURST', 10))
+RATE_LIMIT_MAX_USERS = int(os.environ.get('RATE_LIMIT_MAX_USERS', 10000))
+# インスタンス全体の負荷制限: 同時処理数の上限と、平均レイテンシが目標を超えている間に絞る上限
+SHED_MAX_CONCURRENT = int(os.environ.get('SHED_MAX_CONCURRENT', 80))
+SHED_DEGRADED_CONCURRENT = int(os.environ.get('SHED_DEGRADED_CONCURRENT', 8))
+SHED_LATENCY_TARGET_MS = float(os.environ.get('SHED_LATENCY_TARGET_MS', 2000))
+
+# stats アクション (インスタンスのキャッシュ・制限の内部状態) を参照できる管理者のメールアドレス (カンマ区切り。空なら誰も参照できない)
+STATS_ADMIN_EMAILS = {
+    email.strip().lower() for email in os.environ.get('STATS_ADMIN_EMAILS', '').split(',') if email.strip()
+}
+
+# メッセージの保存先 ('firestore'、メッセージを時間バケットにまとめる 'firestore_buckets'、またはローカル実行・負荷試験用の 'memory')
+CHAT_STORAGE_BACKEND = os.environ.get('CHAT_STORAGE_BACKEND', 'firestore')
+storage = create_storage(CHAT_STORAGE_BACKEND)
+
+# batch アクションの読み込みを並列実行するスレッドプール (リクエスト間で共有)
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_READ_WORKERS, thread_name_prefix='batch-read')
 
 # Flask アプリケーションの作成
 app = Flask(__name__)
 
+class LazyResource:
+    """初回の利用時に factory で作り、以降はプロセス内で共有するオブジェクト
+
+    重いクライアントの作成やモジュールの読み込みを import 時から初回のリクエスト (またはウォームアップ) に
+    遅らせ、コールドスタートを短くする。作成は 1 回だけ行われる (スレッドセーフ)。
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        value = self._value
+        if value is None:
+            with self._lock:
+                if self._value is None:
+                    self._value = self._factory()
+                value = self._value
+        return value
+
+    @property
+    def initialized(self):
+        return self._value is not None
+
+# --- 検証済みトークンキャッシュ ---
+class VerifiedTokenCache:
+    """検証済み ID トークンのクレームを保持するスレッドセーフな LRU キャッシュ
+
+    キーはトークン文字列そのものではなく SHA-256 ダイジェストを使う (メモリ上に生トークンを残さないため)。
+    各エントリはトークンの exp からマージンを引いた時刻で失効する。
+    """
+
+    def __init__(self, max_entries=TOKEN_CACHE_MAX_ENTRIES, skew_seconds=TOKEN_CACHE_EXP_SKEW_SECONDS):
+        self.max_entries = max_entries
+        self.skew_seconds = skew_seconds
+        self._entries = OrderedDict() # digest -> (expires_at, idinfo)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        """キャッシュ済みのクレームを返す。未登録または失効済みなら None"""
+        key = self._digest(token)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                if entry is not None:
+                    del self._entries[key] # 失効済みエントリを削除
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return dict(entry[1]) # 呼び出し側での変更がキャッシュに波及しないようコピーを返す
+
+    def put(self, token, idinfo):
+        """検証済みクレームを登録する。exp が無い・既に失効間近のトークンはキャッシュしない"""
+        try:
+            expires_at = float(idinfo.get('exp', 0)) - self.skew_seconds
+        except (TypeError, ValueError):
+            return
+        if self.max_entries <= 0 or expires_at <= time.time():
+            return
+        key = self._digest(token)
+        with self._lock:
+            self._entries[key] = (expires_at, dict(idinfo))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False) # 最も古く使われたエントリを追い出す
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ヒット/ミス数とヒット率を返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits / total) if total else 0.0,
+            }
+
+token_cache = VerifiedTokenCache()
+
+# --- Google 証明書ストア ---
+# Google API への HTTPS 通信はプロセス内で共有するセッション (コネクションプール, keep-alive) を使う
+def _create_http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=2))
+    return session
+
+http_session = LazyResource(_create_http_session)
+
+def _parse_max_age(cache_control):
+    """Cache-Control ヘッダーから max-age (秒) を取り出す。無ければ None"""
+    match = re.search(r'max-age=(\d+)', cache_control or '')
+    return int(match.group(1)) if match else None
+
+class GoogleCertStore:
+    """ID トークン検証用の証明書をプロセス内に保持するストア
+
+    Cache-Control の max-age に従って有効期限を管理し、失効が近づくとバックグラウンドで再取得する。
+    これにより通常のトークン検証はネットワークを介さないローカルな CPU 処理だけで完結する。
+    """
+
+    def __init__(self, certs_url=GOOGLE_CERTS_URL, session=None,
+                 refresh_ahead_seconds=CERT_REFRESH_AHEAD_SECONDS,
+                 default_max_age_seconds=CERT_DEFAULT_MAX_AGE_SECONDS):
+        self.certs_url = certs_url
+        self._session = session
+        self.refresh_ahead_seconds = refresh_ahead_seconds
+        self.default_max_age_seconds = default_max_age_seconds
+        self._certs = None
+        self._expires_at = 0.0
+        self._refresh_at = 0.0 # この時刻を過ぎたらバックグラウンドで再取得する
+        self._last_fetch_at = 0.0
+        self._lock = threading.Lock() # 同期取得を 1 本に絞るためのロック
+        self._refresh_flag_lock = threading.Lock()
+        self._refreshing = False
+        self.fetch_count = 0
+
+    @property
+    def session(self):
+        return self._session or http_session.get()
+
+    def _fetch(self):
+        """証明書エンドポイントから証明書を取得してストアを更新する"""
+        response = self.session.get(self.certs_url, timeout=CERT_FETCH_TIMEOUT)
+        response.raise_for_status()
+        certs = response.json()
+        if not isinstance(certs, dict) or not certs:
+            raise ConnectionError(f"Unexpected certificate response from {self.certs_url}")
+        max_age = _parse_max_age(response.headers.get('Cache-Control'))
+        if max_age is None:
+            max_age = self.default_max_age_seconds
+        now = time.time()
+        self._certs = certs
+        self._expires_at = now + max_age
+        # max-age が短い場合に再取得の直後から先読みが続かないよう、先読みの幅は有効期間の半分までに抑える
+        self._refresh_at = self._expires_at - min(self.refresh_ahead_seconds, max_age / 2)
+        self._last_fetch_at = now
+        self.fetch_count += 1
+        print(f"Fetched {len(certs)} Google signing certs (max-age={max_age}s)")
+        return certs
+
+    def _refresh_in_background(self):
+        """失効前にバックグラウンドスレッドで証明書を再取得する (同時に 1 本まで)"""
+        with self._refresh_flag_lock:
+            if self._refreshing:
+                return
+            if time.time() - self._last_fetch_at < CERT_MIN_FORCED_REFRESH_INTERVAL_SECONDS:
+                return
+            self._refreshing = True
+
+        def _worker():
+            try:
+                with self._lock:
+                    self._fetch()
+            except Exception as e:
+                # 取得に失敗しても既存の証明書は失効まで使い続ける
+                print(f"Background cert refresh failed: {e}")
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=_worker, name='google-cert-refresh', daemon=True).start()
+
+    def get_certs(self):
+        """有効な証明書 (kid -> PEM) を返す。失効済みなら同期的に取得する"""
+        now = time.time()
+        certs = self._certs
+        if certs is not None and now < self._expires_at:
+            if now >= self._refresh_at:
+                self._refresh_in_background()
+            return certs
+        with self._lock:
+            # ロック待ちの間に他のスレッドが取得済みならそれを使う
+            if self._certs is not None and time.time() < self._expires_at:
+                return self._certs
+            return self._fetch()
+
+    def refresh_for_unknown_kid(self, kid):
+        """未知の kid を持つトークンを受け取った場合に証明書を強制再取得する (鍵ローテーション対応)"""
+        with self._lock:
+            if self._certs is not None and kid in self._certs:
+                return self._certs
+            if time.time() - self._last_fetch_at < CERT_MIN_FORCED_REFRESH_INTERVAL_SECONDS:
+                return self._certs or {}
+            return self._fetch()
+
+    def stats(self):
+        return {
+            'certs': len(self._certs or {}),
+            'expires_in_seconds': max(0.0, self._expires_at - time.time()),
+            'fetch_count': self.fetch_count,
+        }
+
+# テストではこの変数をローカルのダミーエンドポイントを指すストアに差し替えられる
+cert_store = GoogleCertStore()
+
 # --- 認証ヘルパー関数 ---
-def verify_id_token(auth_header):
-    """Authorization ヘッダーから ID トークンを検証し、ユーザー情報を返す"""
+def _load_google_jwt():
+    from google.auth import jwt
+    return jwt
+
+# google.auth (と依存する cryptography) の読み込みは重いため、初回のトークン検証まで遅らせる
+google_jwt_module = LazyResource(_load_google_jwt)
+
+def decode_google_id_token(token, audience):
+    """ローカルに保持した証明書で ID トークンの署名・有効期限・audience・issuer を検証する"""
+    google_jwt = google_jwt_module.get()
+    certs = cert_store.get_certs()
+    kid = google_jwt.decode_header(token).get('kid')
+    if kid and kid not in certs:
+        certs = cert_store.refresh_for_unknown_kid(kid)
+    idinfo = google_jwt.decode(token, certs=certs, audience=audience)
+    if idinfo.get('iss') not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer. 'iss' should be one of {GOOGLE_ISSUERS} but got {idinfo.get('iss')}")
+    return idinfo
+
+def parse_bearer_token(auth_header):
+    """Authorization ヘッダーから ID トークンの文字列を取り出す"""
     if not auth_header or not auth_header.startswith('Bearer '):
         raise ValueError("Invalid Authorization header: Missing or invalid format.")
 
@@ -35,23 +383,35 @@ def verify_id_token(auth_header):
 
     if not GOOGLE_CLIENT_ID:
          raise ConnectionError("Server configuration error: Google Client ID is not set.")
+    return token
+
+def verify_id_token(auth_header):
+    """Authorization ヘッダーから ID トークンを検証し、ユーザー情報を返す"""
+    token = parse_bearer_token(auth_header)
+
+    # 同じトークンで繰り返し呼ばれる場合は署名検証・証明書取得を省略する
+    cached_idinfo = token_cache.get(token)
+    if cached_idinfo is not None:
+        return cached_idinfo
+    return verify_uncached_token(token)
 
+def verify_uncached_token(token):
+    """キャッシュにない ID トークンを検証し、検証済みトークンキャッシュに登録する (証明書の取得で通信することがある)"""
     try:
         # ID トークンを検証
         # audience には、この Functions を呼び出すクライアント (Streamlit アプリ) の OAuth クライアントID を指定
         # これにより、意図しないクライアントからの呼び出しを防ぐ
-        idinfo = id_token.verify_oauth2_token(
+        # 証明書は cert_store がキャッシュしているため、通常はネットワーク通信なしで検証が完了する
+        idinfo = decode_google_id_token(
             token,
-            google_requests.Request(),
             GOOGLE_CLIENT_ID # 環境変数から取得したクライアントID
         )
-        # ここで特定の issuer や hosted domain (hd) のチェックを追加することも可能
-        # 例: if idinfo['iss'] not in ['accounts.google.com', 'https://accounts.google.com']:
-        #       raise ValueError('Wrong issuer.')
+        # ここで特定の hosted domain (hd) のチェックを追加することも可能 (issuer は decode_google_id_token でチェック済み)
         # 例: if 'hd' not in idinfo or idinfo['hd'] != 'your-domain.com':
         #       raise ValueError('Unauthorized domain.')
 
         print(f"ID token successfully verified for user: {idinfo.get('email')}")
+        token_cache.put(token, idinfo)
         return idinfo # 検証済みのユーザー情報 (email, name, sub などを含む辞書)
 
     except ValueError as e:
@@ -63,121 +423,1405 @@ def verify_id_token(auth_header):
         raise ConnectionError(f"Token verification internal error: {e}") # 500 Internal Server Error が適切か
 
 
-# --- Firestore 操作関数 ---
-def get_messages_from_db(room_id, limit=50):
-    """Firestore からメッセージを取得"""
-    messages = []
-    messages_ref = db.collection("chat_rooms").document(room_id).collection("messages")
-    messages_stream = messages_ref.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(limit).stream()
-    for msg_doc in messages_stream:
-        msg_data = msg_doc.to_dict()
-        # Firestore の Timestamp を ISO 形式文字列に変換して JSON で返しやすくする
-        if 'timestamp' in msg_data and isinstance(msg_data['timestamp'], datetime.datetime):
-             # Firestore から取得したタイムスタンプは UTC であると想定
-             # naive な場合、UTC を付与
-             if msg_data['timestamp'].tzinfo is None:
-                 msg_data['timestamp'] = pytz.utc.localize(msg_data['timestamp'])
-             # ISO形式に変換
-             msg_data['timestamp'] = msg_data['timestamp'].isoformat()
-        messages.append(msg_data)
-    messages.reverse() # 古い順に戻す
-    return messages
+# --- メッセージカーソル ---
+# カーソルは "ISO形式タイムスタンプ|ドキュメントID" の文字列。
+# 同一タイムスタンプのメッセージがあっても ドキュメントID で順序が一意に決まる
+def encode_cursor(timestamp, doc_id):
+    """メッセージのタイムスタンプ (UTC の datetime) と ID からカーソル文字列を作る"""
+    return f"{timestamp.isoformat()}|{doc_id}"
+
+def decode_cursor(cursor):
+    """カーソル文字列を (UTC の datetime, ドキュメントID) に分解する"""
+    try:
+        timestamp_iso, doc_id = cursor.split('|', 1)
+        timestamp = datetime.datetime.fromisoformat(timestamp_iso)
+    except (AttributeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    if not doc_id or '/' in doc_id:
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp, doc_id
+
+def parse_page_size(value, default=MESSAGES_PAGE_SIZE, maximum=MESSAGES_MAX_PAGE_SIZE):
+    """クライアントが指定したページサイズを検証し、サーバー側の上限で切り詰める"""
+    if value is None:
+        return default
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError("Invalid 'limit' parameter: must be a positive integer")
+    return min(value, maximum)
+
+def message_cursor(msg_data):
+    """get_messages_from_db が返したメッセージ (timestamp は UTC の datetime) からカーソルを作る"""
+    return encode_cursor(msg_data['timestamp'], msg_data['id'])
+
+def message_sort_key(msg_data):
+    """メッセージの並び順のキー (decode_cursor の戻り値と比較できる)"""
+    return msg_data['timestamp'], msg_data['id']
+
+# --- ルームメッセージキャッシュ ---
+class RoomMessageCache:
+    """ルームごとの最新メッセージをインスタンス内に保持するスレッドセーフな LRU キャッシュ
+
+    エントリは短い TTL で失効し、他のインスタンスからの書き込みもその時間内に反映される。
+    全エントリの推定メモリ使用量が上限を超えると、最も古く使われたルームから追い出す。
+    """
+
+    def __init__(self, ttl_seconds=ROOM_CACHE_TTL_SECONDS, max_bytes=ROOM_CACHE_MAX_BYTES,
+                 max_messages_per_room=ROOM_CACHE_MAX_MESSAGES):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.max_messages_per_room = max_messages_per_room
+        # room_id -> {'messages', 'keys', 'complete', 'fetched_at', 'fetched_through', 'bytes'}
+        # keys は messages と同じ順序の (UTC datetime, ID) で、カーソルとの比較に使う
+        # fetched_through は保存先から読み切った最新メッセージのカーソル。ライトスルーで追加したメッセージでは進めない
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _estimate_bytes(msg):
+        """メッセージ 1 件のおおよそのメモリ使用量 (dict のオーバーヘッド + 文字列長)"""
+        return 240 + sum(len(key) + len(str(value)) for key, value in msg.items())
+
+    @staticmethod
+    def _sort_key(msg):
+        return message_sort_key(msg)
+
+    def _set_entry(self, room_id, messages, keys, complete, fetched_at, fetched_through):
+        """エントリを登録・更新し、件数上限とメモリ上限を適用する (ロック取得済みで呼ぶ)"""
+        if len(messages) > self.max_messages_per_room:
+            messages = messages[-self.max_messages_per_room:]
+            keys = keys[-self.max_messages_per_room:]
+            complete = False
+        old_entry = self._entries.pop(room_id, None)
+        if old_entry is not None:
+            self.total_bytes -= old_entry['bytes']
+        entry_bytes = sum(self._estimate_bytes(msg) for msg in messages)
+        self._entries[room_id] = {
+            'messages': messages,
+            'keys': keys,
+            'complete': complete,
+            'fetched_at': fetched_at,
+            'fetched_through': fetched_through,
+            'bytes': entry_bytes,
+        }
+        self.total_bytes += entry_bytes
+        while self.total_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= evicted['bytes']
+            self.evictions += 1
+
+    def lookup(self, room_id, limit, since=None):
+        """有効なエントリから応答できればメッセージのリストを返す。できなければ None (統計には数えない)"""
+        with self._lock:
+            entry = self._entries.get(room_id)
+            if entry is None or time.time() - entry['fetched_at'] > self.ttl_seconds:
+                return None
+            keys = entry['keys']
+            if since:
+                since_key = decode_cursor(since)
+                # キャッシュの範囲より古いカーソルは、全履歴を保持している場合のみ応答できる
+                if not entry['complete'] and (not keys or since_key < keys[0]):
+                    return None
+                start = bisect.bisect_right(keys, since_key)
+                selected = entry['messages'][start:start + limit]
+            else:
+                if len(keys) < limit and not entry['complete']:
+                    return None
+                selected = entry['messages'][-limit:] if keys else []
+            self._entries.move_to_end(room_id)
+            return [dict(msg) for msg in selected]
+
+    def get(self, room_id, limit, since=None):
+        """lookup と同じだが、ヒット/ミスを統計に記録する"""
+        result = self.lookup(room_id, limit, since)
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
 
-def send_message_to_db(room_id, sender_email, receiver_email, content):
-    """Firestore にメッセージを保存"""
+    def fetched_through(self, room_id):
+        """(TTL 切れでも) エントリが保存先から読み切った最新メッセージのカーソル。差分更新に使う
+
+        ライトスルーで追加したメッセージより前に他インスタンスが書き込んだメッセージを取りこぼさないよう、
+        キャッシュ内の最新メッセージではなく、最後に保存先から読んだ位置を返す。
+        """
+        with self._lock:
+            entry = self._entries.get(room_id)
+            if entry is None:
+                return None
+            return entry['fetched_through']
+
+    def fresh_version(self, room_id):
+        """TTL 内のエントリがあれば、ルームのバージョン (最新メッセージのカーソル。空なら '') を返す。無ければ None"""
+        with self._lock:
+            entry = self._entries.get(room_id)
+            if entry is None or time.time() - entry['fetched_at'] > self.ttl_seconds:
+                return None
+            return message_cursor(entry['messages'][-1]) if entry['messages'] else ''
+
+    def store(self, room_id, messages, complete):
+        """Firestore から取得した最新ページ (古い順) でエントリを作り直す"""
+        keys = [self._sort_key(msg) for msg in messages]
+        fetched_through = message_cursor(messages[-1]) if messages else None
+        with self._lock:
+            self._set_entry(room_id, [dict(msg) for msg in messages], keys, complete, time.time(), fetched_through)
+
+    def refresh(self, room_id, new_messages):
+        """TTL 切れのエントリに差分を追加して有効期限を延長する。エントリが無ければ False"""
+        with self._lock:
+            entry = self._entries.get(room_id)
+            if entry is None:
+                return False
+            messages = list(entry['messages'])
+            keys = list(entry['keys'])
+            fetched_through = entry['fetched_through']
+            for msg in new_messages:
+                self._insert(messages, keys, dict(msg))
+            if new_messages:
+                fetched_through = message_cursor(max(new_messages, key=self._sort_key))
+            self._set_entry(room_id, messages, keys, entry['complete'], time.time(), fetched_through)
+            self.refreshes += 1
+            return True
+
+    def _insert(self, messages, keys, msg):
+        key = self._sort_key(msg)
+        index = bisect.bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            return # 同じメッセージは追加しない
+        keys.insert(index, key)
+        messages.insert(index, msg)
+
+    def append(self, room_id, msg):
+        """書き込んだメッセージを既存エントリに追加する (ライトスルー)。エントリが無ければ何もしない"""
+        with self._lock:
+            entry = self._entries.get(room_id)
+            if entry is None:
+                return
+            messages = list(entry['messages'])
+            keys = list(entry['keys'])
+            self._insert(messages, keys, dict(msg))
+            # 有効期限も fetched_through も進めない (TTL 切れ後の差分更新で、この間の他インスタンスの書き込みを読むため)
+            self._set_entry(room_id, messages, keys, entry['complete'], entry['fetched_at'], entry['fetched_through'])
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """ヒット率とメモリ使用量を返す"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'rooms': len(self._entries),
+                'messages': sum(len(entry['messages']) for entry in self._entries.values()),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': (self.hits / total) if total else 0.0,
+                'refreshes': self.refreshes,
+                'evictions': self.evictions,
+            }
+
+room_cache = RoomMessageCache()
+
+# --- 送信の重複排除 ---
+class SentMessageDedup:
+    """冪等キー付きで保存したメッセージを一定期間覚えておくスレッドセーフな LRU
+
+    同じキーでの再送 (タイムアウト後のリトライなど) は保存先に問い合わせずにここで検出する。
+    別インスタンスへの再送や期間外の再送は、保存先の「存在しなければ作成」で検出される。
+    """
+
+    def __init__(self, window_seconds=SEND_DEDUP_WINDOW_SECONDS, max_entries=SEND_DEDUP_MAX_ENTRIES):
+        self.window_seconds = window_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # (room_id, message_id) -> (expires_at, 保存したメッセージ)
+        self._lock = threading.Lock()
+        self.duplicates = 0
+
+    def get(self, room_id, message_id):
+        """保存済みのメッセージを返す。未登録または期間外なら None"""
+        key = (room_id, message_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                return None
+            self.duplicates += 1
+            return dict(entry[1])
+
+    def put(self, room_id, message):
+        if self.max_entries <= 0:
+            return
+        key = (room_id, message['id'])
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.window_seconds, dict(message))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.duplicates = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'duplicates': self.duplicates,
+            }
+
+sent_dedup = SentMessageDedup()
+
+# --- 流量制御 (ユーザーごとのレート制限と、インスタンス全体の負荷制限) ---
+class TokenBucketLimiter:
+    """キー (検証済みのメールアドレス) ごとのトークンバケット
+
+    トークンは rate_per_second の速さで burst まで貯まり、リクエストごとに cost を消費する。
+    補充は参照時にまとめて計算するため、1 回の判定はロック 1 回と数回の演算で済む。
+    追跡するキーの数は max_keys までで、超えたら最も古く使われたキーを忘れる (満タン扱いに戻る)。
+    """
+
+    def __init__(self, rate_per_second, burst, max_keys=RATE_LIMIT_MAX_USERS):
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict() # key -> [残りトークン, 最後に補充した時刻 (time.monotonic)]
+        self._lock = threading.Lock()
+        self.allowed = 0
+        self.rejected = 0
+
+    def acquire(self, key, cost=1):
+        """cost 分のトークンを消費できれば 0.0、できなければ再試行までの待ち時間 (秒) を返す"""
+        cost = min(cost, self.burst) # バケットの上限を超える要求も、満タンになれば通す
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [self.burst, now]
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate_per_second)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.allowed += 1
+                return 0.0
+            self.rejected += 1
+            return (cost - bucket[0]) / self.rate_per_second
+
+    def refund(self, key, cost=1):
+        """acquire で消費したトークンを戻す (他の予算で拒否されたリクエストの分)"""
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + min(cost, self.burst))
+
+    def stats(self):
+        with self._lock:
+            return {
+                'users': len(self._buckets),
+                'rate_per_second': self.rate_per_second,
+                'burst': self.burst,
+                'allowed': self.allowed,
+                'rejected': self.rejected,
+            }
+
+class LoadShedder:
+    """インスタンス全体の同時処理数を制限し、平均レイテンシが目標を超えている間は上限を絞る
+
+    レイテンシは完了したリクエストの指数移動平均で追跡する。上限を超えたリクエストは
+    認証や保存先へのアクセスを行う前に断るため、混雑時にも処理中のリクエストの遅延を悪化させない。
+    """
+
+    def __init__(self, max_concurrent=SHED_MAX_CONCURRENT, degraded_concurrent=SHED_DEGRADED_CONCURRENT,
+                 latency_target_ms=SHED_LATENCY_TARGET_MS, ewma_alpha=0.2):
+        self.max_concurrent = max_concurrent
+        self.degraded_concurrent = degraded_concurrent
+        self.latency_target_ms = latency_target_ms
+        self.ewma_alpha = ewma_alpha
+        self.in_flight = 0
+        self.latency_ewma_ms = 0.0
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def try_enter(self):
+        """処理を開始してよければ True (その場合は必ず exit() を呼ぶ)"""
+        with self._lock:
+            limit = self.max_concurrent if self.latency_ewma_ms <= self.latency_target_ms else self.degraded_concurrent
+            if self.in_flight >= limit:
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            return True
+
+    def exit(self, latency_ms):
+        with self._lock:
+            self.in_flight -= 1
+            self.latency_ewma_ms += self.ewma_alpha * (latency_ms - self.latency_ewma_ms)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'in_flight': self.in_flight,
+                'latency_ewma_ms': round(self.latency_ewma_ms, 2),
+                'degraded': self.latency_ewma_ms > self.latency_target_ms,
+                'shed': self.shed,
+            }
+
+read_limiter = TokenBucketLimiter(RATE_LIMIT_READ_PER_SECOND, RATE_LIMIT_READ_BURST)
+write_limiter = TokenBucketLimiter(RATE_LIMIT_WRITE_PER_SECOND, RATE_LIMIT_WRITE_BURST)
+load_shedder = LoadShedder()
+# ストリームは長時間開いたままになるため、通常のリクエストとは別の枠で数える
+# (接続時間でレイテンシの平均を押し上げないよう、上限は絞らない)
+stream_shedder = LoadShedder(max_concurrent=STREAM_MAX_CONCURRENT, degraded_concurrent=STREAM_MAX_CONCURRENT,
+                             latency_target_ms=math.inf)
+
+# 書き込みの予算を消費するアクション (それ以外は読み込み)
+WRITE_ACTIONS = {'send_message', 'mark_room_read'}
+
+def request_costs(action, req_data):
+    """リクエストが消費する (読み込み, 書き込み) のトークン数。batch はサブアクションごとに数える"""
+    if action == 'batch':
+        items = req_data.get('requests')
+        if not isinstance(items, list) or not items:
+            return 1, 0
+        writes = sum(1 for item in items if isinstance(item, dict) and item.get('action') in WRITE_ACTIONS)
+        return len(items) - writes, writes
+    return (0, 1) if action in WRITE_ACTIONS else (1, 0)
+
+def admit_request(user_email, action, req_data):
+    """ユーザーのレート制限を確認し、超えていれば再試行までの待ち時間 (秒)、通せば 0.0 を返す"""
+    if not RATE_LIMIT_ENABLED:
+        return 0.0
+    key = user_email.lower()
+    reads, writes = request_costs(action, req_data)
+    if reads:
+        retry_after = read_limiter.acquire(key, reads)
+        if retry_after:
+            return retry_after
+    if writes:
+        retry_after = write_limiter.acquire(key, writes)
+        if retry_after:
+            if reads:
+                read_limiter.refund(key, reads)
+            return retry_after
+    return 0.0
+
+def rate_limited_response(retry_after):
+    """429 Too Many Requests (Retry-After は秒の整数に切り上げる)"""
+    response = jsonify({"error": "Too many requests", "retry_after": round(retry_after, 3)})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def overloaded_response():
+    """503 Service Unavailable (インスタンスが混雑している。クライアントは少し待って再試行する)"""
+    response = jsonify({"error": "Server is overloaded, please retry"})
+    response.status_code = 503
+    response.headers['Retry-After'] = '1'
+    return response
+
+# --- 保存先の操作関数 ---
+def get_messages_from_db(room_id, limit=50, since=None, before=None):
+    """保存先からメッセージを取得 (古い順)
+
+    since (カーソル) を指定した場合は、そのメッセージより新しいものだけを古い順に最大 limit 件返す。
+    before (カーソル) を指定した場合は、そのメッセージより古いものを新しい側から最大 limit 件返す。
+    """
+    if since and before:
+        raise ValueError("'since' and 'before' cannot be specified together")
+    since_position = decode_cursor(since) if since else None
+    before_position = decode_cursor(before) if before else None
+    with request_phase('db'):
+        return storage.get_messages(room_id, limit, since=since_position, before=before_position)
+
+def watch_messages_in_db(room_id, since, callback):
+    """since (カーソル) より新しいメッセージを監視する (Firestore ではスナップショットリスナー)
+
+    追加されたメッセージのリスト (古い順) を引数に callback が呼ばれる (リスナーのスレッドから呼ばれる点に注意)。
+    戻り値の関数を呼ぶと監視を停止する。
+    """
+    return storage.watch_messages(room_id, decode_cursor(since) if since else None, callback)
+
+def _check_duplicate_sender(message, sender_email):
+    """冪等キーが衝突したメッセージが同じ送信者のものか確認する (他人のメッセージ ID を使った再送は拒否)"""
+    if (message.get('sender_email') or '').lower() != sender_email.lower():
+        raise ValueError("Forbidden: message_id is already used by another sender")
+
+def send_message_to_db(room_id, sender_email, receiver_email, content, message_id=None, batch=None):
+    """メッセージを保存し、ルームのサマリーを同じバッチで更新する
+
+    message_id (クライアントが生成した冪等キー) を指定した場合は、そのIDのドキュメントを「存在しなければ作成」する。
+    同じIDでの再送は書き込まずに最初に保存したメッセージを返す (戻り値の 'duplicate' が True)。
+    batch (storage.batch() の戻り値) を渡した場合は書き込みをバッチに追加するだけで、コミットは呼び出し側で行う。
+    """
     if not all([room_id, sender_email, receiver_email, content]):
         raise ValueError("Missing required message data.")
-    messages_ref = db.collection("chat_rooms").document(room_id).collection("messages")
-    new_msg_ref = messages_ref.document()
+    if message_id:
+        duplicate = sent_dedup.get(room_id, message_id)
+        if duplicate is not None:
+            _check_duplicate_sender(duplicate, sender_email)
+            return {**duplicate, 'duplicate': True}
     # 保存するデータ。sender_email は検証済みトークンの email を使う
     data_to_send = {
         'sender_email': sender_email, # トークンから取得したメールアドレス
         'receiver_email': receiver_email, # リクエストから取得
         'content': content, # リクエストから取得
-        'timestamp': datetime.datetime.now(pytz.utc) # UTCで保存
+        'timestamp': datetime.datetime.now(datetime.timezone.utc) # UTCで保存
     }
-    new_msg_ref.set(data_to_send)
+    # 戻り値は get_messages_from_db と同じ形式の保存したメッセージ (キャッシュへの書き込みに使う)
+    # メッセージとサマリーは同じバッチでコミットされるので、再送でメッセージの作成が失敗すればサマリーも更新されない
+    write_batch = batch if batch is not None else storage.batch()
+    # 検索の索引語もメッセージと同じバッチで書き込む (索引の更新はメッセージ 1 件分だけで済む)
+    message_id = write_batch.add_message(room_id, data_to_send, message_id=message_id,
+                                         search_terms=search_index.index_terms(content))
+    saved_message = {**data_to_send, 'id': message_id}
+    if batch is not None:
+        return saved_message
+    try:
+        with request_phase('db'):
+            write_batch.commit()
+    except MessageAlreadyExists:
+        # 別インスタンスで処理済み、または重複排除の期間外の再送
+        with request_phase('db'):
+            existing = storage.get_message(room_id, message_id)
+        return accept_existing_message(room_id, existing, sender_email)
+    record_sent_message(room_id, saved_message, message_id)
     print(f"Message saved to room {room_id} by {sender_email}")
-    return True
+    return saved_message
+
+def accept_existing_message(room_id, existing, sender_email):
+    """冪等キーが衝突した保存済みのメッセージを、同じ送信者の再送として重複扱いで返す"""
+    _check_duplicate_sender(existing, sender_email)
+    sent_dedup.put(room_id, existing)
+    print(f"Duplicate message {existing['id']} ignored in room {room_id}")
+    return {**existing, 'duplicate': True}
+
+def record_sent_message(room_id, saved_message, message_id=None):
+    """コミットしたメッセージを重複排除とルームキャッシュに反映する"""
+    if message_id:
+        sent_dedup.put(room_id, saved_message)
+    room_cache.append(room_id, saved_message) # ライトスルー
+
+class SearchScan:
+    """search_messages の 1 リクエスト分の走査の状態
+
+    索引から最も絞り込める語 (lookup_term) の候補を新しい順にページ単位で読み、検索語のすべての索引語を
+    含むものをヒットとして集める。limit 件のヒットが集まるか、候補を SEARCH_MAX_SCANNED 件読んだら止め、
+    続きは最後に読んだ候補の位置 (next_cursor) から再開する。保存先の呼び出しは持たないので、
+    WSGI 版と ASGI 版で共有できる。
+    """
+
+    def __init__(self, query, limit, before=None):
+        self.terms = search_index.query_terms(query)
+        if not self.terms:
+            raise ValueError("Invalid 'query' parameter: no searchable words")
+        self.normalized_query = search_index.normalize(query).strip()
+        self.lookup_term = search_index.most_selective_term(self.terms)
+        self.limit = limit
+        self.position = decode_cursor(before) if before else None
+        self.hits = [] # (メッセージ, スコア) (新しい順)
+        self.scanned = 0
+        self.exhausted = False
+
+    def next_page_size(self):
+        """次に索引から読む候補の件数 (0 なら走査を終える)"""
+        if self.exhausted or len(self.hits) >= self.limit:
+            return 0
+        return min(SEARCH_SCAN_PAGE_SIZE, SEARCH_MAX_SCANNED - self.scanned)
+
+    def feed(self, candidates, page_size):
+        """索引から読んだ候補 (新しい順) を採点し、ヒットを集める"""
+        for index, message in enumerate(candidates):
+            self.scanned += 1
+            self.position = message_sort_key(message)
+            score = search_index.score_message(message.get('content'), self.terms, self.normalized_query)
+            if score is not None:
+                self.hits.append((message, score))
+                if len(self.hits) >= self.limit:
+                    # 最後の候補まで読み、かつページが埋まっていなければ、続きはない
+                    self.exhausted = index == len(candidates) - 1 and len(candidates) < page_size
+                    return
+        if len(candidates) < page_size:
+            self.exhausted = True
+
+    def body(self):
+        """search_messages のレスポンス辞書 (ヒットはスコアの高い順、同点なら新しい順)"""
+        ranked = sorted(self.hits, key=lambda hit: (hit[1], message_sort_key(hit[0])), reverse=True)
+        has_more = not self.exhausted and self.position is not None
+        return {
+            "hits": [
+                {"message": message, "score": score, "cursor": message_cursor(message)} for message, score in ranked
+            ],
+            # さらに古いメッセージを検索する際に before に渡すカーソル (読んだ最後の候補の位置)
+            "next_cursor": encode_cursor(*self.position) if has_more else None,
+            "has_more": has_more,
+            "scanned": self.scanned,
+        }
+
+def search_messages_in_db(room_id, query, limit, before=None):
+    """ルームのメッセージを検索し、search_messages のレスポンス辞書を返す
+
+    読むのは索引の候補だけで、ルームの履歴全体は走査しない (1 リクエストで最大 SEARCH_MAX_SCANNED 件)。
+    """
+    scan = SearchScan(query, limit, before)
+    while True:
+        page_size = scan.next_page_size()
+        if not page_size:
+            return scan.body()
+        with request_phase('db'):
+            candidates = storage.search_messages(room_id, scan.lookup_term, page_size, before=scan.position)
+        scan.feed(candidates, page_size)
+
+def room_for_user(summary, user_email):
+    """保存先のルームのサマリーを、list_rooms で user_email に返すルーム辞書に変換"""
+    my_email = user_email.lower()
+    return {
+        'room_id': summary['room_id'],
+        'partner_email': next((email for email in summary['participants'] if email != my_email), my_email),
+        'last_message': summary['last_message'],
+        'message_count': summary['message_count'],
+        'unread_count': summary['unread_counts'].get(my_email, 0),
+    }
+
+def list_rooms_from_db(user_email, limit=ROOMS_PAGE_SIZE):
+    """user_email が参加しているルームのサマリーを、最新メッセージの新しい順に取得
+
+    サマリーへの 1 回のクエリで済む (Firestore では participants + updated_at の複合インデックスが必要)。
+    """
+    with request_phase('db'):
+        summaries = storage.list_rooms(user_email, limit)
+    return [room_for_user(summary, user_email) for summary in summaries]
+
+def mark_room_read_in_db(room_id, user_email):
+    """ルームのサマリーで user_email の未読数を 0 にする (まだメッセージがないルームでは何もしない)"""
+    with request_phase('db'):
+        storage.mark_room_read(room_id, user_email)
+
+def get_messages_cached(room_id, limit=50, since=None, before=None):
+    """インスタンス内のルームキャッシュを優先してメッセージを取得 (引数と戻り値は get_messages_from_db と同じ)
+
+    キャッシュが TTL 切れの場合は、前回保存先から読んだ位置 (fetched_through) 以降の差分だけを読んで更新する。
+    過去ページ (before) はキャッシュしない。
+    """
+    if before:
+        return get_messages_from_db(room_id, limit=limit, before=before)
+    cached = room_cache.get(room_id, limit, since)
+    if cached is not None:
+        return cached
+
+    fetched_through = room_cache.fetched_through(room_id)
+    if fetched_through:
+        delta = get_messages_from_db(room_id, limit=ROOM_CACHE_MAX_MESSAGES, since=fetched_through)
+        # 差分が多すぎる場合はキャッシュを作り直す
+        if len(delta) < ROOM_CACHE_MAX_MESSAGES and room_cache.refresh(room_id, delta):
+            cached = room_cache.lookup(room_id, limit, since)
+            if cached is not None:
+                return cached
+
+    if since:
+        return get_messages_from_db(room_id, limit=limit, since=since)
+    messages = get_messages_from_db(room_id, limit=limit)
+    # limit 件に満たなければ、それがルームの全履歴
+    room_cache.store(room_id, messages, complete=len(messages) < limit)
+    return messages
+
+# --- エラー処理ヘルパー ---
+def error_response_for_exception(e):
+    """処理中に発生した例外を (レスポンス辞書, ステータスコード) に変換する"""
+    if isinstance(e, ValueError): # 認証エラー(401/403)やパラメータ不足(400)
+        error_message = str(e)
+        status_code = 400
+        if "token" in error_message.lower() or "authorization" in error_message.lower():
+            status_code = 401 # Unauthorized
+        elif "forbidden" in error_message.lower():
+            status_code = 403 # Forbidden
+        print(f"Client Error ({status_code}): {error_message}")
+        return {"error": error_message}, status_code
+    if isinstance(e, ConnectionError): # サーバー内部の接続や設定エラー
+        print(f"Server Configuration/Connection Error: {e}")
+        return {"error": f"Server configuration error: {e}"}, 500
+    # その他の予期せぬエラー
+    print(f"An internal server error occurred: {''.join(traceback.format_exception(type(e), e, e.__traceback__))}")
+    return {"error": "An internal server error occurred."}, 500
+
+# --- アクション処理 ---
+# 各アクションは (レスポンス辞書, ステータスコード) を返す。
+# パラメータ不正は ValueError で通知する ("Forbidden" を含むメッセージは 403、それ以外は 400 になる)
+def require_room_member(user_email, room_id):
+    """room_id が指定され、かつ user_email がそのルームの参加者であることを確認する"""
+    if not room_id:
+        raise ValueError("Missing 'room_id' parameter")
+    # room_id は参加者のメールアドレスを "_" で結合したもの
+    if user_email.lower() not in room_id.lower().split('_'):
+         raise ValueError("Forbidden: You are not part of this chat room")
+
+def parse_get_messages(user_email, req_data):
+    """get_messages のパラメータを検証し、(room_id, limit, since, before) を返す"""
+    room_id = req_data.get('room_id')
+    require_room_member(user_email, room_id)
+
+    # since が指定されていれば、そのカーソル以降の差分だけを返す
+    # before が指定されていれば、そのカーソルより古いページを返す (過去ログの遡り)
+    since = req_data.get('since')
+    before = req_data.get('before')
+    if since is not None and not isinstance(since, str):
+        raise ValueError("Invalid 'since' parameter")
+    if before is not None and not isinstance(before, str):
+        raise ValueError("Invalid 'before' parameter")
+    if since and before:
+        raise ValueError("'since' and 'before' cannot be specified together")
+    limit = parse_page_size(req_data.get('limit'))
+    return room_id, limit, since, before
+
+def messages_page_body(messages, limit, since, before):
+    """get_messages のレスポンス辞書 (メッセージと、続きを取得するためのカーソル)"""
+    return {
+        "messages": messages,
+        # 次回のポーリングで since に渡すカーソル (新着がなければ受け取ったカーソルをそのまま返す)
+        "cursor": message_cursor(messages[-1]) if messages else since,
+        # さらに古いページを取得する際に before に渡すカーソル
+        "older_cursor": message_cursor(messages[0]) if messages else before,
+        # 差分取得で limit 件ちょうど返った場合は、まだ新着が残っている可能性がある
+        "has_more": bool(since) and len(messages) >= limit,
+        # 最新ページ / 過去ページで limit 件ちょうど返った場合は、さらに古いメッセージがある可能性がある
+        "has_older": not since and len(messages) >= limit,
+    }
+
+def action_get_messages(user_email, req_data):
+    """get_messages: ルームのメッセージを取得"""
+    room_id, limit, since, before = parse_get_messages(user_email, req_data)
+    messages = get_messages_cached(room_id, limit=limit, since=since, before=before)
+    return messages_page_body(messages, limit, since, before), 200
+
+def parse_search_messages(user_email, req_data):
+    """search_messages のパラメータを検証し、(room_id, query, limit, before) を返す"""
+    room_id = req_data.get('room_id')
+    require_room_member(user_email, room_id)
+    query = req_data.get('query')
+    if not isinstance(query, str) or not query.strip():
+        raise ValueError("Missing 'query' parameter")
+    if len(query) > SEARCH_QUERY_MAX_CHARS:
+        raise ValueError(f"Invalid 'query' parameter: must be at most {SEARCH_QUERY_MAX_CHARS} characters")
+    before = req_data.get('before')
+    if before is not None and not isinstance(before, str):
+        raise ValueError("Invalid 'before' parameter")
+    limit = parse_page_size(req_data.get('limit'), default=SEARCH_PAGE_SIZE, maximum=SEARCH_MAX_PAGE_SIZE)
+    return room_id, query, limit, before
+
+def action_search_messages(user_email, req_data):
+    """search_messages: ルームのメッセージを全文検索し、スコアの高い順に返す"""
+    room_id, query, limit, before = parse_search_messages(user_email, req_data)
+    return search_messages_in_db(room_id, query, limit, before=before), 200
+
+def validate_send_message(user_email, req_data):
+    """send_message のパラメータを検証し、send_message_to_db に渡す引数を返す"""
+    room_id = req_data.get('room_id')
+    receiver_email = req_data.get('receiver_email')
+    content = req_data.get('content')
+    message_id = req_data.get('message_id') # 任意。指定された場合は冪等キーとして使う
+    if not all([room_id, receiver_email, content]):
+        raise ValueError("Missing 'room_id', 'receiver_email', or 'content'")
+    if message_id is not None and not (isinstance(message_id, str) and MESSAGE_ID_PATTERN.match(message_id)):
+        raise ValueError("Invalid 'message_id': must be 8-64 characters of [A-Za-z0-9_-]")
+
+    # 送信者は認証されたユーザー自身 (user_email)
+    sender_email = user_email
+
+    # セキュリティチェック: room_id と sender/receiver が一致するかなど
+    expected_room_id = "_".join(sorted([sender_email.lower(), receiver_email.lower()]))
+    if room_id != expected_room_id:
+         raise ValueError("Forbidden: Invalid room_id for sender/receiver pair")
+    return room_id, sender_email, receiver_email, content, message_id
+
+def send_result_body(saved_message):
+    return {"success": True, "id": saved_message['id'], "duplicate": saved_message.get('duplicate', False)}
+
+def action_send_message(user_email, req_data):
+    """send_message: メッセージを送信 (message_id 付きの再送は書き込みを行わずに成功を返す)"""
+    saved_message = send_message_to_db(*validate_send_message(user_email, req_data))
+    return send_result_body(saved_message), 200
+
+def _run_batch_item(handler, user_email, item):
+    """バッチ内の 1 件を実行し、結果またはエラーを {"status": ..., "body": ...} 形式で返す"""
+    try:
+        body, status = handler(user_email, item)
+    except Exception as e:
+        body, status = error_response_for_exception(e)
+    return {"status": status, "body": body}
+
+def split_batch_items(req_data):
+    """batch のサブアクションを検証し、(結果のリスト, 読み込みの (index, item), 書き込みの (index, item)) に分ける
+
+    未対応のアクションの結果はこの時点で埋める。
+    """
+    items = req_data.get('requests')
+    if not isinstance(items, list) or not items:
+        raise ValueError("Missing or invalid 'requests' parameter: must be a non-empty list")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise ValueError(f"Too many requests in batch: maximum is {BATCH_MAX_ITEMS}")
+
+    results = [None] * len(items)
+    read_items = []
+    write_items = []
+    for index, item in enumerate(items):
+        action = item.get('action') if isinstance(item, dict) else None
+        if action == 'get_messages':
+            read_items.append((index, item))
+        elif action == 'send_message':
+            write_items.append((index, item))
+        else:
+            results[index] = {"status": 400, "body": {"error": f"Unsupported action in batch: {action}"}}
+    return results, read_items, write_items
+
+def stage_batch_writes(user_email, write_items, write_batch, results):
+    """検証を通過した送信を write_batch に追加し、(コミット対象, 同じバッチ内での再送) を返す
+
+    コミット対象は (index, send_message_to_db の引数, 保存するメッセージ) のリスト、
+    再送は (index, 先に書き込む要素の index) のリスト。検証エラーと重複排除済みの再送の結果は results に書き込む。
+    """
+    committed = []
+    batch_message_ids = {} # (room_id, message_id) -> 同じバッチ内で先に書き込む要素の index
+    repeated = []
+    for index, item in write_items:
+        try:
+            send_args = validate_send_message(user_email, item)
+            key = (send_args[0], send_args[4])
+            if send_args[4] and key in batch_message_ids:
+                repeated.append((index, batch_message_ids[key]))
+                continue
+            saved_message = send_message_to_db(*send_args, batch=write_batch)
+            if saved_message.get('duplicate'):
+                results[index] = {"status": 200, "body": send_result_body(saved_message)}
+                continue
+            if send_args[4]:
+                batch_message_ids[key] = index
+            committed.append((index, send_args, saved_message))
+        except Exception as e:
+            body, status = error_response_for_exception(e)
+            results[index] = {"status": status, "body": body}
+    return committed, repeated
+
+def finish_batch_writes(user_email, committed, results):
+    """コミットに成功した送信をキャッシュ・重複排除に反映し、結果を埋める"""
+    print(f"Batch committed {len(committed)} message(s) by {user_email}")
+    for index, send_args, saved_message in committed:
+        record_sent_message(send_args[0], saved_message, send_args[4])
+        results[index] = {"status": 200, "body": send_result_body(saved_message)}
+
+def fail_batch_writes(e, committed, results):
+    """WriteBatch はアトミックなので、コミットの失敗時はバッチ内の書き込みをすべて失敗扱いにする"""
+    body, status = error_response_for_exception(e)
+    for index, _, _ in committed:
+        results[index] = {"status": status, "body": body}
+
+def resolve_repeated_writes(repeated, results):
+    """同じバッチ内での再送に、先に書き込んだ要素の結果を (成功なら重複扱いで) コピーする"""
+    for index, first_index in repeated:
+        first_result = results[first_index]
+        if first_result['status'] == 200:
+            results[index] = {"status": 200, "body": {**first_result['body'], "duplicate": True}}
+        else:
+            results[index] = first_result
+
+def action_batch(user_email, req_data):
+    """batch: 複数のサブアクションを 1 回の HTTP 往復で処理
+
+    書き込み (send_message) は 1 つの WriteBatch にまとめてコミットし、その後で
+    読み込み (get_messages) を並列に実行する。同じバッチで送信したメッセージは読み込み結果に含まれる。
+    message_id 付きの送信が既に保存済みでコミットが失敗した場合は、1 件ずつ保存し直して重複分を成功扱いにする。
+    結果は requests と同じ順序で、各要素ごとにステータスとエラーを返す。
+    """
+    results, read_items, write_items = split_batch_items(req_data)
+
+    # 1. 書き込み: 検証を通過したものを 1 つの WriteBatch でまとめてコミット
+    if write_items:
+        write_batch = storage.batch()
+        committed, repeated = stage_batch_writes(user_email, write_items, write_batch, results)
+        if committed:
+            try:
+                with request_phase('db'):
+                    write_batch.commit()
+                finish_batch_writes(user_email, committed, results)
+            except MessageAlreadyExists:
+                # 再送が含まれていた: 1 件ずつ「存在しなければ作成」で保存し直す
+                print(f"Batch commit hit an existing message_id, retrying {len(committed)} write(s) individually")
+                for index, send_args, _ in committed:
+                    try:
+                        saved_message = send_message_to_db(*send_args)
+                        results[index] = {"status": 200, "body": send_result_body(saved_message)}
+                    except Exception as e:
+                        body, status = error_response_for_exception(e)
+                        results[index] = {"status": status, "body": body}
+            except Exception as e:
+                fail_batch_writes(e, committed, results)
+        resolve_repeated_writes(repeated, results)
+
+    # 2. 読み込み: ルームごとのクエリを並列に実行
+    futures = [
+        (index, batch_executor.submit(_run_batch_item, action_get_messages, user_email, item))
+        for index, item in read_items
+    ]
+    for index, future in futures:
+        results[index] = future.result()
+
+    return {"results": results}, 200
+
+def action_list_rooms(user_email, req_data):
+    """list_rooms: 参加しているルームの一覧 (最新メッセージのプレビュー・未読数付き) を取得"""
+    limit = parse_page_size(req_data.get('limit'), default=ROOMS_PAGE_SIZE, maximum=ROOMS_MAX_PAGE_SIZE)
+    return {"rooms": list_rooms_from_db(user_email, limit=limit)}, 200
+
+def action_mark_room_read(user_email, req_data):
+    """mark_room_read: ルームの自分の未読数を 0 にする"""
+    room_id = req_data.get('room_id')
+    require_room_member(user_email, room_id)
+    mark_room_read_in_db(room_id, user_email)
+    return {"success": True}, 200
+
+def action_stats(user_email, req_data):
+    """stats: このインスタンスのキャッシュ統計 (ヒット率・メモリ使用量) を返す (STATS_ADMIN_EMAILS のユーザーのみ)
+
+    インスタンスの内部状態 (キャッシュの使用量・制限の状況) を含むため、それ以外のユーザーには 403 を返す。
+    """
+    if user_email.lower() not in STATS_ADMIN_EMAILS:
+        raise ValueError("Forbidden: stats is restricted to administrators")
+    return {
+        "token_cache": token_cache.stats(),
+        "cert_store": cert_store.stats(),
+        "room_cache": room_cache.stats(),
+        "sent_dedup": sent_dedup.stats(),
+        "rate_limit": {"read": read_limiter.stats(), "write": write_limiter.stats()},
+        "load_shedder": load_shedder.stats(),
+        "streams": stream_shedder.stats(),
+    }, 200
+
+# アクション名と処理関数の対応
+ACTION_HANDLERS = {
+    'get_messages': action_get_messages,
+    'send_message': action_send_message,
+    'batch': action_batch,
+    'list_rooms': action_list_rooms,
+    'mark_room_read': action_mark_room_read,
+    'search_messages': action_search_messages,
+    'stats': action_stats,
+    # (オプション) ユーザーリスト取得などのアクションを追加する場合
+    # 'get_users': action_get_users,
+}
+
+# --- レスポンスの形式 ---
+# クライアントは Accept ヘッダーで形式を選べる (指定がなければ従来どおりの JSON)
+#   application/json                          : フィールド名そのまま、timestamp は ISO 形式文字列
+#   application/vnd.securechat.compact+json   : 短いフィールド名、timestamp はエポックミリ秒の整数
+#   application/x-msgpack                     : compact と同じ内容を MessagePack で (msgpack がインストールされている場合)
+CONTENT_TYPE_JSON = 'application/json'
+CONTENT_TYPE_COMPACT_JSON = 'application/vnd.securechat.compact+json'
+CONTENT_TYPE_MSGPACK = 'application/x-msgpack'
+# compact 形式でのメッセージのフィールド名
+COMPACT_MESSAGE_KEYS = {
+    'id': 'i',
+    'sender_email': 's',
+    'receiver_email': 'r',
+    'content': 'c',
+    'timestamp': 't',
+}
+
+def offered_response_formats():
+    """このインスタンスが返せるレスポンスの形式 (Content-Type) のリスト"""
+    offered = [CONTENT_TYPE_JSON, CONTENT_TYPE_COMPACT_JSON]
+    if msgpack is not None:
+        offered.append(CONTENT_TYPE_MSGPACK)
+    return offered
+
+def negotiate_response_format():
+    """Accept ヘッダーからレスポンスの形式 (Content-Type) を決める"""
+    return request.accept_mimetypes.best_match(offered_response_formats(), default=CONTENT_TYPE_JSON)
+
+def serialize_messages(messages, response_format):
+    """内部形式のメッセージ (timestamp は datetime) を、指定された形式の辞書のリストに変換する"""
+    if response_format == CONTENT_TYPE_JSON:
+        return [
+            {**msg, 'timestamp': msg['timestamp'].isoformat()} if isinstance(msg.get('timestamp'), datetime.datetime) else msg
+            for msg in messages
+        ]
+    compact_messages = []
+    for msg in messages:
+        compact = {COMPACT_MESSAGE_KEYS.get(key, key): value for key, value in msg.items()}
+        if isinstance(compact.get('t'), datetime.datetime):
+            compact['t'] = int(compact['t'].timestamp() * 1000)
+        compact_messages.append(compact)
+    return compact_messages
+
+def _serialize_body(body, response_format):
+    """レスポンス辞書に含まれるメッセージ (ルームの最新メッセージ、検索のヒット、batch の各結果を含む) を指定された形式に変換する"""
+    if isinstance(body.get('messages'), list):
+        body = {**body, 'messages': serialize_messages(body['messages'], response_format)}
+    if isinstance(body.get('rooms'), list):
+        body = {**body, 'rooms': [
+            {**room, 'last_message': serialize_messages([room['last_message']], response_format)[0]} if room.get('last_message') else room
+            for room in body['rooms']
+        ]}
+    if isinstance(body.get('hits'), list):
+        body = {**body, 'hits': [
+            {**hit, 'message': serialize_messages([hit['message']], response_format)[0]} for hit in body['hits']
+        ]}
+    if isinstance(body.get('results'), list):
+        body = {**body, 'results': [
+            {**result, 'body': _serialize_body(result['body'], response_format)} if isinstance(result.get('body'), dict) else result
+            for result in body['results']
+        ]}
+    return body
+
+def encode_body(body, response_format):
+    """レスポンス辞書を指定された形式のバイト列にする"""
+    body = _serialize_body(body, response_format)
+    if response_format == CONTENT_TYPE_MSGPACK:
+        return msgpack.packb(body, use_bin_type=True)
+    if response_format == CONTENT_TYPE_COMPACT_JSON and orjson is not None:
+        return orjson.dumps(body)
+    if response_format == CONTENT_TYPE_COMPACT_JSON:
+        return json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return json.dumps(body, separators=(',', ':')).encode('utf-8')
+
+def build_response(body, status_code, response_format=CONTENT_TYPE_JSON):
+    """アクションの結果から Flask のレスポンスを作る"""
+    if response_format != CONTENT_TYPE_JSON:
+        return Response(encode_body(body, response_format), status=status_code, mimetype=response_format)
+    body = _serialize_body(body, response_format)
+    response = jsonify(body)
+    response.status_code = status_code
+    return response
+
+# --- リクエストの計測 (Server-Timing / 構造化ログ) ---
+class RequestTimer:
+    """1 リクエストのフェーズ (認証・パース・保存先・シリアライズなど) ごとの所要時間をミリ秒で集計する
+
+    同じ名前のフェーズが複数回あれば合算する。フェーズは入れ子になってよい (action の中の db など)。
+    """
+
+    def __init__(self):
+        self.started_at = time.perf_counter()
+        self.phases = {} # フェーズ名 -> 合計ミリ秒 (記録した順)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + (time.perf_counter() - started_at) * 1000
+
+    def total_ms(self):
+        return (time.perf_counter() - self.started_at) * 1000
+
+    def server_timing(self, total_ms):
+        """Server-Timing ヘッダーの値 (例: "auth;dur=0.31, db;dur=12.50, total;dur=14.02")"""
+        metrics = [f"{name};dur={duration:.2f}" for name, duration in self.phases.items()]
+        metrics.append(f"total;dur={total_ms:.2f}")
+        return ', '.join(metrics)
+
+def request_phase(name):
+    """現在のリクエストの計測にフェーズを記録するコンテキストマネージャ (リクエスト外・別スレッドでは何もしない)"""
+    timer = g.get('request_timer') if has_request_context() else None
+    return timer.phase(name) if timer is not None else contextlib.nullcontext()
+
+def should_log_request(status_code, total_ms):
+    """構造化ログを出すか (エラー・遅いリクエストは必ず、それ以外はサンプリング)"""
+    return status_code >= 500 or total_ms >= REQUEST_LOG_SLOW_MS or random.random() < REQUEST_LOG_SAMPLE_RATE
+
+@app.before_request
+def start_request_timer():
+    g.request_timer = RequestTimer()
+    # クライアントのログと突き合わせるための ID (クライアントが送らなければ生成する)
+    g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+
+def log_request_timing(request_id, path, action, status_code, timer, total_ms, response_bytes):
+    """1 リクエストの計測結果を 1 行の JSON ログ (Cloud Logging の構造化ログ) で出力する"""
+    print(json.dumps({
+        'severity': 'WARNING' if status_code >= 500 or total_ms >= REQUEST_LOG_SLOW_MS else 'INFO',
+        'message': 'request timing',
+        'request_id': request_id,
+        'path': path,
+        'action': action,
+        'status': status_code,
+        'total_ms': round(total_ms, 2),
+        'phases_ms': {name: round(duration, 2) for name, duration in timer.phases.items()},
+        'response_bytes': response_bytes,
+    }))
+
+# after_request は登録と逆順に呼ばれるため、圧縮 (compress_response) より先に登録して圧縮後に計測を締める
+@app.after_request
+def emit_request_timing(response):
+    """フェーズごとの所要時間を Server-Timing ヘッダーと 1 行の JSON ログ (Cloud Logging の構造化ログ) で出力する"""
+    timer = g.get('request_timer')
+    if timer is None:
+        return response
+    total_ms = timer.total_ms()
+    response.headers['X-Request-ID'] = g.request_id
+    if SERVER_TIMING_ENABLED:
+        response.headers['Server-Timing'] = timer.server_timing(total_ms)
+    if should_log_request(response.status_code, total_ms):
+        log_request_timing(g.request_id, request.path, g.get('action'), response.status_code, timer, total_ms,
+                           None if response.is_streamed else response.content_length)
+    return response
+
+# --- 条件付きリクエスト (ETag / 304) と圧縮 ---
+def messages_etag(req_data, version, response_format):
+    """get_messages の応答を識別する ETag を作る
+
+    同じパラメータ (room_id, since, before, limit) と同じルームのバージョン (最新メッセージのカーソル) なら
+    応答の内容は同じになる。過去ページ (before) はメッセージが変更されないため、バージョンに依存しない。
+    """
+    if req_data.get('before'):
+        version = 'history'
+    key = "|".join(str(part) for part in (
+        req_data.get('room_id'), req_data.get('since'), req_data.get('before'),
+        req_data.get('limit'), version, response_format,
+    ))
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def not_modified_response(etag):
+    """クライアントの If-None-Match が etag と一致すれば、ボディなしの 304 レスポンスを返す"""
+    if etag is not None and request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+def precheck_get_messages_etag(user_email, req_data, response_format):
+    """ルームキャッシュが有効な間は、Firestore もレスポンス作成も通さずに 304 で応答できるか確認する"""
+    if not request.if_none_match:
+        return None
+    require_room_member(user_email, req_data.get('room_id'))
+    version = room_cache.fresh_version(req_data.get('room_id'))
+    if version is None and not req_data.get('before'):
+        return None
+    return not_modified_response(messages_etag(req_data, version, response_format))
+
+@app.after_request
+def compress_response(response):
+    """Accept-Encoding に応じて、一定サイズ以上のレスポンスを brotli または gzip で圧縮する"""
+    if (response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers):
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESS_MIN_BYTES:
+        return response
+    with request_phase('compress'):
+        compressed, encoding = compress_body(data, request.accept_encodings)
+    if encoding is None:
+        return response
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+def compress_body(data, accept_encodings):
+    """Accept-Encoding (werkzeug の Accept) に応じて brotli または gzip で圧縮し、(データ, Content-Encoding) を返す
+
+    クライアントがどちらも受け付けなければ (data, None) を返す。
+    """
+    if brotli is not None and accept_encodings['br']:
+        return brotli.compress(data, quality=BROTLI_QUALITY), 'br'
+    if accept_encodings['gzip']:
+        return gzip.compress(data, compresslevel=GZIP_COMPRESS_LEVEL), 'gzip'
+    return data, None
+
+# --- メッセージストリーム (Server-Sent Events) ---
+def _sse_event(event, data, event_id=None):
+    """Server-Sent Events の 1 イベント分の文字列を作る"""
+    lines = [f"id: {event_id}"] if event_id else []
+    lines.append(f"event: {event}")
+    lines.append(f"data: {json.dumps(data, ensure_ascii=False)}")
+    return "\n".join(lines) + "\n\n"
+
+def stream_room_messages(room_id, since):
+    """ルームの新着メッセージを SSE として送り続けるジェネレーター
+
+    スナップショットリスナーが受け取った新着をキューで受け渡し、STREAM_MAX_SECONDS 経過で終了する。
+    各イベントの id はカーソルなので、クライアントは Last-Event-ID (または since) で続きから再接続できる。
+    """
+    pending = queue.Queue()
+    unsubscribe = watch_messages_in_db(room_id, since, pending.put)
+    cursor = since
+    try:
+        yield "retry: 3000\n\n" # 切断時の再接続間隔 (ミリ秒)
+        deadline = time.monotonic() + STREAM_MAX_SECONDS
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                added = pending.get(timeout=min(STREAM_HEARTBEAT_SECONDS, remaining))
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            # リスナーの呼び出しが複数たまっていればまとめて 1 イベントにする
+            while True:
+                try:
+                    added.extend(pending.get_nowait())
+                except queue.Empty:
+                    break
+            added.sort(key=message_sort_key)
+            for msg in added:
+                room_cache.append(room_id, msg)
+            cursor = message_cursor(added[-1])
+            yield _sse_event("messages", {"messages": serialize_messages(added, CONTENT_TYPE_JSON), "cursor": cursor},
+                             event_id=cursor)
+        yield _sse_event("end", {"cursor": cursor})
+    finally:
+        unsubscribe()
+
+@app.route('/stream', methods=['GET'])
+def handle_stream():
+    """ルームの新着メッセージを Server-Sent Events で配信するエンドポイント
+
+    クエリパラメータ: room_id (必須), since (カーソル。省略時は Last-Event-ID ヘッダー、それも無ければ現在の最新から)
+    開いているストリームが STREAM_MAX_CONCURRENT 本に達していれば、認証などの処理を行う前に 503 で断る。
+    枠はストリームを閉じるまで (エラーの応答ではその時点で) 占有する。
+    """
+    if not stream_shedder.try_enter():
+        return overloaded_response()
+    started_at = time.perf_counter()
+
+    def release():
+        stream_shedder.exit((time.perf_counter() - started_at) * 1000)
+    try:
+        response = open_message_stream()
+    except BaseException:
+        release()
+        raise
+    if isinstance(response, Response) and response.is_streamed:
+        response.call_on_close(release)
+    else:
+        release()
+    return response
+
+def open_message_stream():
+    """認証・レート制限を行い、ストリームのレスポンス (またはエラーの応答) を返す"""
+    g.action = 'stream'
+    try:
+        with request_phase('auth'):
+            user_info = verify_id_token(request.headers.get('Authorization'))
+        user_email = user_info.get('email')
+        if not user_email:
+            return jsonify({"error": "Email not found in verified token"}), 403
+        room_id = request.args.get('room_id')
+        require_room_member(user_email, room_id)
+        # 再接続を繰り返すクライアントもユーザーの読み込みの予算で制限する
+        retry_after = admit_request(user_email, 'stream', {})
+        if retry_after:
+            return rate_limited_response(retry_after)
+        since = request.args.get('since') or request.headers.get('Last-Event-ID')
+        if since:
+            decode_cursor(since) # 不正なカーソルはストリーム開始前に 400 で返す
+        else:
+            latest = get_messages_cached(room_id, limit=1)
+            since = message_cursor(latest[-1]) if latest else None
+    except Exception as e:
+        body, status_code = error_response_for_exception(e)
+        return jsonify(body), status_code
+
+    print(f"Opening message stream for room {room_id} by {user_email}")
+    return Response(
+        stream_with_context(stream_room_messages(room_id, since)),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no', # プロキシでのバッファリングを無効化
+        },
+    )
+
+# --- ルームの書き出し (NDJSON) ---
+def export_room_lines(room_id, after=None):
+    """ルームの全メッセージを古い順に NDJSON として返すジェネレーター (1 ページ分ずつのバイト列)
+
+    各行は get_messages と同じ JSON 形式のメッセージ。最後の行は {"end": true, "complete": ..., "cursor": ..., "count": ...} で、
+    complete が false (EXPORT_MAX_SECONDS で打ち切った) なら cursor を after に渡して続きを書き出す。
+    保存先からはカーソルで 1 ページずつ読むため、メモリに保持するのはルームの大きさに関わらず 1 ページ分だけ。
+    """
+    cursor = after
+    count = 0
+    complete = True
+    deadline = time.monotonic() + EXPORT_MAX_SECONDS
+    pages = storage.iter_message_pages(room_id, EXPORT_PAGE_SIZE, after=decode_cursor(after) if after else None)
+    try:
+        for messages in pages:
+            yield ''.join(
+                json.dumps(msg, ensure_ascii=False) + '\n' for msg in serialize_messages(messages, CONTENT_TYPE_JSON)
+            ).encode('utf-8')
+            count += len(messages)
+            cursor = message_cursor(messages[-1])
+            if time.monotonic() >= deadline:
+                complete = False
+                break
+    finally:
+        pages.close()
+    print(f"Exported {count} message(s) from room {room_id} (complete: {complete})")
+    yield (json.dumps({"end": True, "complete": complete, "cursor": cursor, "count": count}) + '\n').encode('utf-8')
+
+def gzip_stream(chunks):
+    """バイト列のチャンクを逐次 gzip 圧縮するジェネレーター
+
+    チャンクごとに Z_SYNC_FLUSH するので、クライアントは受け取った分から展開できる (全体をメモリに持たない)。
+    """
+    compressor = zlib.compressobj(GZIP_COMPRESS_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    yield compressor.flush()
+
+@app.route('/export', methods=['GET'])
+def handle_export():
+    """ルームの全履歴を NDJSON (application/x-ndjson) で書き出すエンドポイント (export_room)
+
+    クエリパラメータ: room_id (必須), after (カーソル。そのメッセージより後から書き出す。中断した書き出しの再開用)
+    Accept-Encoding に gzip を含めると、書き出しながら gzip で圧縮する。
+    """
+    g.action = 'export_room'
+    try:
+        with request_phase('auth'):
+            user_info = verify_id_token(request.headers.get('Authorization'))
+        user_email = user_info.get('email')
+        if not user_email:
+            return jsonify({"error": "Email not found in verified token"}), 403
+        room_id = request.args.get('room_id')
+        require_room_member(user_email, room_id)
+        after = request.args.get('after')
+        if after:
+            decode_cursor(after) # 不正なカーソルは書き出し開始前に 400 で返す
+        retry_after = admit_request(user_email, 'export_room', {})
+        if retry_after:
+            return rate_limited_response(retry_after)
+    except Exception as e:
+        body, status_code = error_response_for_exception(e)
+        return jsonify(body), status_code
+
+    print(f"Exporting room {room_id} for {user_email}")
+    chunks = export_room_lines(room_id, after)
+    filename = re.sub(r'[^A-Za-z0-9@._-]', '_', room_id)
+    headers = {
+        'Cache-Control': 'no-store',
+        'Content-Disposition': f'attachment; filename="{filename}.ndjson"',
+        'X-Accel-Buffering': 'no', # プロキシでのバッファリングを無効化
+    }
+    if request.accept_encodings['gzip']:
+        chunks = gzip_stream(chunks)
+        headers['Content-Encoding'] = 'gzip'
+        headers['Vary'] = 'Accept-Encoding'
+    return Response(stream_with_context(chunks), mimetype='application/x-ndjson', headers=headers)
+
+# --- ウォームアップ ---
+_warmup_lock = threading.Lock()
+_warmup_done = False
+
+@app.route('/warmup', methods=['GET'])
+def handle_warmup():
+    """インスタンスの初回リクエストの前に呼ぶ軽量なウォームアップ (認証不要)
+
+    google.auth の読み込みとトークン検証用の証明書の取得、保存先の接続を済ませておく。
+    準備はインスタンスごとに 1 回だけ行い、2 回目以降は何もせずに応答する。
+    """
+    global _warmup_done
+    if _warmup_done:
+        return jsonify({"warm": True}), 200
+    started_at = time.perf_counter()
+    with _warmup_lock:
+        if not _warmup_done:
+            try:
+                with request_phase('auth'):
+                    google_jwt_module.get()
+                    cert_store.get_certs()
+                with request_phase('db'):
+                    storage.warmup()
+            except Exception as e:
+                print(f"Warmup failed: {e}")
+                return jsonify({"warm": False, "error": "Warmup failed"}), 503
+            _warmup_done = True
+    return jsonify({"warm": True, "elapsed_ms": round((time.perf_counter() - started_at) * 1000, 2)}), 200
 
 # --- HTTP リクエストハンドラ ---
 @app.route('/', methods=['POST'])
 def handle_request():
     """HTTP POST リクエストを処理するメイン関数"""
+    # 0. 負荷制限: インスタンスが混雑していれば、認証などの処理を行う前に 503 で断る
+    if not load_shedder.try_enter():
+        return overloaded_response()
+    started_at = time.perf_counter()
+    try:
+        return process_request()
+    finally:
+        load_shedder.exit((time.perf_counter() - started_at) * 1000)
+
+def process_request():
+    """認証・レート制限・アクションの実行を行い、レスポンスを返す"""
     try:
         # 1. 認証: ID トークンを検証
         auth_header = request.headers.get('Authorization')
-        user_info = verify_id_token(auth_header)
+        with request_phase('auth'):
+            user_info = verify_id_token(auth_header)
         user_email = user_info.get('email')
         if not user_email:
             # 通常 verify_id_token が成功すれば email は存在するはずだが念のため
             return jsonify({"error": "Email not found in verified token"}), 403
 
         # 2. リクエストボディを取得
-        req_data = request.get_json()
+        with request_phase('parse'):
+            req_data = request.get_json()
         if not req_data:
             return jsonify({"error": "Invalid request: Missing JSON body"}), 400
         if 'action' not in req_data:
             return jsonify({"error": "Invalid request: Missing 'action' in JSON body"}), 400
 
         action = req_data.get('action')
+        g.action = action
 
         # 3. アクションに応じた処理を実行
-        if action == 'get_messages':
-            room_id = req_data.get('room_id')
-            if not room_id:
-                return jsonify({"error": "Missing 'room_id' parameter"}), 400
-
-            # Firestore からメッセージ取得 (セキュリティチェックはここでも追加可能)
-            # 例: room_id に user_email が含まれているかチェックするなど
-            if user_email.lower() not in room_id.lower().split('_'):
-                 return jsonify({"error": "Forbidden: You are not part of this chat room"}), 403
-
-            messages = get_messages_from_db(room_id)
-            return jsonify({"messages": messages}), 200
-
-        elif action == 'send_message':
-            room_id = req_data.get('room_id')
-            receiver_email = req_data.get('receiver_email')
-            content = req_data.get('content')
-            if not all([room_id, receiver_email, content]):
-                return jsonify({"error": "Missing 'room_id', 'receiver_email', or 'content'"}), 400
-
-            # 送信者は認証されたユーザー自身 (user_email)
-            sender_email = user_email
-
-            # セキュリティチェック: room_id と sender/receiver が一致するかなど
-            expected_room_id = "_".join(sorted([sender_email.lower(), receiver_email.lower()]))
-            if room_id != expected_room_id:
-                 return jsonify({"error": "Forbidden: Invalid room_id for sender/receiver pair"}), 403
-
-            send_message_to_db(room_id, sender_email, receiver_email, content)
-            return jsonify({"success": True}), 200
-
-        # (オプション) ユーザーリスト取得などのアクションを追加する場合
-        # elif action == 'get_users':
-        #     # Firestore の users コレクションなどからリストを取得
-        #     users = ["user1@example.com", "user2@example.com"] # ダミー
-        #     return jsonify({"users": users}), 200
-
-        else:
+        handler = ACTION_HANDLERS.get(action)
+        if handler is None:
             return jsonify({"error": f"Unknown action: {action}"}), 400
+        # ユーザーごとのレート制限 (読み込み・書き込みの予算を超えていれば 429)
+        retry_after = admit_request(user_email, action, req_data)
+        if retry_after:
+            return rate_limited_response(retry_after)
+        response_format = negotiate_response_format()
+        if action == 'get_messages':
+            # 変化のないルームはクライアントのキャッシュを使わせる (304)
+            precheck = precheck_get_messages_etag(user_email, req_data, response_format)
+            if precheck is not None:
+                return precheck
+        with request_phase('action'):
+            body, status_code = handler(user_email, req_data)
+        if action == 'get_messages' and status_code == 200:
+            etag = messages_etag(req_data, body.get('cursor') or '', response_format)
+            not_modified = not_modified_response(etag)
+            if not_modified is not None:
+                return not_modified
+            with request_phase('serialize'):
+                response = build_response(body, status_code, response_format)
+            response.set_etag(etag)
+            return response
+        with request_phase('serialize'):
+            return build_response(body, status_code, response_format)
 
-    except ValueError as e: # 認証エラー(401/403)やパラメータ不足(400)
-        error_message = str(e)
-        status_code = 400
-        if "token" in error_message.lower() or "authorization" in error_message.lower():
-            status_code = 401 # Unauthorized
-        elif "forbidden" in error_message.lower():
-            status_code = 403 # Forbidden
-        print(f"Client Error ({status_code}): {error_message}")
-        return jsonify({"error": error_message}), status_code
-    except ConnectionError as e: # サーバー内部の接続や設定エラー
-        print(f"Server Configuration/Connection Error: {e}")
-        return jsonify({"error": f"Server configuration error: {e}"}), 500
-    except Exception as e: # その他の予期せぬエラー
-        print(f"An internal server error occurred: {traceback.format_exc()}")
-        return jsonify({"error": "An internal server error occurred."}), 500
+    except Exception as e:
+        body, status_code = error_response_for_exception(e)
+        return jsonify(body), status_code
 
 # Cloud Functions (2nd gen) は Gunicorn などの WSGI サーバーで実行されるため、
 # 以下の if __name__ == '__main__': ブロックは通常不要。
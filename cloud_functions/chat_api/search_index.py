@@ -0,0 +1,101 @@
+"""メッセージ検索用のトークン化 (索引語の抽出) とスコア計算
+
+本文は NFKC 正規化と小文字化の後、次のように索引語に分ける。
+- 英数字などの単語: 単語そのもの (SEARCH_MAX_WORD_CHARS 文字で切り詰める)
+- 日本語 (ひらがな・カタカナ・漢字) と韓国語の連続: 各文字 (uni-gram) と文字 bi-gram
+検索語は、日本語・韓国語の連続が 1 文字ならその 1 文字、2 文字以上なら bi-gram に分け、
+すべての索引語を含むメッセージをヒットとする (1 文字の検索語も長い連続の中の文字にヒットする)。
+
+    python -m doctest search_index.py
+"""
+import re
+import unicodedata
+from collections import Counter
+
+# 1 件のメッセージから索引に登録する語の数の上限 (長文で索引が肥大化しないように)
+# 日本語は 1 文字ごとに uni-gram と bi-gram の 2 語になるため、英文より多めに取る
+SEARCH_MAX_TERMS_PER_MESSAGE = 512
+SEARCH_MAX_WORD_CHARS = 32
+
+# bi-gram で分割する文字 (ひらがな・カタカナ・CJK 統合漢字・互換漢字・ハングル)
+_CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+_TOKEN_PATTERN = re.compile(f'([{_CJK_CHARS}]+)|([^\\W{_CJK_CHARS}]+)')
+_HIRAGANA = re.compile('[\u3040-\u309f]')
+
+
+def normalize(text):
+    """検索用の正規化 (全角英数字・半角カナの統一と小文字化)"""
+    return unicodedata.normalize('NFKC', text or '').lower()
+
+
+def iter_terms(text):
+    """本文の索引語を出現順に返す (重複を含む)
+
+    >>> list(iter_terms('東京駅 Tokyo'))
+    ['東', '東京', '京', '京駅', '駅', 'tokyo']
+    """
+    for match in _TOKEN_PATTERN.finditer(normalize(text)):
+        cjk_run, word = match.groups()
+        if word:
+            yield word[:SEARCH_MAX_WORD_CHARS]
+            continue
+        for i, char in enumerate(cjk_run):
+            yield char
+            if i + 1 < len(cjk_run):
+                yield cjk_run[i:i + 2]
+
+
+def _iter_query_terms(query):
+    """検索語の索引語を出現順に返す (日本語・韓国語の連続は 1 文字なら uni-gram、2 文字以上なら bi-gram のみ)"""
+    for match in _TOKEN_PATTERN.finditer(normalize(query)):
+        cjk_run, word = match.groups()
+        if word:
+            yield word[:SEARCH_MAX_WORD_CHARS]
+        elif len(cjk_run) == 1:
+            yield cjk_run
+        else:
+            for i in range(len(cjk_run) - 1):
+                yield cjk_run[i:i + 2]
+
+
+def index_terms(text):
+    """メッセージを索引に登録する語 (重複なし、最大 SEARCH_MAX_TERMS_PER_MESSAGE 語)"""
+    return list(dict.fromkeys(iter_terms(text)))[:SEARCH_MAX_TERMS_PER_MESSAGE]
+
+
+def query_terms(query):
+    """検索語の索引語 (重複なし)
+
+    1 文字の検索語は、長い連続の中の同じ文字にもヒットする。
+
+    >>> query_terms('猫'), query_terms('東京駅')
+    (['猫'], ['東京', '京駅'])
+    >>> all(term in index_terms('猫が好きです') for term in query_terms('猫'))
+    True
+    >>> all(term in index_terms('東京駅で会おう') for term in query_terms('駅'))
+    True
+    """
+    return list(dict.fromkeys(_iter_query_terms(query)))
+
+
+def most_selective_term(terms):
+    """索引を引く語を選ぶ (ヒット件数が少なそうな語: ひらがなが少なく、長いもの)
+
+    ひらがなの bi-gram ("です" "ます" など) は多くのメッセージに現れるため後回しにする。
+    """
+    return max(terms, key=lambda term: (-len(_HIRAGANA.findall(term)), len(term)))
+
+
+def score_message(content, terms, normalized_query):
+    """メッセージが検索語のすべての索引語を含めばスコア (大きいほど上位)、含まなければ None を返す
+
+    検索語がそのまま含まれる場合に 1 を加え、本文に占める検索語の索引語の割合 (0〜1) を足す。
+    """
+    counts = Counter(iter_terms(content))
+    if any(term not in counts for term in terms):
+        return None
+    matched = sum(counts[term] for term in terms)
+    score = matched / sum(counts.values())
+    if normalized_query and normalized_query in normalize(content):
+        score += 1.0
+    return round(score, 4)
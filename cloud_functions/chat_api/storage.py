@@ -0,0 +1,1012 @@
+import bisect
+import datetime
+import threading
+import uuid
+
+import search_index
+
+# Firestore バックエンド用 (任意。インメモリバックエンドだけを使う場合は不要)
+# google.cloud.firestore の読み込みは重いため、import 時ではなく最初に Firestore を使う時に読み込む (load_firestore)
+firestore = None
+google_exceptions = None
+
+# --- 定数 ---
+# ルームのサマリーに保存する最新メッセージのプレビュー文字数
+ROOM_SUMMARY_PREVIEW_CHARS = 100
+# 時間バケット方式 (firestore_buckets): 1 つのバケットに入れるメッセージ数とおおよそのバイト数の上限
+# (Firestore のドキュメントは 1 MiB まで。バケットを大きくすると差分取得で読む量が増える)
+BUCKET_MAX_MESSAGES = 100
+BUCKET_MAX_BYTES = 256 * 1024
+# バケットを読む 1 回のクエリの最大件数 (最新のバケットから 1, 2, 4... と増やしながら読む)
+BUCKET_SCAN_MAX_PAGE = 8
+# get_message で探す最新のバケットの数 (冪等キーの衝突は追記先のバケットで起きるため、少数で足りる)
+BUCKET_LOOKUP_DEPTH = 4
+
+
+class MessageAlreadyExists(Exception):
+    """message_id を指定した作成で、同じ ID のメッセージが既に保存されていた"""
+
+
+def room_summary_fields(message):
+    """メッセージの保存で上書きされるサマリーのフィールド (参加者、最新メッセージのプレビュー、更新時刻)"""
+    return {
+        'participants': sorted([message['sender_email'].lower(), message['receiver_email'].lower()]),
+        'last_message': {
+            'id': message['id'],
+            'sender_email': message['sender_email'],
+            'receiver_email': message['receiver_email'],
+            'content': message['content'][:ROOM_SUMMARY_PREVIEW_CHARS],
+            'timestamp': message['timestamp'],
+        },
+        'updated_at': message['timestamp'],
+    }
+
+
+def _as_utc(timestamp):
+    # Firestore から取得したタイムスタンプは UTC であると想定し、naive な場合は UTC を付与
+    if isinstance(timestamp, datetime.datetime) and timestamp.tzinfo is None:
+        return timestamp.replace(tzinfo=datetime.timezone.utc)
+    return timestamp
+
+
+def load_firestore():
+    global firestore, google_exceptions
+    if firestore is None:
+        try:
+            from google.cloud import firestore as firestore_module
+            from google.api_core import exceptions as exceptions_module
+        except ImportError:
+            raise ImportError("google-cloud-firestore is required for the firestore storage backend")
+        google_exceptions = exceptions_module
+        firestore = firestore_module
+    return firestore
+
+
+class MessageStorage:
+    """メッセージとルームのサマリーの保存先のインターフェース
+
+    メッセージは sender_email, receiver_email, content, timestamp (UTC の datetime), id を持つ辞書。
+    since / before の位置は (timestamp, メッセージID) のタプルで指定し、メッセージはこの順に並ぶ。
+    """
+
+    def get_messages(self, room_id, limit, since=None, before=None):
+        """since より新しいものを古い順に最大 limit 件、または before より古いものを新しい側から最大 limit 件 (古い順で返す)"""
+        raise NotImplementedError
+
+    def get_message(self, room_id, message_id):
+        """1 件のメッセージを返す (なければ None)"""
+        raise NotImplementedError
+
+    def watch_messages(self, room_id, since, callback):
+        """since より新しいメッセージ (since が None なら監視開始以降のメッセージ) を監視する
+
+        追加されたメッセージのリスト (古い順) を引数に callback が呼ばれる (別スレッドから呼ばれることがある)。
+        戻り値の関数を呼ぶと監視を停止する。
+        """
+        raise NotImplementedError
+
+    def batch(self):
+        """複数のメッセージをアトミックに保存する MessageWriteBatch を返す"""
+        raise NotImplementedError
+
+    def list_rooms(self, user_email, limit):
+        """user_email が参加しているルームのサマリーを更新の新しい順に返す
+
+        各要素は room_id, participants, last_message, message_count, unread_counts を持つ辞書。
+        """
+        raise NotImplementedError
+
+    def mark_room_read(self, room_id, user_email):
+        """ルームのサマリーで user_email の未読数を 0 にする (サマリーがなければ何もしない)"""
+        raise NotImplementedError
+
+    def search_messages(self, room_id, term, limit, before=None):
+        """索引語 term を含むメッセージを新しい順に最大 limit 件返す (before を指定した場合はそれより古いものだけ)
+
+        索引は add_message の search_terms で書き込み時に更新されたもの。読む量は limit 件分で済み、履歴全体は走査しない。
+        """
+        raise NotImplementedError
+
+    def iter_message_pages(self, room_id, page_size, after=None):
+        """ルームの全メッセージを古い順に、およそ page_size 件ずつのリストで返すジェネレーター
+
+        after (位置) を指定した場合は、それより新しいメッセージから返す。ページごとにカーソルで続きを読むため、
+        保持するのはルームの大きさに関わらず 1 ページ分だけ。
+        """
+        raise NotImplementedError
+
+    def warmup(self):
+        """クライアントの作成や接続など、初回の操作にかかる準備を済ませておく (既定では何もしない)"""
+
+
+class MessageWriteBatch:
+    """メッセージの保存をまとめてコミットするバッチ (ルームのサマリーの更新も同じバッチで行う)"""
+
+    def add_message(self, room_id, data, message_id=None, search_terms=None):
+        """メッセージの保存を追加し、保存先のメッセージ ID を返す
+
+        message_id を指定した場合は「存在しなければ作成」になり、既に存在すると commit() が
+        MessageAlreadyExists を送出する (その場合バッチ内の書き込みはすべて行われない)。
+        search_terms (search_index.index_terms の結果) を渡すと、同じバッチでルームの検索の索引にも登録する。
+        """
+        raise NotImplementedError
+
+    def commit(self):
+        raise NotImplementedError
+
+
+class AsyncMessageStorage:
+    """MessageStorage の非同期版 (ASGI モード用)。各メソッドの引数と戻り値は MessageStorage と同じ
+
+    watch_messages は提供しない (メッセージストリームは WSGI 側で配信する)。
+    """
+
+    async def get_messages(self, room_id, limit, since=None, before=None):
+        raise NotImplementedError
+
+    async def get_message(self, room_id, message_id):
+        raise NotImplementedError
+
+    def batch(self):
+        """add_message() は同期、commit() はコルーチンの書き込みバッチを返す"""
+        raise NotImplementedError
+
+    async def list_rooms(self, user_email, limit):
+        raise NotImplementedError
+
+    async def mark_room_read(self, room_id, user_email):
+        raise NotImplementedError
+
+    async def search_messages(self, room_id, term, limit, before=None):
+        raise NotImplementedError
+
+    async def warmup(self):
+        """クライアントの作成や接続など、初回の操作にかかる準備を済ませておく (既定では何もしない)"""
+
+
+# --- Firestore ---
+# クエリの組み立てとドキュメントの変換は、同期 (Client) と非同期 (AsyncClient) のクライアントで共通
+def message_from_doc(msg_doc):
+    msg_data = msg_doc.to_dict()
+    msg_data.pop('search_terms', None) # 検索の索引語はメッセージとしては返さない
+    msg_data['id'] = msg_doc.id # カーソル作成やクライアント側の重複排除に使う
+    # タイムスタンプは datetime のまま保持し、レスポンス作成時に要求された形式に変換する
+    if 'timestamp' in msg_data:
+        msg_data['timestamp'] = _as_utc(msg_data['timestamp'])
+    return msg_data
+
+
+def _messages_query(messages_ref, limit, since=None, before=None):
+    """get_messages のクエリと、結果を逆順に並べ直す (新しい側から読んだ) かを返す"""
+    # offset ではなく start_after を使うため、履歴の深さに関わらず読み取り件数は limit 件で済む
+    if since:
+        query = (
+            messages_ref.order_by("timestamp").order_by("__name__")
+            .start_after({"timestamp": since[0], "__name__": messages_ref.document(since[1])})
+        )
+        return query.limit(limit), False
+    query = (
+        messages_ref.order_by("timestamp", direction=firestore.Query.DESCENDING)
+        .order_by("__name__", direction=firestore.Query.DESCENDING)
+    )
+    if before:
+        query = query.start_after({"timestamp": before[0], "__name__": messages_ref.document(before[1])})
+    return query.limit(limit), True
+
+
+def _search_query(messages_ref, term, limit, before=None):
+    # search_terms (配列) の array_contains で索引を引く (search_terms + timestamp + __name__ の複合インデックスが必要)
+    query = (
+        messages_ref.where(filter=firestore.FieldFilter("search_terms", "array_contains", term))
+        .order_by("timestamp", direction=firestore.Query.DESCENDING)
+        .order_by("__name__", direction=firestore.Query.DESCENDING)
+    )
+    if before:
+        query = query.start_after({"timestamp": before[0], "__name__": messages_ref.document(before[1])})
+    return query.limit(limit)
+
+
+def _rooms_query(db, user_email, limit):
+    # サマリードキュメントへの 1 回のクエリで済む (participants + updated_at の複合インデックスが必要)
+    return (
+        db.collection("chat_rooms")
+        .where(filter=firestore.FieldFilter("participants", "array_contains", user_email.lower()))
+        .order_by("updated_at", direction=firestore.Query.DESCENDING)
+        .limit(limit)
+    )
+
+
+def _room_from_doc(room_doc):
+    data = room_doc.to_dict()
+    last_message = data.get('last_message') or None
+    if last_message and 'timestamp' in last_message:
+        last_message['timestamp'] = _as_utc(last_message['timestamp'])
+    return {
+        'room_id': room_doc.id,
+        'participants': data.get('participants') or [],
+        'last_message': last_message,
+        'message_count': data.get('message_count', 0),
+        'unread_counts': data.get('unread_counts') or {},
+    }
+
+
+def _unread_reset_update(user_email):
+    # メールアドレスは '.' を含むため、エスケープしたフィールドパスを使う
+    return {firestore.Client.field_path('unread_counts', user_email.lower()): 0}
+
+
+def _add_message_to_batch(db, write_batch, room_id, data, message_id=None, search_terms=None):
+    """メッセージの作成とサマリーの更新を Firestore の WriteBatch (または AsyncWriteBatch) に追加し、メッセージ ID を返す
+
+    検索の索引語はメッセージの search_terms 配列に保存する (Firestore が配列の索引を書き込み時に更新する)。
+    """
+    room_ref = db.collection("chat_rooms").document(room_id)
+    messages_ref = room_ref.collection("messages")
+    doc_data = {**data, 'search_terms': search_terms} if search_terms else data
+    if message_id:
+        msg_ref = messages_ref.document(message_id)
+        write_batch.create(msg_ref, doc_data)
+    else:
+        msg_ref = messages_ref.document()
+        write_batch.set(msg_ref, doc_data)
+    # 受信者の未読数を 1 増やし、送信者の未読数は 0 にする (返信した時点でルームは既読とみなす)
+    summary = room_summary_fields({**data, 'id': msg_ref.id})
+    summary['message_count'] = firestore.Increment(1)
+    summary['unread_counts'] = {data['receiver_email'].lower(): firestore.Increment(1), data['sender_email'].lower(): 0}
+    write_batch.set(room_ref, summary, merge=True)
+    return msg_ref.id
+
+
+class FirestoreStorage(MessageStorage):
+    """Firestore の chat_rooms/{room_id} (サマリー) と chat_rooms/{room_id}/messages に保存する"""
+
+    def __init__(self, client=None):
+        self._db = client
+        self._db_lock = threading.Lock()
+
+    @property
+    def db(self):
+        """Firestore クライアント (Functions の実行環境のSAを使用)。初回の利用時に作り、以降は共有する"""
+        db = self._db
+        if db is None:
+            with self._db_lock:
+                if self._db is None:
+                    self._db = load_firestore().Client()
+                db = self._db
+        return db
+
+    def _messages_ref(self, room_id):
+        return self.db.collection("chat_rooms").document(room_id).collection("messages")
+
+    def get_messages(self, room_id, limit, since=None, before=None):
+        query, newest_first = _messages_query(self._messages_ref(room_id), limit, since, before)
+        messages = [message_from_doc(msg_doc) for msg_doc in query.stream()]
+        if newest_first:
+            messages.reverse() # 古い順に戻す
+        return messages
+
+    def get_message(self, room_id, message_id):
+        msg_doc = self._messages_ref(room_id).document(message_id).get()
+        return message_from_doc(msg_doc) if msg_doc.exists else None
+
+    def watch_messages(self, room_id, since, callback):
+        messages_ref = self._messages_ref(room_id)
+        query = messages_ref.order_by("timestamp").order_by("__name__")
+        if since:
+            query = query.start_after({"timestamp": since[0], "__name__": messages_ref.document(since[1])})
+        else:
+            # カーソルが無ければ、監視開始以降のメッセージだけを対象にする
+            query = query.where(filter=firestore.FieldFilter("timestamp", ">", datetime.datetime.now(datetime.timezone.utc)))
+
+        def on_snapshot(snapshot, changes, read_time):
+            added = [message_from_doc(change.document) for change in changes if change.type.name == 'ADDED']
+            if added:
+                callback(added)
+
+        watch = query.on_snapshot(on_snapshot)
+        return watch.unsubscribe
+
+    def batch(self):
+        return _FirestoreWriteBatch(self)
+
+    def list_rooms(self, user_email, limit):
+        return [_room_from_doc(room_doc) for room_doc in _rooms_query(self.db, user_email, limit).stream()]
+
+    def mark_room_read(self, room_id, user_email):
+        try:
+            self.db.collection("chat_rooms").document(room_id).update(_unread_reset_update(user_email))
+        except google_exceptions.NotFound:
+            pass
+
+    def search_messages(self, room_id, term, limit, before=None):
+        query = _search_query(self._messages_ref(room_id), term, limit, before)
+        return [message_from_doc(msg_doc) for msg_doc in query.stream()]
+
+    def iter_message_pages(self, room_id, page_size, after=None):
+        messages_ref = self._messages_ref(room_id)
+        query = messages_ref.order_by("timestamp").order_by("__name__")
+        position = tuple(after) if after else None
+        while True:
+            page_query = query
+            if position:
+                page_query = query.start_after({"timestamp": position[0], "__name__": messages_ref.document(position[1])})
+            messages = [message_from_doc(msg_doc) for msg_doc in page_query.limit(page_size).stream()]
+            if messages:
+                yield messages
+            if len(messages) < page_size:
+                return
+            position = _message_key(messages[-1])
+
+    def warmup(self):
+        # 存在しないドキュメントを 1 件読み、クライアントの作成・認証情報の取得・接続の確立を済ませる
+        self.db.collection("chat_rooms").document("_warmup").get()
+
+
+class _FirestoreWriteBatch(MessageWriteBatch):
+
+    def __init__(self, storage):
+        self._db = storage.db
+        self._batch = self._db.batch()
+
+    def add_message(self, room_id, data, message_id=None, search_terms=None):
+        return _add_message_to_batch(self._db, self._batch, room_id, data, message_id, search_terms)
+
+    def commit(self):
+        try:
+            self._batch.commit()
+        except google_exceptions.AlreadyExists as e:
+            raise MessageAlreadyExists(str(e)) from e
+
+
+class AsyncFirestoreStorage(AsyncMessageStorage):
+    """FirestoreStorage と同じコレクションを firestore.AsyncClient で読み書きする
+
+    AsyncClient (gRPC の asyncio 版) は作成したイベントループに結び付くため、ループ内の初回の利用時に作る。
+    """
+
+    def __init__(self, client=None):
+        self._db = client
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = load_firestore().AsyncClient()
+        return self._db
+
+    def _messages_ref(self, room_id):
+        return self.db.collection("chat_rooms").document(room_id).collection("messages")
+
+    async def get_messages(self, room_id, limit, since=None, before=None):
+        query, newest_first = _messages_query(self._messages_ref(room_id), limit, since, before)
+        messages = [message_from_doc(msg_doc) async for msg_doc in query.stream()]
+        if newest_first:
+            messages.reverse() # 古い順に戻す
+        return messages
+
+    async def get_message(self, room_id, message_id):
+        msg_doc = await self._messages_ref(room_id).document(message_id).get()
+        return message_from_doc(msg_doc) if msg_doc.exists else None
+
+    def batch(self):
+        return _AsyncFirestoreWriteBatch(self)
+
+    async def list_rooms(self, user_email, limit):
+        return [_room_from_doc(room_doc) async for room_doc in _rooms_query(self.db, user_email, limit).stream()]
+
+    async def mark_room_read(self, room_id, user_email):
+        try:
+            await self.db.collection("chat_rooms").document(room_id).update(_unread_reset_update(user_email))
+        except google_exceptions.NotFound:
+            pass
+
+    async def search_messages(self, room_id, term, limit, before=None):
+        query = _search_query(self._messages_ref(room_id), term, limit, before)
+        return [message_from_doc(msg_doc) async for msg_doc in query.stream()]
+
+    async def warmup(self):
+        await self.db.collection("chat_rooms").document("_warmup").get()
+
+
+class _AsyncFirestoreWriteBatch:
+
+    def __init__(self, storage):
+        self._db = storage.db
+        self._batch = self._db.batch()
+
+    def add_message(self, room_id, data, message_id=None, search_terms=None):
+        return _add_message_to_batch(self._db, self._batch, room_id, data, message_id, search_terms)
+
+    async def commit(self):
+        try:
+            await self._batch.commit()
+        except google_exceptions.AlreadyExists as e:
+            raise MessageAlreadyExists(str(e)) from e
+
+
+# --- Firestore (時間バケット) ---
+# バケットを読む際に取得するフィールド (検索の索引語 search_terms は検索のクエリ条件にだけ使い、読み込まない)
+_BUCKET_READ_FIELDS = ['messages', 'first_ts', 'last_ts']
+
+
+def _message_key(message):
+    return message['timestamp'], message['id']
+
+
+def estimated_message_size(message):
+    """バケットの容量計算に使う、メッセージを Firestore に保存した際のおおよそのバイト数"""
+    return sum(len(key) + len(str(value).encode('utf-8')) for key, value in message.items()) + 32
+
+
+def pack_into_buckets(head, messages):
+    """古い順のメッセージを、追記先のバケット head から順にバケットへ割り当てる
+
+    head は {'id', 'hour', 'seq', 'count', 'bytes', 'first_ts', 'last_ts'} (バケットがまだなければ None)。
+    UTC の時 (YYYYMMDDHH) が変わるか、件数・バイト数の上限に達したら新しいバケットを開く。バケット ID は
+    "YYYYMMDDHH-連番" で、作成順に辞書順で並ぶ (時計のずれで古い時刻のメッセージが来ても時は戻さない)。
+    戻り値は (追記後のバケットの状態, 追記するメッセージのリスト) のリスト (バケットの作成順)。
+    """
+    segments = []
+    for message in messages:
+        hour = message['timestamp'].astimezone(datetime.timezone.utc).strftime('%Y%m%d%H')
+        size = estimated_message_size(message)
+        if head is not None:
+            hour = max(hour, head['hour'])
+        if (head is None or hour != head['hour'] or head['count'] >= BUCKET_MAX_MESSAGES
+                or (head['count'] and head['bytes'] + size > BUCKET_MAX_BYTES)):
+            seq = head['seq'] + 1 if head is not None and head['hour'] == hour else 0
+            head = {'id': f"{hour}-{seq:04d}", 'hour': hour, 'seq': seq, 'count': 0, 'bytes': 0,
+                    'first_ts': message['timestamp'], 'last_ts': message['timestamp']}
+        else:
+            head = dict(head)
+        head['count'] += 1
+        head['bytes'] += size
+        head['first_ts'] = min(head['first_ts'], message['timestamp'])
+        head['last_ts'] = max(head['last_ts'], message['timestamp'])
+        if segments and segments[-1][0]['id'] == head['id']:
+            segments[-1] = (head, segments[-1][1] + [message])
+        else:
+            segments.append((head, [message]))
+    return segments
+
+
+def _bucket_messages(bucket_doc):
+    messages = []
+    for message in (bucket_doc.to_dict() or {}).get('messages') or []:
+        message = dict(message)
+        message['timestamp'] = _as_utc(message['timestamp'])
+        messages.append(message)
+    return messages
+
+
+def _buckets_ref(db, room_id):
+    return db.collection("chat_rooms").document(room_id).collection("message_buckets")
+
+
+def _bucket_messages_query(buckets_ref, since=None, before=None):
+    """get_messages で読むバケットのクエリと、残すメッセージの条件と、バケットを古い順に読むかを返す"""
+    if since:
+        since = tuple(since)
+        # since を含むバケット以降を古い順に読む (last_ts は追記のたびに更新される)
+        query = buckets_ref.where(filter=firestore.FieldFilter("last_ts", ">=", since[0])).order_by("last_ts")
+        return query.select(_BUCKET_READ_FIELDS), lambda message: _message_key(message) > since, True
+    query = buckets_ref.order_by("first_ts", direction=firestore.Query.DESCENDING)
+    if before:
+        before = tuple(before)
+        query = query.where(filter=firestore.FieldFilter("first_ts", "<=", before[0]))
+        keep = lambda message: _message_key(message) < before
+    else:
+        keep = lambda message: True
+    return query.select(_BUCKET_READ_FIELDS), keep, False
+
+
+def _bucket_page(messages, limit, oldest_first):
+    """バケットから集めたメッセージを古い順に並べ、get_messages のページ (limit 件) にする"""
+    messages.sort(key=_message_key)
+    return messages[:limit] if oldest_first else messages[-limit:]
+
+
+def _bucket_lookup_query(buckets_ref):
+    """get_message で探す最新のバケットのクエリ"""
+    return (
+        buckets_ref.order_by("first_ts", direction=firestore.Query.DESCENDING)
+        .select(_BUCKET_READ_FIELDS).limit(BUCKET_LOOKUP_DEPTH)
+    )
+
+
+def _bucket_search_query(buckets_ref, term, before=None):
+    """索引語を含むバケットを新しい順に読むクエリと、その中から残すメッセージの条件を返す
+
+    search_terms + first_ts の複合インデックスが必要。
+    """
+    query = (
+        buckets_ref.where(filter=firestore.FieldFilter("search_terms", "array_contains", term))
+        .order_by("first_ts", direction=firestore.Query.DESCENDING)
+    )
+    if before:
+        before = tuple(before)
+        query = query.where(filter=firestore.FieldFilter("first_ts", "<=", before[0]))
+
+    def keep(message):
+        return (not before or _message_key(message) < before) and term in search_index.index_terms(message['content'])
+    return query.select(_BUCKET_READ_FIELDS), keep
+
+
+def _newest_first(messages, limit):
+    messages.sort(key=_message_key, reverse=True)
+    return messages[:limit]
+
+
+def _bucket_head(summary_doc):
+    """ルームのサマリーから追記先のバケットの状態を取り出す (バケットがまだなければ None)"""
+    return (summary_doc.to_dict() or {}).get('bucket_head') if summary_doc.exists else None
+
+
+def _needs_head_messages(head, entries):
+    """message_id の重複を確認するために、追記先のバケットのメッセージを読む必要があるか"""
+    return bool(head) and any(create_only for _, create_only, _ in entries)
+
+
+def _stage_bucket_append(transaction, db, room_id, entries, head, existing_ids):
+    """トランザクションに、ルームのバケットへの追記とサマリーの更新を追加する (読み込みはすべて済ませてから呼ぶ)
+
+    entries は [(メッセージ, create_only, 索引語)]。existing_ids は追記先のバケットにあるメッセージ ID。
+    """
+    for message, create_only, _ in entries:
+        if create_only and message['id'] in existing_ids:
+            raise MessageAlreadyExists(f"Message {message['id']} already exists in room {room_id}")
+        existing_ids.add(message['id'])
+
+    terms_by_id = {message['id']: search_terms for message, _, search_terms in entries}
+    segments = pack_into_buckets(head, [message for message, _, _ in entries])
+    for bucket, messages in segments:
+        fields = {
+            'messages': firestore.ArrayUnion(messages),
+            'count': firestore.Increment(len(messages)),
+            'bytes': firestore.Increment(sum(estimated_message_size(message) for message in messages)),
+            'first_ts': bucket['first_ts'],
+            'last_ts': bucket['last_ts'],
+        }
+        search_terms = list(dict.fromkeys(term for message in messages for term in terms_by_id[message['id']]))
+        if search_terms:
+            fields['search_terms'] = firestore.ArrayUnion(search_terms)
+        transaction.set(_buckets_ref(db, room_id).document(bucket['id']), fields, merge=True)
+
+    # 未読数: メッセージごとに受信者を +1、送信者を 0 にした結果 (0 にした後の分は値で、それ以外は増分で書く)
+    unread_counts = {}
+    for message, _, _ in entries:
+        receiver, sender = message['receiver_email'].lower(), message['sender_email'].lower()
+        reset, count = unread_counts.get(receiver, (False, 0))
+        unread_counts[receiver] = (reset, count + 1)
+        unread_counts[sender] = (True, 0)
+    summary = room_summary_fields(entries[-1][0])
+    summary['message_count'] = firestore.Increment(len(entries))
+    summary['unread_counts'] = {
+        email: count if reset else firestore.Increment(count) for email, (reset, count) in unread_counts.items()
+    }
+    summary['bucket_head'] = segments[-1][0]
+    transaction.set(db.collection("chat_rooms").document(room_id), summary, merge=True)
+
+
+class BucketedFirestoreStorage(FirestoreStorage):
+    """メッセージを時間バケットのドキュメントにまとめて保存する Firestore のレイアウト (firestore_buckets)
+
+    chat_rooms/{room_id}/message_buckets/{YYYYMMDDHH-連番} の messages 配列に、1 時間ごと・
+    BUCKET_MAX_MESSAGES 件 / BUCKET_MAX_BYTES バイトまでのメッセージを追記する。50 件のページは
+    通常 1〜2 回のドキュメント読み取りで済む (メッセージごとのドキュメントでは 50 回)。
+    追記はルームのサマリー (追記先のバケット bucket_head を持つ) を読むトランザクションで行うため、
+    同じルームへの書き込みは直列化される。message_id の重複は追記先のバケットの範囲で検出する
+    (バケットが切り替わった後の再送は、インスタンス内の重複排除の期間内でのみ検出される)。
+    検索の索引語はバケットの search_terms 配列に、含まれるメッセージの索引語の和集合として追記する
+    (索引語は本文の部分文字列か bi-gram なので、その大きさは本文のおおよそ 2 倍以内に収まる)。
+    ルームのサマリー (list_rooms / mark_room_read) は FirestoreStorage と同じ。
+    既存のルームは tools/migrate_message_buckets.py で変換する。ASGI 版は AsyncBucketedFirestoreStorage。
+    """
+
+    def _buckets_ref(self, room_id):
+        return _buckets_ref(self.db, room_id)
+
+    def _scan_buckets(self, query, keep, limit):
+        """query の順にバケットを読み、keep を満たすメッセージが limit 件に達するか、バケットがなくなるまで集める"""
+        kept = []
+        last_doc = None
+        page_size = 1 # 通常は最新のバケット 1 件で足りる
+        while True:
+            page_query = query.start_after(last_doc) if last_doc is not None else query
+            bucket_docs = list(page_query.limit(page_size).stream())
+            for bucket_doc in bucket_docs:
+                kept.extend(message for message in _bucket_messages(bucket_doc) if keep(message))
+            if len(bucket_docs) < page_size or (limit is not None and len(kept) >= limit):
+                return kept
+            last_doc = bucket_docs[-1]
+            page_size = min(page_size * 2, BUCKET_SCAN_MAX_PAGE)
+
+    def get_messages(self, room_id, limit, since=None, before=None):
+        query, keep, oldest_first = _bucket_messages_query(self._buckets_ref(room_id), since, before)
+        return _bucket_page(self._scan_buckets(query, keep, limit), limit, oldest_first)
+
+    def get_message(self, room_id, message_id):
+        for bucket_doc in _bucket_lookup_query(self._buckets_ref(room_id)).stream():
+            for message in _bucket_messages(bucket_doc):
+                if message['id'] == message_id:
+                    return message
+        return None
+
+    def watch_messages(self, room_id, since, callback):
+        # カーソルが無ければ、監視開始以降のメッセージだけを対象にする
+        position = {'key': tuple(since) if since else (datetime.datetime.now(datetime.timezone.utc), '')}
+        query = self._buckets_ref(room_id).where(filter=firestore.FieldFilter("last_ts", ">=", position['key'][0]))
+        lock = threading.Lock()
+
+        def on_snapshot(snapshot, changes, read_time):
+            # バケットへの追記は MODIFIED として届くため、通知済みの位置より新しいメッセージだけを渡す
+            with lock:
+                added = sorted((
+                    message
+                    for change in changes if change.type.name in ('ADDED', 'MODIFIED')
+                    for message in _bucket_messages(change.document)
+                    if _message_key(message) > position['key']
+                ), key=_message_key)
+                if added:
+                    position['key'] = _message_key(added[-1])
+                    callback(added)
+
+        watch = query.on_snapshot(on_snapshot)
+        return watch.unsubscribe
+
+    def search_messages(self, room_id, term, limit, before=None):
+        query, keep = _bucket_search_query(self._buckets_ref(room_id), term, before)
+        return _newest_first(self._scan_buckets(query, keep, limit), limit)
+
+    def iter_message_pages(self, room_id, page_size, after=None):
+        # バケットを追記順 (last_ts の昇順) に、page_size 件分のバケット数ずつまとめて読む
+        # (読んでいる間に追記されて last_ts が進んだバケットは再び現れるため、返した位置より新しいものだけを返す)
+        query = self._buckets_ref(room_id).order_by("last_ts")
+        position = tuple(after) if after else None
+        if position:
+            query = query.where(filter=firestore.FieldFilter("last_ts", ">=", position[0]))
+        query = query.select(_BUCKET_READ_FIELDS)
+        buckets_per_page = max(1, page_size // BUCKET_MAX_MESSAGES)
+        last_doc = None
+        while True:
+            page_query = query.start_after(last_doc) if last_doc is not None else query
+            bucket_docs = list(page_query.limit(buckets_per_page).stream())
+            messages = sorted((
+                message for bucket_doc in bucket_docs for message in _bucket_messages(bucket_doc)
+                if not position or _message_key(message) > position
+            ), key=_message_key)
+            if messages:
+                yield messages
+                position = _message_key(messages[-1])
+            if len(bucket_docs) < buckets_per_page:
+                return
+            last_doc = bucket_docs[-1]
+
+    def batch(self):
+        return _BucketedWriteBatch(self)
+
+
+class _BucketedWriteBatch(MessageWriteBatch):
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._writes = {} # room_id -> [(メッセージ, create_only, 索引語)] (追加順)
+
+    def add_message(self, room_id, data, message_id=None, search_terms=None):
+        message = {**data, 'id': message_id or uuid.uuid4().hex}
+        self._writes.setdefault(room_id, []).append((message, bool(message_id), search_terms or []))
+        return message['id']
+
+    def commit(self):
+        if self._writes:
+            db = self._storage.db
+            load_firestore().transactional(self._append)(db.transaction())
+
+    def _append(self, transaction):
+        """トランザクション内でルームごとの追記先のバケットを読み、メッセージを追記してサマリーを更新する
+
+        競合時にはトランザクションごと再実行されるため、読み込んだ内容以外の状態を変更しない。
+        """
+        db = self._storage.db
+        # トランザクションでは、読み込みをすべて書き込みより前に行う
+        heads = {}
+        for room_id, entries in self._writes.items():
+            head = _bucket_head(db.collection("chat_rooms").document(room_id).get(transaction=transaction))
+            existing_ids = set()
+            if _needs_head_messages(head, entries):
+                head_doc = _buckets_ref(db, room_id).document(head['id']).get(
+                    field_paths=['messages'], transaction=transaction)
+                if head_doc.exists:
+                    existing_ids = {message['id'] for message in _bucket_messages(head_doc)}
+            heads[room_id] = (head, existing_ids)
+
+        for room_id, entries in self._writes.items():
+            head, existing_ids = heads[room_id]
+            _stage_bucket_append(transaction, db, room_id, entries, head, existing_ids)
+
+
+class AsyncBucketedFirestoreStorage(AsyncFirestoreStorage):
+    """BucketedFirestoreStorage と同じ時間バケットのレイアウトを firestore.AsyncClient で読み書きする (ASGI 版)
+
+    クエリと追記の内容は同期版と共通。ルームのサマリー (list_rooms / mark_room_read) は AsyncFirestoreStorage と同じ。
+    """
+
+    def _buckets_ref(self, room_id):
+        return _buckets_ref(self.db, room_id)
+
+    async def _scan_buckets(self, query, keep, limit):
+        """BucketedFirestoreStorage._scan_buckets の非同期版"""
+        kept = []
+        last_doc = None
+        page_size = 1
+        while True:
+            page_query = query.start_after(last_doc) if last_doc is not None else query
+            bucket_docs = [bucket_doc async for bucket_doc in page_query.limit(page_size).stream()]
+            for bucket_doc in bucket_docs:
+                kept.extend(message for message in _bucket_messages(bucket_doc) if keep(message))
+            if len(bucket_docs) < page_size or (limit is not None and len(kept) >= limit):
+                return kept
+            last_doc = bucket_docs[-1]
+            page_size = min(page_size * 2, BUCKET_SCAN_MAX_PAGE)
+
+    async def get_messages(self, room_id, limit, since=None, before=None):
+        query, keep, oldest_first = _bucket_messages_query(self._buckets_ref(room_id), since, before)
+        return _bucket_page(await self._scan_buckets(query, keep, limit), limit, oldest_first)
+
+    async def get_message(self, room_id, message_id):
+        async for bucket_doc in _bucket_lookup_query(self._buckets_ref(room_id)).stream():
+            for message in _bucket_messages(bucket_doc):
+                if message['id'] == message_id:
+                    return message
+        return None
+
+    async def search_messages(self, room_id, term, limit, before=None):
+        query, keep = _bucket_search_query(self._buckets_ref(room_id), term, before)
+        return _newest_first(await self._scan_buckets(query, keep, limit), limit)
+
+    def batch(self):
+        return _AsyncBucketedWriteBatch(self)
+
+
+class _AsyncBucketedWriteBatch(_BucketedWriteBatch):
+
+    async def commit(self):
+        if self._writes:
+            db = self._storage.db
+            await load_firestore().async_transactional(self._append)(db.transaction())
+
+    async def _append(self, transaction):
+        """_BucketedWriteBatch._append の非同期版 (読み込みだけを await し、書き込みの内容は共通)"""
+        db = self._storage.db
+        heads = {}
+        for room_id, entries in self._writes.items():
+            head = _bucket_head(await db.collection("chat_rooms").document(room_id).get(transaction=transaction))
+            existing_ids = set()
+            if _needs_head_messages(head, entries):
+                head_doc = await _buckets_ref(db, room_id).document(head['id']).get(
+                    field_paths=['messages'], transaction=transaction)
+                if head_doc.exists:
+                    existing_ids = {message['id'] for message in _bucket_messages(head_doc)}
+            heads[room_id] = (head, existing_ids)
+
+        for room_id, entries in self._writes.items():
+            head, existing_ids = heads[room_id]
+            _stage_bucket_append(transaction, db, room_id, entries, head, existing_ids)
+
+
+# --- インメモリ ---
+class InMemoryStorage(MessageStorage):
+    """プロセス内のメモリに保存する (ローカル実行・負荷試験のベースライン用。インスタンス間では共有されない)
+
+    ルームごとに (timestamp, id) でソートしたキーのリストを持ち、since / before の位置は bisect で求める。
+    検索の索引は、ルームごとに索引語からソート済みのキーのリストへの辞書 (転置索引) として持つ。
+    """
+
+    def __init__(self):
+        # room_id -> {'keys': ソート済みの (timestamp, id) のリスト, 'messages': id -> メッセージ,
+        #             'postings': 索引語 -> ソート済みの (timestamp, id) のリスト}
+        self._rooms = {}
+        self._summaries = {} # room_id -> サマリー
+        self._watchers = {} # room_id -> callback のリスト
+        self._lock = threading.Lock()
+
+    def get_messages(self, room_id, limit, since=None, before=None):
+        with self._lock:
+            return self._select(room_id, limit, since, before)
+
+    def _select(self, room_id, limit, since=None, before=None):
+        # _lock を取得した状態で呼ぶ
+        room = self._rooms.get(room_id)
+        if room is None:
+            return []
+        keys = room['keys']
+        if since:
+            start = bisect.bisect_right(keys, tuple(since))
+            selected = keys[start:start + limit] if limit is not None else keys[start:]
+        else:
+            end = bisect.bisect_left(keys, tuple(before)) if before else len(keys)
+            selected = keys[max(0, end - limit):end]
+        return [dict(room['messages'][key[1]]) for key in selected]
+
+    def get_message(self, room_id, message_id):
+        with self._lock:
+            message = self._rooms.get(room_id, {}).get('messages', {}).get(message_id)
+            return dict(message) if message is not None else None
+
+    def watch_messages(self, room_id, since, callback):
+        with self._lock:
+            self._watchers.setdefault(room_id, []).append(callback)
+            if since:
+                # Firestore のリスナーと同様に、最初に since より新しい既存のメッセージを通知する
+                # (ロックを持ったまま通知するので、この後の書き込みの通知と順序が入れ替わらない)
+                existing = self._select(room_id, None, since=since)
+                if existing:
+                    callback(existing)
+
+        def unsubscribe():
+            with self._lock:
+                callbacks = self._watchers.get(room_id, [])
+                if callback in callbacks:
+                    callbacks.remove(callback)
+                if not callbacks:
+                    self._watchers.pop(room_id, None)
+        return unsubscribe
+
+    def batch(self):
+        return _InMemoryWriteBatch(self)
+
+    def _apply(self, writes):
+        """バッチの書き込みをアトミックに反映し、監視中のルームに通知する"""
+        added = {}
+        with self._lock:
+            created_ids = set()
+            for room_id, data, message_id, create_only, _ in writes:
+                key = (room_id, message_id)
+                if create_only and (key in created_ids or message_id in self._rooms.get(room_id, {}).get('messages', {})):
+                    raise MessageAlreadyExists(f"Message {message_id} already exists in room {room_id}")
+                created_ids.add(key)
+            for room_id, data, message_id, _, search_terms in writes:
+                room = self._rooms.setdefault(room_id, {'keys': [], 'messages': {}, 'postings': {}})
+                message = {**data, 'id': message_id}
+                room['messages'][message_id] = message
+                key = (message['timestamp'], message_id)
+                bisect.insort(room['keys'], key)
+                for term in search_terms:
+                    bisect.insort(room['postings'].setdefault(term, []), key)
+                self._update_summary(room_id, message)
+                added.setdefault(room_id, []).append(dict(message))
+            notifications = [(callback, messages) for room_id, messages in added.items()
+                             for callback in list(self._watchers.get(room_id, []))]
+        for callback, messages in notifications:
+            callback(sorted(messages, key=lambda msg: (msg['timestamp'], msg['id'])))
+
+    def _update_summary(self, room_id, message):
+        # _lock を取得した状態で呼ぶ
+        summary = self._summaries.setdefault(room_id, {'message_count': 0, 'unread_counts': {}})
+        summary.update(room_summary_fields(message))
+        summary['message_count'] += 1
+        receiver_email = message['receiver_email'].lower()
+        summary['unread_counts'][receiver_email] = summary['unread_counts'].get(receiver_email, 0) + 1
+        summary['unread_counts'][message['sender_email'].lower()] = 0
+
+    def list_rooms(self, user_email, limit):
+        my_email = user_email.lower()
+        with self._lock:
+            summaries = [
+                (room_id, summary) for room_id, summary in self._summaries.items()
+                if my_email in summary['participants']
+            ]
+            summaries.sort(key=lambda item: item[1]['updated_at'], reverse=True)
+            return [{
+                'room_id': room_id,
+                'participants': list(summary['participants']),
+                'last_message': dict(summary['last_message']),
+                'message_count': summary['message_count'],
+                'unread_counts': dict(summary['unread_counts']),
+            } for room_id, summary in summaries[:limit]]
+
+    def mark_room_read(self, room_id, user_email):
+        with self._lock:
+            summary = self._summaries.get(room_id)
+            if summary is not None:
+                summary['unread_counts'][user_email.lower()] = 0
+
+    def search_messages(self, room_id, term, limit, before=None):
+        with self._lock:
+            room = self._rooms.get(room_id)
+            postings = room['postings'].get(term, []) if room is not None else []
+            end = bisect.bisect_left(postings, tuple(before)) if before else len(postings)
+            return [dict(room['messages'][key[1]]) for key in reversed(postings[max(0, end - limit):end])]
+
+    def iter_message_pages(self, room_id, page_size, after=None):
+        position = tuple(after) if after else None
+        while True:
+            # ページごとにロックを取り直す (書き出しの途中でも書き込みを止めない)
+            with self._lock:
+                keys = self._rooms.get(room_id, {}).get('keys', [])
+                start = bisect.bisect_right(keys, position) if position else 0
+                messages = [dict(self._rooms[room_id]['messages'][key[1]]) for key in keys[start:start + page_size]]
+            if messages:
+                yield messages
+            if len(messages) < page_size:
+                return
+            position = _message_key(messages[-1])
+
+
+class _InMemoryWriteBatch(MessageWriteBatch):
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._writes = [] # (room_id, data, message_id, create_only, 索引語)
+
+    def add_message(self, room_id, data, message_id=None, search_terms=None):
+        create_only = bool(message_id)
+        message_id = message_id or uuid.uuid4().hex
+        self._writes.append((room_id, dict(data), message_id, create_only, list(search_terms or [])))
+        return message_id
+
+    def commit(self):
+        self._storage._apply(self._writes)
+
+
+class AsyncInMemoryStorage(AsyncMessageStorage):
+    """InMemoryStorage を AsyncMessageStorage として使うアダプター
+
+    I/O を伴わないため同期のまま呼び出す。同じ InMemoryStorage を渡せば WSGI 側とデータを共有できる。
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage if storage is not None else InMemoryStorage()
+
+    async def get_messages(self, room_id, limit, since=None, before=None):
+        return self.storage.get_messages(room_id, limit, since=since, before=before)
+
+    async def get_message(self, room_id, message_id):
+        return self.storage.get_message(room_id, message_id)
+
+    def batch(self):
+        return _AsyncInMemoryWriteBatch(self.storage)
+
+    async def list_rooms(self, user_email, limit):
+        return self.storage.list_rooms(user_email, limit)
+
+    async def mark_room_read(self, room_id, user_email):
+        self.storage.mark_room_read(room_id, user_email)
+
+    async def search_messages(self, room_id, term, limit, before=None):
+        return self.storage.search_messages(room_id, term, limit, before=before)
+
+
+class _AsyncInMemoryWriteBatch(_InMemoryWriteBatch):
+
+    async def commit(self):
+        self._storage._apply(self._writes)
+
+
+# バックエンド名と実装の対応 (環境変数 CHAT_STORAGE_BACKEND で選択する)
+STORAGE_BACKENDS = {
+    'firestore': FirestoreStorage,
+    'firestore_buckets': BucketedFirestoreStorage,
+    'memory': InMemoryStorage,
+}
+
+def create_storage(backend):
+    """バックエンド名から MessageStorage を作る"""
+    try:
+        storage_class = STORAGE_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown storage backend: {backend!r} (choose from {', '.join(STORAGE_BACKENDS)})")
+    return storage_class()
+
+ASYNC_STORAGE_BACKENDS = {
+    'firestore': AsyncFirestoreStorage,
+    'firestore_buckets': AsyncBucketedFirestoreStorage,
+    'memory': AsyncInMemoryStorage,
+}
+
+def create_async_storage(backend):
+    """バックエンド名から AsyncMessageStorage を作る"""
+    try:
+        storage_class = ASYNC_STORAGE_BACKENDS[backend]
+    except KeyError:
+        raise ValueError(f"Unknown storage backend: {backend!r} (choose from {', '.join(ASYNC_STORAGE_BACKENDS)})")
+    return storage_class()
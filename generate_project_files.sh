@@ -149,7 +149,40 @@ cat << 'EOGF' > firebase.json
   }
 }
 EOGF
-touch firestore.indexes.json
+# firestore.indexes.json
+# list_rooms (参加ルームを更新の新しい順に取得) と search_messages (索引語を含むメッセージ / バケットを新しい順に取得) 用の複合インデックス
+cat << 'EOGF' > firestore.indexes.json
+{
+  "indexes": [
+    {
+      "collectionGroup": "chat_rooms",
+      "queryScope": "COLLECTION",
+      "fields": [
+        { "fieldPath": "participants", "arrayConfig": "CONTAINS" },
+        { "fieldPath": "updated_at", "order": "DESCENDING" }
+      ]
+    },
+    {
+      "collectionGroup": "messages",
+      "queryScope": "COLLECTION",
+      "fields": [
+        { "fieldPath": "search_terms", "arrayConfig": "CONTAINS" },
+        { "fieldPath": "timestamp", "order": "DESCENDING" },
+        { "fieldPath": "__name__", "order": "DESCENDING" }
+      ]
+    },
+    {
+      "collectionGroup": "message_buckets",
+      "queryScope": "COLLECTION",
+      "fields": [
+        { "fieldPath": "search_terms", "arrayConfig": "CONTAINS" },
+        { "fieldPath": "first_ts", "order": "DESCENDING" }
+      ]
+    }
+  ],
+  "fieldOverrides": []
+}
+EOGF
 
 # README.md (既に存在する場合は上書きされます)
 cat << 'EOGF' > README.md
@@ -165,7 +198,7 @@ Streamlit + Cloud Functions + Firestore + Google Login
 4.  **Edit Files:** Manually edit the following files with your specific values:
     *   `.github/workflows/deploy.yml`: Update `env` variables (`PROJECT_ID`, `REGION`, `SERVICE_NAME`, etc.) and **critically** the `workload_identity_provider` and `service_account` under the `auth` step. `CHAT_API_FUNCTION_URL` will be updated later.
     *   `streamlit_app/main.py`: Modify the default `ALLOWED_CHAT_PARTNERS` list or plan to set the environment variable.
-5.  **Deploy Firestore Rules:** Run `firebase deploy --only firestore:rules` (ensure `firebase login` and `firebase use <YOUR_GCP_PROJECT_ID>` are done).
+5.  **Deploy Firestore Rules:** Run `firebase deploy --only firestore:rules,firestore:indexes` (ensure `firebase login` and `firebase use <YOUR_GCP_PROJECT_ID>` are done).
 6.  **Deploy Cloud Function:** Run the `gcloud functions deploy ...` command (provided separately). **Copy the HTTPS Trigger URL.**
 7.  **Update Workflow:** Paste the copied Function URL into `.github/workflows/deploy.yml` for the `CHAT_API_FUNCTION_URL` variable.
 8.  **Git & Push:** Initialize a Git repository (if needed), add all files, commit, add your GitHub remote, and push.
@@ -231,9 +264,17 @@ jobs:
     - name: Install Firebase CLI
       run: npm install -g firebase-tools
     - name: Deploy Firestore Rules
-      run: firebase deploy --only firestore:rules --project ${{ env.PROJECT_ID }} --token ${{ steps.auth.outputs.access_token }} --non-interactive
+      run: firebase deploy --only firestore:rules,firestore:indexes --project ${{ env.PROJECT_ID }} --token ${{ steps.auth.outputs.access_token }} --non-interactive
 
     # --- Cloud Functions Deploy ---
+    - name: Set up Python
+      uses: actions/setup-python@v5
+      with:
+        python-version: '3.11'
+    - name: Check import-time budget (cold start)
+      run: |-
+        pip install -r ./cloud_functions/chat_api/requirements.txt
+        python benchmarks/import_time_check.py
     - name: Deploy Cloud Function (${{ env.FUNC_NAME }})
       id: deploy-function
       run: |-
@@ -253,6 +294,8 @@ jobs:
     - name: Get Cloud Function URL
       id: get-function-url
       run: echo "url=$(cat function_url.txt)" >> $GITHUB_OUTPUT
+    - name: Warm up Cloud Function
+      run: curl -fsS --retry 3 "$(cat function_url.txt)/warmup" || echo "Warmup request failed (ignored)"
 
     # --- Docker Build & Push ---
     - name: Set up Docker Buildx
@@ -5,6 +5,15 @@ import pytz
 import requests # requests をインポート
 import streamlit as st # st.session_state を使うため
 import json # JSON パース用
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .http_client import decode_response, latency_stats, post_action
+from .message_store import MessageStore
+from .message_stream import MessageStream
+from .outbox import Outbox
 
 # --- 定数 ---
 # デプロイした Cloud Functions の URL を環境変数から取得
@@ -16,6 +25,28 @@ if not FUNCTION_URL:
     # FUNCTION_URL = "http://localhost:8081" # ローカル Functions Emulator の URL
 
 jst = pytz.timezone('Asia/Tokyo')
+# compact 形式のフィールド名と通常のフィールド名の対応 (timestamp はエポックミリ秒の 't')
+COMPACT_MESSAGE_FIELDS = {
+    'i': 'id',
+    's': 'sender_email',
+    'r': 'receiver_email',
+    'c': 'content',
+}
+
+# ETag による条件付きリクエストを行うアクションと、セッションごとに保持する ETag の数
+CONDITIONAL_ACTIONS = {'get_messages'}
+ETAG_CACHE_MAX_ENTRIES = 50
+
+# 「過去のメッセージを読み込む」で 1 回に取得する件数
+OLDER_MESSAGES_PAGE_SIZE = 50
+# サイドバーのルーム一覧 (list_rooms) を再取得するまでの間隔 (秒)
+ROOM_LIST_REFRESH_SECONDS = 10
+# 変化のあったルームの先読みで 1 回の batch にまとめるルーム数 (Functions 側の BATCH_MAX_ITEMS 以下にする) と並列数
+PREFETCH_BATCH_SIZE = 20
+PREFETCH_MAX_WORKERS = 4
+
+# 先読みの batch 呼び出しを並列に実行するスレッドプール (プロセス内で共有)
+prefetch_executor = ThreadPoolExecutor(max_workers=PREFETCH_MAX_WORKERS, thread_name_prefix='room-prefetch')
 
 # --- ヘルパー関数 ---
 def get_id_token():
@@ -51,21 +82,32 @@ def call_function(action, payload):
         # get_id_token 内でエラー表示されるので、ここでは None を返すだけ
         return None
 
-    headers = {
-        'Authorization': f'Bearer {id_token}',
-        'Content-Type': 'application/json'
-    }
-    data = {'action': action, **payload}
+    # 条件付きリクエスト: 前回と同じ呼び出しなら ETag を送り、変化がなければ (304) 前回の応答を使う
+    etag_key = None
+    cached = None
+    headers = {}
+    if action in CONDITIONAL_ACTIONS:
+        etag_key = f"{action}:{json.dumps(payload, sort_keys=True)}"
+        cached = _get_etag_cache().get(etag_key)
+        if cached:
+            headers['If-None-Match'] = cached[0]
 
     print(f"Calling Cloud Function: {FUNCTION_URL} Action: {action}") # デバッグログ
     try:
-        response = requests.post(FUNCTION_URL, headers=headers, json=data, timeout=30) # タイムアウト設定
-        response.raise_for_status() # HTTPエラー (4xx, 5xx) があれば例外を発生させる
+        # プロセス内で共有するセッション (keep-alive) で送信。冪等なアクションは一時的なエラーをリトライする
+        response = post_action(FUNCTION_URL, id_token, action, payload, headers=headers)
 
         print(f"Cloud Function Response Status: {response.status_code}") # デバッグログ
+        if response.status_code == 304 and cached:
+            _get_etag_cache().move_to_end(etag_key)
+            # not_modified は呼び出し側で「保持済みの内容から変化なし」と判断するための目印
+            return {**cached[1], 'not_modified': True}
         # レスポンスボディが空の場合もあるのでチェック
         if response.content:
-            return response.json()
+            body = decode_response(response)
+            if etag_key and response.headers.get('ETag'):
+                _store_etag(etag_key, response.headers['ETag'], body)
+            return body
         else:
             # ボディが空でも成功 (2xx) の場合がある (例: send_message の 200 OK)
             return {"success": True, "message": "Action completed successfully (no content)"}
@@ -97,37 +139,351 @@ def call_function(action, payload):
         print(f"Error: Unexpected error during Cloud Function call for action {action}: {e}")
         return None
 
+def _get_etag_cache():
+    """このセッションの ETag キャッシュ (呼び出しキー -> (ETag, 応答ボディ))"""
+    if 'etag_cache' not in st.session_state:
+        st.session_state.etag_cache = OrderedDict()
+    return st.session_state.etag_cache
+
+def _store_etag(etag_key, etag, body):
+    etag_cache = _get_etag_cache()
+    etag_cache[etag_key] = (etag, body)
+    etag_cache.move_to_end(etag_key)
+    while len(etag_cache) > ETAG_CACHE_MAX_ENTRIES:
+        etag_cache.popitem(last=False)
+
+def get_api_latency_stats():
+    """このプロセスでの Cloud Functions 呼び出しの往復時間をアクションごとに返す"""
+    return latency_stats.snapshot()
+
+def call_function_batch(requests_list):
+    """複数のアクションを batch アクションで 1 回の呼び出しにまとめる
+
+    requests_list は {'action': ..., **payload} の辞書のリスト。
+    戻り値は同じ順序の {'status': HTTPステータス, 'body': レスポンス辞書} のリスト (呼び出し自体の失敗時は None)。
+    """
+    if not requests_list:
+        return []
+    response = call_function('batch', {'requests': requests_list})
+    if response and isinstance(response.get('results'), list) and len(response['results']) == len(requests_list):
+        return response['results']
+    if response:
+        print(f"Unexpected batch response: {response}")
+    return None
+
 # --- API 操作関数 (Functions 経由) ---
-def get_messages(room_id):
-    """Cloud Functions 経由でメッセージを取得"""
+def _parse_message_timestamp(msg):
+    """API から受け取ったメッセージに JST の datetime (timestamp_jst) を付与する"""
+    if isinstance(msg, dict) and 'timestamp' in msg and isinstance(msg['timestamp'], str):
+        try:
+            # ISOフォーマット文字列から timezone-aware な datetime オブジェクトに変換
+            utc_time = datetime.datetime.fromisoformat(msg['timestamp'])
+            # Functions は UTC で返すはずだが、念のため timezone 確認
+            if utc_time.tzinfo is None:
+                utc_time = pytz.utc.localize(utc_time)
+            # JST に変換して格納
+            msg['timestamp_jst'] = utc_time.astimezone(jst)
+        except (ValueError, TypeError) as e:
+            print(f"Timestamp parsing/conversion error: {e} for value {msg['timestamp']}")
+            msg['timestamp_jst'] = None # パース/変換失敗
+    else:
+         msg['timestamp_jst'] = None # タイムスタンプがないか形式が違う場合
+    return msg
+
+def _parse_messages(raw_messages):
+    """API から受け取ったメッセージのリストを、表示用の辞書 (timestamp_jst 付き) のリストに 1 回のループで変換する
+
+    compact 形式 (短いフィールド名、エポックミリ秒) の場合は、ISO 文字列をパースせずに
+    エポックミリ秒から直接 JST の datetime を作る。
+    """
+    messages = []
+    for msg in raw_messages:
+        if not isinstance(msg, dict):
+            continue
+        if 't' in msg or 'i' in msg: # compact 形式
+            expanded = {COMPACT_MESSAGE_FIELDS.get(key, key): value for key, value in msg.items() if key != 't'}
+            timestamp_ms = msg.get('t')
+            if isinstance(timestamp_ms, int):
+                expanded['timestamp_ms'] = timestamp_ms
+                expanded['timestamp_jst'] = datetime.datetime.fromtimestamp(timestamp_ms / 1000, jst)
+            else:
+                expanded['timestamp_jst'] = None
+            messages.append(expanded)
+        else:
+            messages.append(_parse_message_timestamp(msg))
+    return messages
+
+def get_message_store():
+    """このセッションのメッセージストアを返す (再実行をまたいで保持される)"""
+    if 'message_store' not in st.session_state:
+        st.session_state.message_store = MessageStore()
+    return st.session_state.message_store
+
+def _apply_messages_response(store, room_id, is_delta, response):
+    """get_messages の応答をストアに反映する"""
+    if is_delta and response.get('not_modified'):
+        # 差分取得で 304 なら、ストアはすでに最新 (パースも不要)
+        store.mark_fetched(room_id)
+        return
+    new_messages = _parse_messages(response['messages'])
+    if is_delta and response.get('cursor'):
+        store.merge_new(room_id, new_messages, response.get('cursor'))
+    else:
+        # 初回 (またはカーソル非対応の応答) は全体を置き換える
+        store.replace(room_id, new_messages, response.get('cursor'),
+                      response.get('older_cursor'), bool(response.get('has_older')))
+    store.mark_fetched(room_id)
+
+def get_messages(room_id, force_refresh=False):
+    """Cloud Functions 経由でメッセージを取得
+
+    セッション内のストアに保持しているメッセージを返す。前回の取得から REFRESH_INTERVAL_SECONDS が
+    経過したとき、送信後、または force_refresh=True のときだけ、前回のカーソルを since として送り
+    新着メッセージ (差分) を受け取ってストアへ追加する。戻り値は保持しているメッセージ全体 (古い順)。
+    """
     if not room_id:
         st.warning("チャットルームIDが指定されていません。")
         return []
-    response = call_function('get_messages', {'room_id': room_id})
-    if response and 'messages' in response and isinstance(response['messages'], list):
-        messages_data = []
-        for msg in response['messages']:
-            if isinstance(msg, dict) and 'timestamp' in msg and isinstance(msg['timestamp'], str):
-                try:
-                    # ISOフォーマット文字列から timezone-aware な datetime オブジェクトに変換
-                    utc_time = datetime.datetime.fromisoformat(msg['timestamp'])
-                    # Functions は UTC で返すはずだが、念のため timezone 確認
-                    if utc_time.tzinfo is None:
-                        utc_time = pytz.utc.localize(utc_time)
-                    # JST に変換して格納
-                    msg['timestamp_jst'] = utc_time.astimezone(jst)
-                except (ValueError, TypeError) as e:
-                    print(f"Timestamp parsing/conversion error: {e} for value {msg['timestamp']}")
-                    msg['timestamp_jst'] = None # パース/変換失敗
-            else:
-                 msg['timestamp_jst'] = None # タイムスタンプがないか形式が違う場合
+    store = get_message_store()
+    sync_outbox()
+    room_state = store.room(room_id)
+    stream = st.session_state.get('message_streams', {}).get(room_id)
+    if stream is not None and stream.alive and room_state['cursor']:
+        # ストリーム購読中は HTTP で取得し直さず、受信済みの新着だけをマージする
+        streamed, stream_cursor = stream.drain()
+        if streamed:
+            store.merge_new(room_id, _parse_messages(streamed), stream_cursor)
+        store.mark_fetched(room_id)
+        return store.messages(room_id)
+
+    if not (force_refresh or store.needs_refresh(room_id)):
+        return store.messages(room_id)
 
-            messages_data.append(msg)
-        return messages_data
+    payload = {'room_id': room_id}
+    if room_state['cursor']:
+        payload['since'] = room_state['cursor']
+    response = call_function('get_messages', payload)
+    if response and 'messages' in response and isinstance(response['messages'], list):
+        _apply_messages_response(store, room_id, 'since' in payload, response)
     elif response and response.get('error'):
         # call_function でエラー表示されるのでここではログのみ
         print(f"Error received from get_messages API: {response.get('error')}")
-    return [] # エラーまたはメッセージがない場合
+    # エラー時は保持しているメッセージ (なければ空リスト) を返す
+    return store.messages(room_id)
+
+def list_rooms(force_refresh=False):
+    """参加しているルームのサマリー (最新メッセージ・未読数) を room_id -> ルーム辞書 で返す
+
+    Functions 側のサマリードキュメントへの 1 回のクエリで、ルーム数に関わらず往復は 1 回で済む。
+    結果はセッションに保持し、ROOM_LIST_REFRESH_SECONDS ごと (または force_refresh 時) にだけ再取得する。
+    """
+    cached = st.session_state.get('room_list')
+    if cached and not force_refresh and time.monotonic() - cached['fetched_at'] < ROOM_LIST_REFRESH_SECONDS:
+        return cached['rooms']
+    response = call_function('list_rooms', {})
+    if response is None or not isinstance(response.get('rooms'), list):
+        # 取得に失敗した場合は前回の一覧を使い、次の再実行で取得し直す
+        return cached['rooms'] if cached else {}
+    rooms = {}
+    for room in response['rooms']:
+        if not isinstance(room, dict) or not room.get('room_id'):
+            continue
+        last_message = room.get('last_message')
+        room['last_message'] = _parse_messages([last_message])[0] if isinstance(last_message, dict) else None
+        rooms[room['room_id']] = room
+    st.session_state.room_list = {'fetched_at': time.monotonic(), 'rooms': rooms}
+    return rooms
+
+def prefetch_rooms(room_ids):
+    """ルーム一覧 (list_rooms) で変化のあったルームのメッセージを batch アクションでまとめて取得し、ストアを温めておく
+
+    サマリーの最新メッセージが保持している最新メッセージと異なるルーム (新着・未読がある、またはまだ読み込んで
+    いないルーム) だけを PREFETCH_BATCH_SIZE 件ずつの batch にまとめ、batch 同士は並列に送る。未読があっても
+    最新メッセージを保持済みのルームは読まない。ルームを切り替えた直後は先読み済みのメッセージですぐ表示できる。
+    """
+    store = get_message_store()
+    streams = st.session_state.get('message_streams', {})
+    rooms = list_rooms()
+    items = []
+    for room_id in room_ids:
+        room = rooms.get(room_id)
+        stream = streams.get(room_id)
+        if room is None or not room.get('last_message') or (stream is not None and stream.alive):
+            continue # メッセージのないルームと、ストリーム購読中のルーム (get_messages 側で反映される) は読まない
+        latest_message = store.latest_message(room_id)
+        if latest_message is not None and latest_message.get('id') == room['last_message'].get('id'):
+            continue
+        item = {'action': 'get_messages', 'room_id': room_id}
+        if store.room(room_id)['cursor']:
+            item['since'] = store.room(room_id)['cursor']
+        items.append(item)
+    if not items or not FUNCTION_URL:
+        return
+    id_token = get_id_token()
+    if not id_token:
+        return
+
+    # スレッドからは st.session_state に触れないため、HTTP 呼び出しだけを並列にし、結果の反映はここで行う
+    chunks = [items[i:i + PREFETCH_BATCH_SIZE] for i in range(0, len(items), PREFETCH_BATCH_SIZE)]
+    futures = [prefetch_executor.submit(post_action, FUNCTION_URL, id_token, 'batch', {'requests': chunk}) for chunk in chunks]
+    for chunk, future in zip(chunks, futures):
+        try:
+            results = decode_response(future.result()).get('results') or []
+        except Exception as e:
+            # 先読みの失敗は表示に影響させない (選択したルームは通常の取得で読み込まれる)
+            print(f"Room prefetch failed: {e}")
+            continue
+        for item, result in zip(chunk, results):
+            body = result.get('body') if isinstance(result, dict) else None
+            if result.get('status') == 200 and isinstance(body, dict) and isinstance(body.get('messages'), list):
+                _apply_messages_response(store, item['room_id'], 'since' in item, body)
+            else:
+                print(f"Room prefetch failed for {item['room_id']}: {result}")
+
+def get_room_summary(room_id, my_email):
+    """サイドバー表示用に、最新メッセージと未読数を返す
+
+    未読数はルーム一覧 (サーバー側のサマリー) の値を使う。最新メッセージは、このセッションで
+    読み込んだメッセージの方が新しければそちらを使う (送信直後など、一覧の再取得前でも反映される)。
+    """
+    store = get_message_store()
+    room = list_rooms().get(room_id)
+    latest_message = store.latest_message(room_id)
+    if room is not None and room.get('last_message'):
+        summary_message = room['last_message']
+        if latest_message is None or (summary_message.get('timestamp_jst') and latest_message.get('timestamp_jst')
+                                       and summary_message['timestamp_jst'] > latest_message['timestamp_jst']):
+            latest_message = summary_message
+    return {
+        'latest_message': latest_message,
+        'unread_count': room.get('unread_count', 0) if room is not None else store.unread_count(room_id, my_email),
+    }
+
+def mark_room_seen(room_id):
+    """ルームのメッセージを表示したことを記録する (未読数を 0 にする)
+
+    サーバー側の未読数が残っている場合だけ mark_room_read を呼ぶ (表示のたびには呼ばない)。
+    """
+    get_message_store().mark_seen(room_id)
+    room = st.session_state.get('room_list', {}).get('rooms', {}).get(room_id)
+    if room is not None and room.get('unread_count'):
+        response = call_function('mark_room_read', {'room_id': room_id})
+        if response is not None and response.get('success'):
+            room['unread_count'] = 0
+
+def ensure_message_stream(room_id):
+    """ルームの新着メッセージのストリーム購読を (未開始なら) 開始する
+
+    購読中は get_messages が HTTP で再取得せず、ストリームで受け取った新着だけをマージする。
+    他のルームのストリームは停止する。開始できなかった場合は False (通常の取得にフォールバック)。
+    ID トークンの期限切れ (401) で停止したストリームは、トークンが更新されていれば新しいトークンで作り直す。
+    """
+    streams = st.session_state.setdefault('message_streams', {})
+    for other_room_id in [key for key in streams if key != room_id]:
+        streams.pop(other_room_id).stop()
+
+    stream = streams.get(room_id)
+    if stream is not None and stream.alive:
+        return True
+    room_state = get_message_store().room(room_id)
+    id_token = get_id_token()
+    if stream is not None and stream.error:
+        if stream.error_status != 401 or id_token == stream.id_token:
+            return False # 権限エラー、または同じトークンで 401 になったストリームは再開しない
+        streams.pop(room_id) # 更新されたトークンで下で作り直す (カーソルはストアのものから再開する)
+    # 最初の 1 回は通常の取得でカーソルを得てから購読する
+    if not FUNCTION_URL or not id_token or not room_state['cursor']:
+        return False
+    streams[room_id] = MessageStream(FUNCTION_URL, id_token, room_id, since=room_state['cursor']).start()
+    return True
+
+def stop_message_streams():
+    """このセッションのストリーム購読をすべて停止する"""
+    for stream in st.session_state.pop('message_streams', {}).values():
+        stream.stop()
+
+def has_older_messages(room_id):
+    """保持しているメッセージより古いメッセージが (おそらく) サーバーに残っているか"""
+    return get_message_store().has_older(room_id)
+
+def get_older_messages(room_id, page_size=OLDER_MESSAGES_PAGE_SIZE):
+    """保持している最も古いメッセージより前のページを取得し、先頭に追加する
+
+    戻り値は今回追加したメッセージ数。
+    """
+    store = get_message_store()
+    if not store.has_older(room_id):
+        return 0
+    response = call_function('get_messages', {
+        'room_id': room_id,
+        'before': store.room(room_id)['older_cursor'],
+        'limit': page_size,
+    })
+    if not (response and isinstance(response.get('messages'), list)):
+        if response and response.get('error'):
+            print(f"Error received from get_messages API (before): {response.get('error')}")
+        return 0
+    older_messages = _parse_messages(response['messages'])
+    return store.prepend_older(room_id, older_messages, response.get('older_cursor'), bool(response.get('has_older')))
+
+def get_outbox():
+    """このセッションの送信箱を返す"""
+    if 'outbox' not in st.session_state:
+        st.session_state.outbox = Outbox(FUNCTION_URL)
+    return st.session_state.outbox
+
+def enqueue_message(room_id, receiver_email, content):
+    """メッセージを送信箱に入れてすぐに戻る (送信はバックグラウンドで行われる)
+
+    送信待ちの間は get_pending_messages で「送信中」として表示できる。送信が確認されると、
+    同じ batch で取得した差分がストアに反映され、送信待ちから取り除かれる。
+    """
+    if not all([room_id, receiver_email, content]):
+         st.error("メッセージの送信に必要な情報が不足しています。")
+         return False
+    if not FUNCTION_URL:
+        st.error("Cloud Functions の URL が設定されていません。")
+        return False
+    id_token = get_id_token()
+    if not id_token:
+        return False
+    since = get_message_store().room(room_id)['cursor']
+    get_outbox().enqueue(room_id, receiver_email, content, id_token, since=since)
+    return True
+
+def sync_outbox():
+    """送信箱のワーカーが受け取った結果 (送信後の差分) をストアに反映する"""
+    if 'outbox' not in st.session_state:
+        return
+    store = get_message_store()
+    for room_id, since, body in get_outbox().drain_results():
+        if body is None or not isinstance(body.get('messages'), list):
+            # 差分取得に失敗した場合は次回の get_messages で取得し直す
+            store.invalidate(room_id)
+        elif store.room(room_id)['cursor'] == since:
+            _apply_messages_response(store, room_id, bool(since), body)
+        else:
+            # その間にストリームなどでカーソルが進んでいた場合は、カーソルを戻さずにメッセージだけを追加する
+            store.merge_new(room_id, _parse_messages(body['messages']))
+
+def get_pending_messages(room_id):
+    """表示用: ルームの送信待ち (送信中・送信失敗) メッセージを古い順に返す"""
+    if 'outbox' not in st.session_state:
+        return []
+    pending = get_outbox().pending(room_id)
+    for entry in pending:
+        entry['timestamp_jst'] = entry['created_at'].astimezone(jst)
+    return pending
+
+def retry_pending_message(client_id):
+    """送信に失敗したメッセージを再送する"""
+    id_token = get_id_token()
+    if id_token:
+        get_outbox().retry(client_id, id_token)
+
+def discard_pending_message(client_id):
+    """送信に失敗したメッセージを送信箱から取り除く"""
+    get_outbox().discard(client_id)
 
 def send_message(room_id, receiver_email, content):
     """Cloud Functions 経由でメッセージを送信"""
@@ -136,6 +492,7 @@ def send_message(room_id, receiver_email, content):
          return False
 
     payload = {
+        'message_id': uuid.uuid4().hex, # 冪等キー: タイムアウト後にリトライしても二重に保存されない
         'room_id': room_id,
         'receiver_email': receiver_email,
         'content': content
@@ -144,7 +501,10 @@ def send_message(room_id, receiver_email, content):
     response = call_function('send_message', payload)
     # 成功レスポンスは {'success': True} またはボディなしの 200 OK を期待
     success = response is not None and response.get('success', False)
-    if not success:
+    if success:
+        # 送信したメッセージを次回の get_messages で取得させる
+        get_message_store().invalidate(room_id)
+    else:
         print(f"Failed to send message via API. Response: {response}")
     return success
 
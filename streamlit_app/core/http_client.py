@@ -0,0 +1,228 @@
+import random
+import threading
+import time
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# MessagePack 形式のレスポンス用 (任意。インストールされていなければ compact JSON を要求する)
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# --- 定数 ---
+# コネクションプールの設定 (Streamlit のセッションはすべて同じプロセスで動くため、プールはプロセス内で共有する)
+HTTP_POOL_CONNECTIONS = 4
+HTTP_POOL_MAXSIZE = 16
+# 接続タイムアウトと読み込みタイムアウト (秒)。接続は速く諦め、Functions のコールドスタートは読み込み側で待つ
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 30
+
+# リトライ設定
+RETRY_MAX_ATTEMPTS = 3 # 初回を含む最大試行回数
+RETRY_BASE_DELAY = 0.25 # 指数バックオフの基準 (秒)
+RETRY_MAX_DELAY = 4.0 # 1 回の待ち時間の上限 (秒)。Retry-After もこの値で切り詰める
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}
+# リトライしても副作用が重複しないアクション (send_message は message_id 付きの場合のみ。is_idempotent を参照)
+IDEMPOTENT_ACTIONS = {'get_messages', 'stats'}
+# リトライ予算: リクエスト 1 件ごとに RETRY_BUDGET_RATIO 回分が貯まり、リトライ 1 回で 1 消費する
+# 障害時にリトライで負荷を増幅させないため、リトライ数をリクエスト数の一定割合に抑える
+RETRY_BUDGET_RATIO = 0.1
+RETRY_BUDGET_MIN_TOKENS = 5
+RETRY_BUDGET_MAX_TOKENS = 20
+
+# レスポンス形式 (Cloud Functions 側の CONTENT_TYPE_* と合わせる)
+# compact 形式はフィールド名が短く、timestamp がエポックミリ秒の整数になる
+CONTENT_TYPE_COMPACT_JSON = 'application/vnd.securechat.compact+json'
+CONTENT_TYPE_MSGPACK = 'application/x-msgpack'
+if msgpack is not None:
+    ACCEPT_HEADER = f'{CONTENT_TYPE_MSGPACK}, {CONTENT_TYPE_COMPACT_JSON};q=0.9, application/json;q=0.5'
+else:
+    ACCEPT_HEADER = f'{CONTENT_TYPE_COMPACT_JSON}, application/json;q=0.5'
+
+
+def _create_session():
+    """keep-alive とコネクションプールを有効にしたセッションを作る (リトライは post_action 側で制御する)"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_CONNECTIONS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+http_session = _create_session()
+
+
+class RetryBudget:
+    """リトライ回数を通常リクエスト数の一定割合に制限するトークンバケット"""
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, min_tokens=RETRY_BUDGET_MIN_TOKENS,
+                 max_tokens=RETRY_BUDGET_MAX_TOKENS):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = float(min_tokens)
+        self._lock = threading.Lock()
+
+    def record_request(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def try_acquire(self):
+        """リトライしてよければ 1 消費して True"""
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+retry_budget = RetryBudget()
+
+
+class LatencyStats:
+    """アクションごとの呼び出し回数と往復時間 (ミリ秒) を集計する
+
+    レスポンスに Server-Timing があれば、サーバー側の処理時間と直近のフェーズ内訳も合わせて記録する
+    (往復時間との差がネットワークとキューイングの時間)。
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def record(self, action, latency_ms, ok, server_timing=None):
+        with self._lock:
+            stat = self._stats.setdefault(action, {
+                'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'last_ms': 0.0,
+                'server_count': 0, 'server_total_ms': 0.0, 'last_server_phases': {},
+            })
+            stat['count'] += 1
+            stat['errors'] += 0 if ok else 1
+            stat['total_ms'] += latency_ms
+            stat['max_ms'] = max(stat['max_ms'], latency_ms)
+            stat['last_ms'] = latency_ms
+            if server_timing and 'total' in server_timing:
+                stat['server_count'] += 1
+                stat['server_total_ms'] += server_timing['total']
+                stat['last_server_phases'] = dict(server_timing)
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = {}
+            for action, stat in self._stats.items():
+                avg_server_ms = stat['server_total_ms'] / stat['server_count'] if stat['server_count'] else None
+                snapshot[action] = {
+                    **stat,
+                    'last_server_phases': dict(stat['last_server_phases']),
+                    'avg_ms': stat['total_ms'] / stat['count'] if stat['count'] else 0.0,
+                    'avg_server_ms': avg_server_ms,
+                }
+            return snapshot
+
+latency_stats = LatencyStats()
+
+
+def is_idempotent(action, payload):
+    """リトライしてよいアクションか (batch は全サブアクションが冪等な場合のみ)
+
+    send_message は message_id (冪等キー) を付けた場合、Functions 側で再送が重複排除されるためリトライできる。
+    """
+    if action == 'batch':
+        items = payload.get('requests') or []
+        return all(isinstance(item, dict) and is_idempotent(item.get('action'), item) for item in items)
+    if action == 'send_message':
+        return bool(payload.get('message_id'))
+    return action in IDEMPOTENT_ACTIONS
+
+
+def _retry_delay(attempt, response=None):
+    """jitter 付き指数バックオフの待ち時間。429/503 の Retry-After があればそれを優先する"""
+    if response is not None:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            try:
+                return min(RETRY_MAX_DELAY, max(0.0, float(retry_after)))
+            except ValueError:
+                pass # HTTP-date 形式は無視してバックオフを使う
+    # full jitter: 0 から上限までの一様乱数
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** attempt)))
+
+
+def parse_server_timing(header_value):
+    """Server-Timing ヘッダーを {フェーズ名: ミリ秒} に変換する (dur の無いメトリクスは無視)"""
+    phases = {}
+    for metric in (header_value or '').split(','):
+        name, *params = [part.strip() for part in metric.split(';')]
+        for param in params:
+            if param.startswith('dur='):
+                try:
+                    phases[name] = float(param[len('dur='):])
+                except ValueError:
+                    pass
+    return phases
+
+
+def post_action(function_url, id_token, action, payload, headers=None):
+    """Cloud Functions にアクションを POST し、requests.Response を返す
+
+    Streamlit に依存しないため、バックグラウンドスレッドからも呼べる。
+    冪等なアクションは接続エラー・タイムアウト・429/5xx の一部をリトライする (リトライ予算の範囲内)。
+    最終的な失敗は requests の例外 (HTTPError を含む) として送出する。
+    X-Request-ID を付けて送るので、往復時間のログと Functions 側の構造化ログを突き合わせられる。
+    """
+    request_id = uuid.uuid4().hex
+    request_headers = {
+        'Authorization': f'Bearer {id_token}',
+        'Content-Type': 'application/json',
+        'Accept': ACCEPT_HEADER,
+        'X-Request-ID': request_id,
+        **(headers or {}),
+    }
+    data = {'action': action, **payload}
+    retryable = is_idempotent(action, payload)
+    retry_budget.record_request()
+
+    started_at = time.perf_counter()
+    attempt = 0
+    while True:
+        attempt += 1
+        response = None
+        try:
+            response = http_session.post(function_url, headers=request_headers, json=data,
+                                         timeout=(HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+            if response.status_code not in RETRYABLE_STATUS_CODES:
+                response.raise_for_status() # HTTPエラー (4xx, 5xx) があれば例外を発生させる
+                break
+            error = requests.exceptions.HTTPError(f"{response.status_code} Error for action {action}", response=response)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            error = e
+        except requests.exceptions.HTTPError:
+            _record_latency(action, started_at, attempt, ok=False, request_id=request_id, response=response)
+            raise
+
+        if not retryable or attempt >= RETRY_MAX_ATTEMPTS or not retry_budget.try_acquire():
+            _record_latency(action, started_at, attempt, ok=False, request_id=request_id, response=response)
+            raise error
+        delay = _retry_delay(attempt, response)
+        print(f"Retrying action {action} (attempt {attempt + 1}/{RETRY_MAX_ATTEMPTS}) in {delay:.2f}s: {error}")
+        time.sleep(delay)
+
+    _record_latency(action, started_at, attempt, ok=True, request_id=request_id, response=response)
+    return response
+
+
+def decode_response(response):
+    """レスポンスの Content-Type に応じてボディを辞書に変換する (compact 形式のフィールド名はそのまま)"""
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+    if content_type == CONTENT_TYPE_MSGPACK and msgpack is not None:
+        return msgpack.unpackb(response.content, raw=False)
+    return response.json() # application/json と compact JSON
+
+
+def _record_latency(action, started_at, attempts, ok, request_id=None, response=None):
+    latency_ms = (time.perf_counter() - started_at) * 1000
+    server_timing = parse_server_timing(response.headers.get('Server-Timing')) if response is not None else {}
+    latency_stats.record(action, latency_ms, ok, server_timing)
+    server_phases = ' '.join(f"{name}={duration:.1f}" for name, duration in server_timing.items())
+    print(f"Cloud Function call action={action} request_id={request_id} ok={ok} attempts={attempts} "
+          f"latency_ms={latency_ms:.1f} server_ms=[{server_phases or '-'}]")
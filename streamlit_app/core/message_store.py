@@ -0,0 +1,184 @@
+import datetime
+import time
+from collections import OrderedDict
+
+# --- 定数 ---
+# 1 ルームで保持するメッセージ数の上限 (新着の追加で超えた分は古い側から捨てる)
+MAX_MESSAGES_PER_ROOM = 500
+# セッション全体で保持するメッセージ数の上限 (超えたら最も古く参照されたルームから捨てる)
+MAX_MESSAGES_TOTAL = 2000
+# 自動で再取得するまでの間隔 (秒)。この間の再実行では保持済みのメッセージをそのまま使う
+REFRESH_INTERVAL_SECONDS = 10
+
+
+def message_cursor(msg):
+    """メッセージから Functions と同じ形式のカーソル ("ISO形式タイムスタンプ|ID") を作る
+
+    過去ページ取得 (before) の基準として使う。compact 形式で受け取ったメッセージはミリ秒単位の
+    タイムスタンプしか持たないため、そのミリ秒の末尾に切り上げる (基準のメッセージ自体が再取得されることはあるが、
+    ID で重複排除されるので取りこぼしよりは安全)。
+    """
+    if not msg.get('id'):
+        return None
+    if isinstance(msg.get('timestamp'), str):
+        return f"{msg['timestamp']}|{msg['id']}"
+    if isinstance(msg.get('timestamp_ms'), int):
+        timestamp = datetime.datetime.fromtimestamp(msg['timestamp_ms'] // 1000, datetime.timezone.utc)
+        timestamp += datetime.timedelta(microseconds=(msg['timestamp_ms'] % 1000) * 1000 + 999)
+        return f"{timestamp.isoformat()}|{msg['id']}"
+    return None
+
+
+class MessageStore:
+    """セッション内でルームごとのメッセージ (タイムスタンプ変換済み) とカーソルを保持するストア
+
+    st.session_state に 1 つ置いて Streamlit の再実行をまたいで使う。
+    再取得は一定間隔ごと、または invalidate() 後 (送信直後など) にだけ行い、それ以外の再実行では
+    API 呼び出しもタイムスタンプの変換も行わない。保持するメッセージ数はルーム単位とセッション全体で制限する。
+    """
+
+    def __init__(self, max_messages_per_room=MAX_MESSAGES_PER_ROOM, max_messages_total=MAX_MESSAGES_TOTAL,
+                 refresh_interval_seconds=REFRESH_INTERVAL_SECONDS):
+        self.max_messages_per_room = max_messages_per_room
+        self.max_messages_total = max_messages_total
+        self.refresh_interval_seconds = refresh_interval_seconds
+        self._rooms = OrderedDict() # room_id -> ルームの状態 (最後に参照したルームが末尾)
+
+    def room(self, room_id):
+        """ルームの状態 (messages, cursor, older_cursor, has_older, fetched_at, stale) を返す"""
+        state = self._rooms.get(room_id)
+        if state is None:
+            state = {
+                'messages': [],
+                'cursor': None, # 新着の差分取得 (since) に使うカーソル
+                'older_cursor': None, # 過去ページの取得 (before) に使うカーソル
+                'has_older': False,
+                'fetched_at': None, # 最後にサーバーから取得した時刻 (time.monotonic)
+                'stale': True, # True なら次回の get_messages で必ず再取得する
+                'last_seen_id': None, # 最後に画面に表示した時点の最新メッセージ ID (未読数の基準)
+            }
+            self._rooms[room_id] = state
+        self._rooms.move_to_end(room_id)
+        return state
+
+    def messages(self, room_id):
+        return list(self.room(room_id)['messages'])
+
+    def needs_refresh(self, room_id):
+        state = self.room(room_id)
+        if state['stale'] or state['fetched_at'] is None:
+            return True
+        return time.monotonic() - state['fetched_at'] >= self.refresh_interval_seconds
+
+    def invalidate(self, room_id):
+        """次回の get_messages で再取得させる (送信後など)"""
+        self.room(room_id)['stale'] = True
+
+    def mark_fetched(self, room_id):
+        state = self.room(room_id)
+        state['fetched_at'] = time.monotonic()
+        state['stale'] = False
+
+    def replace(self, room_id, messages, cursor, older_cursor, has_older):
+        """最新ページでルームのメッセージを置き換える (初回取得時)"""
+        state = self.room(room_id)
+        state['messages'] = list(messages)
+        state['cursor'] = cursor
+        state['older_cursor'] = older_cursor
+        state['has_older'] = has_older
+        if state['last_seen_id'] is None:
+            # 初めて読み込んだ時点のメッセージは未読に数えない ('' は「空のルームを読み込んだ」の意味)
+            state['last_seen_id'] = state['messages'][-1].get('id') if state['messages'] else ''
+        self._trim_room(state)
+        self._enforce_total_limit()
+
+    def merge_new(self, room_id, new_messages, cursor=None):
+        """新着メッセージ (差分) を末尾に追加する。戻り値は実際に追加した件数"""
+        state = self.room(room_id)
+        # 再送などで重複した ID は除外
+        known_ids = {msg.get('id') for msg in state['messages']}
+        added = [msg for msg in new_messages if msg.get('id') not in known_ids]
+        state['messages'].extend(added)
+        if cursor:
+            state['cursor'] = cursor
+        self._trim_room(state)
+        self._enforce_total_limit()
+        return len(added)
+
+    def prepend_older(self, room_id, older_messages, older_cursor, has_older):
+        """過去ページを先頭に追加する
+
+        明示的に遡ったメッセージはルーム単位の上限を超えても保持する (セッション全体の上限は適用する)。
+        """
+        state = self.room(room_id)
+        known_ids = {msg.get('id') for msg in state['messages']}
+        added = [msg for msg in older_messages if msg.get('id') not in known_ids]
+        state['messages'][:0] = added
+        state['older_cursor'] = older_cursor
+        state['has_older'] = has_older
+        self._enforce_total_limit()
+        return len(added)
+
+    def mark_seen(self, room_id):
+        """ルームのメッセージを表示したことを記録する (未読数を 0 にする)"""
+        state = self.room(room_id)
+        state['last_seen_id'] = state['messages'][-1].get('id') if state['messages'] else ''
+
+    def unread_count(self, room_id, my_email):
+        """最後に表示した後に届いた、相手からのメッセージ数
+
+        基準のメッセージが保持範囲外に出た場合は、保持している相手のメッセージをすべて未読とみなす。
+        ルームの状態を参照しても LRU の順序は変えない。
+        """
+        state = self._rooms.get(room_id)
+        if state is None or state['last_seen_id'] is None:
+            return 0
+        my_email = (my_email or '').lower()
+        count = 0
+        for msg in reversed(state['messages']):
+            if msg.get('id') == state['last_seen_id']:
+                break
+            if (msg.get('sender_email') or '').lower() != my_email:
+                count += 1
+        return count
+
+    def latest_message(self, room_id):
+        """保持している最新のメッセージ (なければ None)。LRU の順序は変えない"""
+        state = self._rooms.get(room_id)
+        if state is None or not state['messages']:
+            return None
+        return state['messages'][-1]
+
+    def has_older(self, room_id):
+        state = self.room(room_id)
+        return state['has_older'] and bool(state['older_cursor'])
+
+    def _trim_room(self, state):
+        if len(state['messages']) > self.max_messages_per_room:
+            self._drop_oldest(state, len(state['messages']) - self.max_messages_per_room)
+
+    @staticmethod
+    def _drop_oldest(state, count):
+        # 古い側を切り捨てた場合は、切り捨てた分を「過去のメッセージ」として再取得できるようにする
+        del state['messages'][:count]
+        state['older_cursor'] = message_cursor(state['messages'][0]) if state['messages'] else None
+        state['has_older'] = state['older_cursor'] is not None
+
+    def _enforce_total_limit(self):
+        """セッション全体の上限を超えた分を、最も古く参照されたルームから捨てる (現在のルームは残す)"""
+        total = sum(len(state['messages']) for state in self._rooms.values())
+        for room_id in list(self._rooms)[:-1]:
+            if total <= self.max_messages_total:
+                return
+            total -= len(self._rooms.pop(room_id)['messages'])
+        if total > self.max_messages_total:
+            # 現在のルームだけで上限を超える場合は、その古い側を捨てる
+            current = next(reversed(self._rooms.values()))
+            self._drop_oldest(current, total - self.max_messages_total)
+
+    def stats(self):
+        return {
+            'rooms': len(self._rooms),
+            'messages': sum(len(state['messages']) for state in self._rooms.values()),
+            'max_messages_total': self.max_messages_total,
+        }
@@ -0,0 +1,131 @@
+import json
+import queue
+import threading
+import time
+
+import requests
+
+# --- 定数 ---
+# 接続タイムアウトと読み込みタイムアウト (秒)。読み込みはサーバーのハートビート間隔 (15秒) より長くする
+STREAM_CONNECT_TIMEOUT = 5
+STREAM_READ_TIMEOUT = 45
+# 切断後に再接続するまでの待ち時間 (秒)
+STREAM_RECONNECT_DELAY = 3
+# この秒数以上バッファが読み出されなければ、セッションが閉じられたとみなしてストリームを止める
+STREAM_IDLE_TIMEOUT = 120
+
+
+def _retry_after_seconds(response):
+    """Retry-After ヘッダー (秒数) を返す (無い・解釈できない場合は 0)"""
+    try:
+        return max(0.0, float(response.headers.get('Retry-After', 0)))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class MessageStream:
+    """Cloud Functions の /stream (Server-Sent Events) をバックグラウンドスレッドで購読する
+
+    受け取った新着メッセージはスレッドセーフなキューにたまり、Streamlit のスクリプト側で drain() して使う。
+    スレッドからは st.session_state などに触れないため、URL やトークンはすべて引数で受け取る。
+    """
+
+    def __init__(self, function_url, id_token, room_id, since=None, session=None):
+        self.stream_url = function_url.rstrip('/') + '/stream'
+        self.id_token = id_token
+        self.room_id = room_id
+        self.cursor = since
+        self.session = session or requests.Session()
+        self.error = None # 致命的なエラー (認証切れなど) で停止した場合の内容
+        self.error_status = None # 停止の原因になった HTTP ステータス (401 ならトークンを更新して再開できる)
+        self._pending = queue.Queue()
+        self._stop_event = threading.Event()
+        self._last_drained_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name=f"message-stream-{room_id}", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+
+    @property
+    def alive(self):
+        return self._thread.is_alive() and not self._stop_event.is_set()
+
+    def drain(self):
+        """これまでに受け取った新着メッセージ (古い順) と最新のカーソルを返す"""
+        self._last_drained_at = time.monotonic()
+        messages = []
+        while True:
+            try:
+                messages.extend(self._pending.get_nowait())
+            except queue.Empty:
+                break
+        return messages, self.cursor
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            if time.monotonic() - self._last_drained_at > STREAM_IDLE_TIMEOUT:
+                print(f"Message stream for {self.room_id} idle, stopping.")
+                break
+            delay = STREAM_RECONNECT_DELAY
+            try:
+                self._consume_once()
+            except requests.exceptions.HTTPError as e:
+                status = e.response.status_code if e.response is not None else None
+                if status in (400, 401, 403):
+                    # 認証切れ・権限エラーは同じトークンで再接続しても回復しないので停止
+                    # (呼び出し側は 401 なら新しいトークンで作り直し、それ以外は通常の取得に戻る)
+                    self.error = f"HTTP {status}"
+                    self.error_status = status
+                    print(f"Message stream for {self.room_id} stopped: HTTP {status}")
+                    break
+                if status in (429, 503):
+                    # レート制限・ストリーム数の上限: サーバーが指定した時間は再接続しない
+                    delay = max(delay, _retry_after_seconds(e.response))
+                print(f"Message stream for {self.room_id} HTTP error: {e}")
+            except requests.exceptions.RequestException as e:
+                print(f"Message stream for {self.room_id} disconnected: {e}")
+            self._stop_event.wait(delay)
+        self._stop_event.set()
+
+    def _consume_once(self):
+        """1 本の SSE 接続を最後まで読み、受け取ったイベントを処理する"""
+        params = {'room_id': self.room_id}
+        if self.cursor:
+            params['since'] = self.cursor
+        headers = {'Authorization': f'Bearer {self.id_token}', 'Accept': 'text/event-stream'}
+        with self.session.get(self.stream_url, params=params, headers=headers, stream=True,
+                              timeout=(STREAM_CONNECT_TIMEOUT, STREAM_READ_TIMEOUT)) as response:
+            response.raise_for_status()
+            event, data_lines = None, []
+            for line in response.iter_lines(decode_unicode=True):
+                if self._stop_event.is_set():
+                    return
+                if line is None:
+                    continue
+                if line == '':
+                    # 空行でイベントが確定する
+                    if data_lines:
+                        self._handle_event(event or 'message', '\n'.join(data_lines))
+                    event, data_lines = None, []
+                elif line.startswith(':'):
+                    continue # ハートビート (コメント行)
+                elif line.startswith('event:'):
+                    event = line[len('event:'):].strip()
+                elif line.startswith('data:'):
+                    data_lines.append(line[len('data:'):].lstrip())
+
+    def _handle_event(self, event, data):
+        try:
+            payload = json.loads(data)
+        except json.JSONDecodeError:
+            print(f"Invalid SSE data for {self.room_id}: {data[:100]}")
+            return
+        if event == 'messages' and isinstance(payload.get('messages'), list):
+            self._pending.put([msg for msg in payload['messages'] if isinstance(msg, dict)])
+        # カーソルはメッセージをキューに入れた後で進める (drain() で取りこぼさないため)
+        if payload.get('cursor'):
+            self.cursor = payload['cursor']
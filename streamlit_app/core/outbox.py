@@ -0,0 +1,156 @@
+import datetime
+import threading
+import time
+import uuid
+
+from .http_client import decode_response, post_action
+
+# --- 定数 ---
+# 連続した送信を 1 回の batch にまとめるために待つ時間 (秒)
+OUTBOX_COALESCE_SECONDS = 0.15
+# 1 回の batch で送るメッセージ数の上限 (再取得の get_messages と合わせて Functions 側の BATCH_MAX_ITEMS 以下にする)
+OUTBOX_MAX_BATCH_MESSAGES = 10
+# 送信待ちがない状態がこの秒数続いたらワーカースレッドを終了する (次の送信時に再開する)
+OUTBOX_WORKER_IDLE_SECONDS = 60
+
+
+class Outbox:
+    """送信待ちメッセージを保持し、バックグラウンドスレッドでまとめて送信する送信箱
+
+    enqueue() はすぐに戻り、メッセージは「送信中」として画面に表示できる。ワーカーは短時間に
+    積まれた送信を 1 つの batch (送信 + 送信先ルームの差分取得) にまとめて送り、結果を drain_results() で
+    Streamlit のスクリプト側に渡す。スレッドからは st.session_state に触れない。
+    """
+
+    def __init__(self, function_url):
+        self.function_url = function_url
+        self._entries = {} # client_id -> 送信待ちエントリ (送信中・失敗・確認済みを含む)
+        self._queue = [] # 送信待ちのエントリ
+        self._results = [] # (room_id, 差分取得に使った since, get_messages の応答ボディ または None) のリスト
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def enqueue(self, room_id, receiver_email, content, id_token, since=None):
+        """メッセージを送信待ちに追加し、表示用のエントリを返す"""
+        entry = {
+            'client_id': uuid.uuid4().hex,
+            'room_id': room_id,
+            'receiver_email': receiver_email,
+            'content': content,
+            'created_at': datetime.datetime.now(datetime.timezone.utc),
+            'status': 'pending', # pending -> sending -> acked (確認済み) / failed
+            'error': None,
+            'id_token': id_token,
+            'since': since, # 送信後の差分取得に使うカーソル
+        }
+        with self._condition:
+            self._entries[entry['client_id']] = entry
+            self._queue.append(entry)
+            self._ensure_worker()
+            self._condition.notify()
+        return entry
+
+    def retry(self, client_id, id_token):
+        """送信に失敗したエントリを再送する (同じ client_id を使うので、実は保存済みだった場合も重複しない)"""
+        with self._condition:
+            entry = self._entries.get(client_id)
+            if entry is None or entry['status'] != 'failed':
+                return
+            entry.update(status='pending', error=None, id_token=id_token)
+            self._queue.append(entry)
+            self._ensure_worker()
+            self._condition.notify()
+
+    def discard(self, client_id):
+        with self._condition:
+            entry = self._entries.get(client_id)
+            if entry is not None and entry['status'] == 'failed':
+                del self._entries[client_id]
+
+    def pending(self, room_id):
+        """表示用: ルームの未確認 (送信待ち・送信中・失敗) エントリを古い順に返す"""
+        with self._condition:
+            return [dict(entry) for entry in self._entries.values()
+                    if entry['room_id'] == room_id and entry['status'] != 'acked']
+
+    def drain_results(self):
+        """ワーカーが受け取った差分取得の結果を返し、確認済みのエントリを取り除く
+
+        確認済みのエントリは、再取得したメッセージがストアに反映されるまで残しておく (表示のちらつき防止)。
+        """
+        with self._condition:
+            results, self._results = self._results, []
+            for client_id in [key for key, entry in self._entries.items() if entry['status'] == 'acked']:
+                del self._entries[client_id]
+        return results
+
+    def _ensure_worker(self):
+        # _condition を取得した状態で呼ぶ
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='outbox-worker', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._queue:
+                    self._condition.wait(OUTBOX_WORKER_IDLE_SECONDS)
+                    if not self._queue:
+                        self._thread = None
+                        return
+            # 連続した送信をまとめるために少し待つ
+            time.sleep(OUTBOX_COALESCE_SECONDS)
+            with self._condition:
+                batch, self._queue = self._queue[:OUTBOX_MAX_BATCH_MESSAGES], self._queue[OUTBOX_MAX_BATCH_MESSAGES:]
+                for entry in batch:
+                    entry['status'] = 'sending'
+            self._send(batch)
+
+    def _send(self, batch):
+        """送信と送信先ルームの差分取得を 1 つの batch で送る (Functions 側で書き込み -> 読み込みの順に処理される)"""
+        items = [{
+            'action': 'send_message',
+            'message_id': entry['client_id'], # 冪等キー: 再送 (リトライ・失敗後の再送) でも二重に保存されない
+            'room_id': entry['room_id'],
+            'receiver_email': entry['receiver_email'],
+            'content': entry['content'],
+        } for entry in batch]
+        refresh_rooms = {}
+        for entry in batch:
+            refresh_rooms.setdefault(entry['room_id'], entry['since'])
+        for room_id, since in refresh_rooms.items():
+            item = {'action': 'get_messages', 'room_id': room_id}
+            if since:
+                item['since'] = since
+            items.append(item)
+
+        try:
+            response = post_action(self.function_url, batch[-1]['id_token'], 'batch', {'requests': items})
+            results = decode_response(response).get('results') or []
+        except Exception as e:
+            print(f"Outbox send failed: {e}")
+            self._finish(batch, [], {}, error=str(e))
+            return
+        send_results = results[:len(batch)]
+        refresh_results = {
+            room_id: (since, result)
+            for (room_id, since), result in zip(refresh_rooms.items(), results[len(batch):])
+        }
+        self._finish(batch, send_results, refresh_results)
+
+    def _finish(self, batch, send_results, refresh_results, error=None):
+        with self._condition:
+            for index, entry in enumerate(batch):
+                result = send_results[index] if index < len(send_results) else None
+                if result is not None and result.get('status') == 200:
+                    entry['status'] = 'acked'
+                else:
+                    entry['status'] = 'failed'
+                    body = result.get('body') if isinstance(result, dict) else None
+                    entry['error'] = error or (body or {}).get('error') or 'unknown error'
+            for room_id in {entry['room_id'] for entry in batch}:
+                since, result = refresh_results.get(room_id, (None, None))
+                body = result.get('body') if isinstance(result, dict) else None
+                if not (result and result.get('status') == 200 and isinstance(body, dict)):
+                    body = None # 差分取得に失敗した場合は、呼び出し側で通常の再取得を行う
+                self._results.append((room_id, since, body))
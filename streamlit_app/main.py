@@ -12,7 +12,11 @@ import datetime
 # 新しいディレクトリ構造に合わせて core.api_client をインポート
 try:
     # 同じ streamlit_app パッケージ内の core モジュールからインポート
-    from core.api_client import get_messages, send_message, format_timestamp_for_display
+    from core.api_client import (
+        get_messages, get_older_messages, has_older_messages, format_timestamp_for_display,
+        ensure_message_stream, stop_message_streams, prefetch_rooms, get_room_summary, mark_room_seen,
+        enqueue_message, get_pending_messages, retry_pending_message, discard_pending_message,
+    )
     # (もしユーザーリスト取得APIを実装したら) from core.api_client import get_available_users
 except ImportError:
     # ローカル実行時 (python -m streamlit run streamlit_app/main.py) のためのパス解決
@@ -21,17 +25,40 @@ except ImportError:
     if project_root not in sys.path:
         sys.path.append(project_root)
     try:
-        from streamlit_app.core.api_client import get_messages, send_message, format_timestamp_for_display
+        from streamlit_app.core.api_client import (
+            get_messages, get_older_messages, has_older_messages, format_timestamp_for_display,
+            ensure_message_stream, stop_message_streams, prefetch_rooms, get_room_summary, mark_room_seen,
+            enqueue_message, get_pending_messages, retry_pending_message, discard_pending_message,
+        )
         # from streamlit_app.core.api_client import get_available_users
     except ImportError as e:
          st.error(f"モジュールのインポートに失敗しました: {e}. パスを確認してください。")
          st.stop()
 
 
+# --- 定数 ---
+# チャット表示部分 (フラグメント) だけを再実行する間隔 (秒)。ストリームで受け取った新着はこの間隔で画面に反映される
+CHAT_REFRESH_SECONDS = float(os.getenv('CHAT_REFRESH_SECONDS', 3))
+# 1 件ずつの吹き出しで表示する最新メッセージ数と、「過去のメッセージを表示」1 回で広げる件数
+# (広げた過去のメッセージは MESSAGE_WINDOW_STEP 件ずつ 1 つのブロックにまとめて描画する)
+MESSAGE_WINDOW_SIZE = 50
+MESSAGE_WINDOW_STEP = 50
+
+
 # --- 認証設定の読み込み ---
-config = None
-try:
-    # 優先度: 環境変数 (Cloud Runデプロイ時) > config.yaml (ローカルテスト時)
+class AuthConfigError(Exception):
+    """認証設定が見つからない、または形式が正しくない"""
+
+
+@st.cache_resource
+def load_auth_config():
+    """認証設定を読み込み、(設定, 画面に出す警告のリスト) を返す
+
+    プロセス内で 1 回だけ読み込み、以降の再実行・他のセッションでは同じ設定を使う
+    (例外はキャッシュされないため、読み込みに失敗した場合は次の再実行で読み直す)。
+    優先度: 環境変数 (Cloud Runデプロイ時) > config.yaml (ローカルテスト時)
+    """
+    warnings = []
     # 環境変数から読み込むキー名は GitHub Actions や Cloud Run 設定と合わせる
     if os.getenv('GOOGLE_CLIENT_ID') and os.getenv('GOOGLE_CLIENT_SECRET') and os.getenv('COOKIE_KEY') and os.getenv('COOKIE_NAME'):
         print("Loading auth config from environment variables.")
@@ -55,21 +82,25 @@ try:
         print("Loading auth config from streamlit_app/config.yaml.")
         # config.yaml のパスを修正
         with open('streamlit_app/config.yaml') as file:
-            config_from_file = yaml.safe_load(file)
-            # ローカルテスト用に OAuth 情報が設定されているか確認
-            if (not config_from_file.get('credentials', {}).get('google_oauth', {}).get('client_id') or
-                not config_from_file.get('credentials', {}).get('google_oauth', {}).get('client_secret')):
-                 st.warning("ローカルテスト用の OAuth クライアント情報が config.yaml に設定されていません。Google ログインは機能しません。")
-            config = config_from_file
+            config = yaml.safe_load(file)
+        # ローカルテスト用に OAuth 情報が設定されているか確認
+        if (not config.get('credentials', {}).get('google_oauth', {}).get('client_id') or
+            not config.get('credentials', {}).get('google_oauth', {}).get('client_secret')):
+             warnings.append("ローカルテスト用の OAuth クライアント情報が config.yaml に設定されていません。Google ログインは機能しません。")
     else:
-         st.error("🚨 認証設定ファイル (streamlit_app/config.yaml) または関連する環境変数が見つかりません。")
-         st.stop()
+         raise AuthConfigError("認証設定ファイル (streamlit_app/config.yaml) または関連する環境変数が見つかりません。")
 
     # 設定が最低限読み込めたか確認
     if not config or 'credentials' not in config or 'cookie' not in config:
-         st.error("🚨 認証設定の読み込みに失敗したか、形式が正しくありません。")
-         st.stop()
+         raise AuthConfigError("認証設定の読み込みに失敗したか、形式が正しくありません。")
+    return config, warnings
 
+
+try:
+    config, config_warnings = load_auth_config()
+except AuthConfigError as e:
+     st.error(f"🚨 {e}")
+     st.stop()
 except FileNotFoundError:
      st.error("🚨 streamlit_app/config.yaml が見つかりません。")
      st.stop()
@@ -80,18 +111,30 @@ except Exception as e:
     st.error(f"🚨 認証設定の読み込み中に予期せぬエラーが発生しました: {e}")
     st.exception(e) # 詳細なトレースバックを表示
     st.stop()
+for config_warning in config_warnings:
+    st.warning(config_warning)
 
 
 # --- 認証オブジェクトの初期化とログイン処理 ---
-# streamlit-authenticator の Authenticate インスタンスを作成
+def get_authenticator(config):
+    """このセッションの streamlit-authenticator の Authenticate インスタンスを返す (再実行のたびには作り直さない)
+
+    Authenticate は作成時にブラウザのクッキーを読むコンポーネントを持つセッションごとのオブジェクトなので、
+    全セッションで共有される st.cache_resource ではなく st.session_state に置く。
+    """
+    if 'authenticator' not in st.session_state:
+        st.session_state.authenticator = Authenticate(
+            config['credentials'],
+            config['cookie']['name'],
+            config['cookie']['key'],
+            config['cookie']['expiry_days'],
+            config['preauthorized']['emails']
+        )
+    return st.session_state.authenticator
+
+
 try:
-    authenticator = Authenticate(
-        config['credentials'],
-        config['cookie']['name'],
-        config['cookie']['key'],
-        config['cookie']['expiry_days'],
-        config['preauthorized']['emails']
-    )
+    authenticator = get_authenticator(config)
 except Exception as e:
     st.error(f"🚨 Authenticator の初期化に失敗しました: {e}")
     st.exception(e)
@@ -132,6 +175,112 @@ except Exception as e:
     st.exception(e)
     st.stop()
 
+# --- チャット相手とメッセージ表示のヘルパー ---
+@st.cache_data
+def parse_chat_partners(allowed_partners_str):
+    """ALLOWED_CHAT_PARTNERS (カンマ区切り) をメールアドレスのリストにする (同じ値なら再実行のたびには分解しない)"""
+    return [email.strip() for email in allowed_partners_str.split(',') if email.strip()]
+
+
+def render_message(msg, sender_email):
+    """メッセージ 1 件を st.chat_message の吹き出しで表示する"""
+    msg_sender = msg.get('sender_email', '不明な送信者')
+    # タイムスタンプは api_client で JST datetime オブジェクトに変換済み想定
+    timestamp_str = format_timestamp_for_display(msg.get('timestamp_jst'))
+    # 自分が送信したメッセージかどうかを判定
+    is_sender = (msg_sender.lower() == sender_email.lower())
+    # name は表示名、avatar はアイコン (文字列 or URL)
+    avatar_icon = "🧑‍💻" if is_sender else "🤖" # またはユーザーアイコンURLなど
+    with st.chat_message(name="user" if is_sender else "assistant", avatar=avatar_icon):
+         # メタ情報（送信者名と時刻）を表示
+         st.caption(f"{'あなた' if is_sender else msg_sender.split('@')[0]} ({timestamp_str})")
+         st.write(msg.get('content', ''))
+
+
+def render_message_batch(messages, sender_email):
+    """過去のメッセージをまとめて 1 つの要素として表示する (件数に比例して要素を増やさない)"""
+    lines = []
+    for msg in messages:
+        msg_sender = msg.get('sender_email', '不明な送信者')
+        name = 'あなた' if msg_sender.lower() == sender_email.lower() else msg_sender.split('@')[0]
+        timestamp_str = format_timestamp_for_display(msg.get('timestamp_jst'))
+        lines.append(f"**{name}** ({timestamp_str}): {msg.get('content', '')}")
+    st.markdown("  \n".join(lines))
+
+
+def render_pending_message(pending):
+    """送信箱にあるメッセージ (送信中・送信失敗) を表示する"""
+    with st.chat_message(name="user", avatar="🧑‍💻"):
+        timestamp_str = format_timestamp_for_display(pending['timestamp_jst'])
+        if pending['status'] == 'failed':
+            st.caption(f"あなた ({timestamp_str}) ⚠️ 送信失敗: {pending['error']}")
+        else:
+            st.caption(f"あなた ({timestamp_str}) ⏳ 送信中...")
+        st.write(pending['content'])
+        if pending['status'] == 'failed':
+            retry_col, discard_col = st.columns(2)
+            retry_col.button("再送", key=f"retry_{pending['client_id']}",
+                             on_click=retry_pending_message, args=(pending['client_id'],))
+            discard_col.button("削除", key=f"discard_{pending['client_id']}",
+                               on_click=discard_pending_message, args=(pending['client_id'],))
+
+
+def show_older_messages(room_id, held_count):
+    """表示範囲を MESSAGE_WINDOW_STEP 件広げる (保持しているメッセージが足りなければ過去のページを取得する)"""
+    windows = st.session_state.setdefault('message_windows', {})
+    window = windows.get(room_id, MESSAGE_WINDOW_SIZE) + MESSAGE_WINDOW_STEP
+    windows[room_id] = window
+    if held_count < window and has_older_messages(room_id):
+        get_older_messages(room_id)
+
+
+@st.fragment(run_every=CHAT_REFRESH_SECONDS)
+def chat_area(room_id, sender_email, use_stream):
+    """メッセージ履歴の表示 (このフラグメントだけが CHAT_REFRESH_SECONDS ごとに再実行される)
+
+    最新の MESSAGE_WINDOW_SIZE 件を吹き出しで、「過去のメッセージを表示」で広げた分を MESSAGE_WINDOW_STEP 件ずつの
+    ブロックで描画する。それより古いメッセージは描画しないため、描画の量はルームの履歴の長さに比例しない。
+    """
+    try:
+        # API クライアント経由でメッセージを取得
+        # ストリーム購読中は受信済みの新着をマージするだけで、HTTP での再取得は行わない
+        # 保持済みのメッセージは一定間隔 (または送信後) にだけ差分を取得し直す。ボタンで即時更新できる
+        force_refresh = st.button("🔄 更新", key=f"refresh_{room_id}")
+        messages = get_messages(room_id, force_refresh=force_refresh)
+        if use_stream:
+            ensure_message_stream(room_id)
+        else:
+            stop_message_streams()
+
+        window = st.session_state.get('message_windows', {}).get(room_id, MESSAGE_WINDOW_SIZE)
+        visible = messages[-window:]
+        # 古いメッセージはボタンが押されたときだけ表示範囲を広げる (必要な分だけページ単位で取得する)
+        if len(messages) > len(visible) or has_older_messages(room_id):
+            st.button("⬆️ 過去のメッセージを表示", key=f"load_older_{room_id}",
+                      on_click=show_older_messages, args=(room_id, len(messages)))
+
+        # 表示したので未読数をリセット
+        mark_room_seen(room_id)
+
+        pending_messages = get_pending_messages(room_id)
+        if not messages and not pending_messages:
+            st.info("まだメッセージはありません。最初のメッセージを送信しましょう！")
+        else:
+            older, tail = visible[:-MESSAGE_WINDOW_SIZE], visible[-MESSAGE_WINDOW_SIZE:]
+            for start in range(0, len(older), MESSAGE_WINDOW_STEP):
+                render_message_batch(older[start:start + MESSAGE_WINDOW_STEP], sender_email)
+            for msg in tail:
+                render_message(msg, sender_email)
+
+        # 送信箱にあるメッセージ (送信中・送信失敗) をサーバーの確認を待たずに表示
+        for pending in pending_messages:
+            render_pending_message(pending)
+
+    except Exception as e:
+        st.error(f"🚨 メッセージの読み込み中にエラーが発生しました: {e}")
+        st.exception(e)
+
+
 # --- 認証後のアプリケーション表示 ---
 # st.session_state["authentication_status"] は True, False, None のいずれか
 if st.session_state.get("authentication_status"):
@@ -153,7 +302,7 @@ if st.session_state.get("authentication_status"):
         # 将来的には get_available_users() API を使うことを検討
         allowed_partners_str = os.getenv("ALLOWED_CHAT_PARTNERS", "") # 環境変数からカンマ区切りで取得
         if allowed_partners_str:
-            all_users = [email.strip() for email in allowed_partners_str.split(',')]
+            all_users = parse_chat_partners(allowed_partners_str)
         else:
             # 環境変数がなければ、固定リスト（デモ用）
              all_users = ["user1@example.com", "user2@example.com"] # <<< 要変更: 実際のユーザーリスト
@@ -167,15 +316,37 @@ if st.session_state.get("authentication_status"):
             st.info("現在チャットできる相手がいません。")
             st.stop()
 
+        # 全相手とのルームの最新メッセージと未読数をルーム一覧 (サーバー側のサマリー) からまとめて取得し、
+        # 変化のあったルームのメッセージだけを batch で先読みする (ルームを切り替えた直後もすぐ表示できる)
+        partner_room_ids = {
+            partner: "_".join(sorted([sender_email.lower(), partner.lower()]))
+            for partner in available_partners
+        }
+        prefetch_rooms(list(partner_room_ids.values()))
+
+        def format_partner(partner):
+            """相手の表示名に未読数を付ける"""
+            unread_count = get_room_summary(partner_room_ids[partner], sender_email)['unread_count']
+            return f"{partner} 🔴 {unread_count}" if unread_count else partner
+
         # ドロップダウンでチャット相手を選択
         receiver_email = st.sidebar.selectbox(
             "相手を選択:",
             available_partners,
             key="receiver_select",
             index=None, # 初期選択なし
-            placeholder="選択してください..."
+            placeholder="選択してください...",
+            format_func=format_partner,
         )
 
+        # 各相手との最新メッセージを表示
+        for partner, partner_room_id in partner_room_ids.items():
+            latest_message = get_room_summary(partner_room_id, sender_email)['latest_message']
+            if latest_message:
+                preview = latest_message.get('content', '')
+                preview = preview if len(preview) <= 20 else preview[:20] + "…"
+                st.sidebar.caption(f"{partner.split('@')[0]}: {preview} ({format_timestamp_for_display(latest_message.get('timestamp_jst'))})")
+
     except Exception as e:
         st.sidebar.error("ユーザーリストの処理中にエラーが発生しました。")
         st.error(f"🚨 ユーザーリストエラー: {e}")
@@ -193,61 +364,37 @@ if st.session_state.get("authentication_status"):
         # --- メッセージ表示エリア ---
         st.markdown("---")
         st.subheader("メッセージ履歴")
-        # メッセージ表示用に高さ固定のコンテナを作成 (スクロール可能にする)
-        message_area = st.container()
-        # message_area.height = 400 # 高さを固定したい場合
-
-        try:
-            # API クライアント経由でメッセージを取得
-            messages = get_messages(room_id)
 
-            with message_area:
-                if not messages:
-                    st.info("まだメッセージはありません。最初のメッセージを送信しましょう！")
-                else:
-                    # メッセージをループして表示
-                    for msg in messages:
-                        msg_sender = msg.get('sender_email', '不明な送信者')
-                        msg_content = msg.get('content', '')
-                        # タイムスタンプは api_client で JST datetime オブジェクトに変換済み想定
-                        timestamp_str = format_timestamp_for_display(msg.get('timestamp_jst'))
-
-                        # 自分が送信したメッセージかどうかを判定
-                        is_sender = (msg_sender.lower() == sender_email.lower())
-
-                        # st.chat_message を使ってチャット風に表示
-                        # name は表示名、avatar はアイコン (文字列 or URL)
-                        avatar_icon = "🧑‍💻" if is_sender else "🤖" # またはユーザーアイコンURLなど
-                        with st.chat_message(name="user" if is_sender else "assistant", avatar=avatar_icon):
-                             # メタ情報（送信者名と時刻）を表示
-                             st.caption(f"{'あなた' if is_sender else msg_sender.split('@')[0]} ({timestamp_str})")
-                             # メッセージ内容を表示
-                             st.write(msg_content)
-
-        except Exception as e:
-            st.error(f"🚨 メッセージの読み込み中にエラーが発生しました: {e}")
-            st.exception(e)
+        # 新着メッセージの受信方法: ストリーム購読 (サーバーからのプッシュ) か、一定間隔の差分取得か
+        use_stream = st.sidebar.toggle("リアルタイム受信 (ストリーム)", value=True, key="use_message_stream")
+        # 表示部分はフラグメントとして単独で再実行されるため、新着の反映で設定の読み込みやサイドバーは再実行されない
+        chat_area(room_id, sender_email, use_stream)
 
         # --- メッセージ入力フォーム ---
         st.markdown("---") # 区切り線
 
         # シンプルな Text Input + Button
-        message_content = st.text_input("メッセージを入力:", key=f"msg_input_{room_id}", label_visibility="collapsed", placeholder="ここにメッセージを入力...")
-        if st.button("送信", key=f"send_btn_{room_id}"):
-            if message_content:
-                 try:
-                     # API クライアント経由でメッセージを送信
-                     success = send_message(room_id, receiver_email, message_content)
-                     if success:
-                         # 送信成功したら入力欄をクリアし、メッセージリストを再読み込みするために rerun
-                         st.rerun()
-                     else:
-                         st.error("メッセージの送信に失敗しました。")
-                 except Exception as e:
-                     st.error(f"🚨 送信処理中にエラーが発生しました: {e}")
-                     st.exception(e)
-            else:
-                 st.warning("メッセージを入力してください。")
+        input_key = f"msg_input_{room_id}"
+
+        def submit_message():
+            """送信ボタンのコールバック: 送信箱に入れて入力欄をクリアする (送信の完了は待たない)"""
+            message_content = st.session_state.get(input_key, "")
+            if not message_content:
+                st.session_state.send_warning = "メッセージを入力してください。"
+                return
+            try:
+                # 送信はバックグラウンドで行われ、メッセージはすぐに「送信中」として表示される
+                if enqueue_message(room_id, receiver_email, message_content):
+                    st.session_state[input_key] = ""
+                else:
+                    st.session_state.send_warning = "メッセージの送信に失敗しました。"
+            except Exception as e:
+                st.session_state.send_warning = f"🚨 送信処理中にエラーが発生しました: {e}"
+
+        st.text_input("メッセージを入力:", key=input_key, label_visibility="collapsed", placeholder="ここにメッセージを入力...")
+        st.button("送信", key=f"send_btn_{room_id}", on_click=submit_message)
+        if st.session_state.get("send_warning"):
+            st.warning(st.session_state.pop("send_warning"))
 
     else:
         # チャット相手が選択されていない場合
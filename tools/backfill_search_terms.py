@@ -0,0 +1,77 @@
+"""既存のメッセージドキュメント (chat_rooms/{room_id}/messages) に検索の索引語 (search_terms) を書き込む
+
+search_messages は書き込み時に登録した索引語だけを引くため、索引の導入前に保存されたメッセージは
+このツールで索引語を付けるまで検索に現れない。ルームごとにメッセージを --page-size 件ずつ読み、
+search_index.index_terms で作った索引語を update する (本文が同じなら何度実行しても結果は同じ)。
+時間バケット (message_buckets) のルームは tools/migrate_message_buckets.py が変換時に索引語を書き込む。
+search_index の索引語の規則を変えた後は、--force で既存のメッセージの索引語も作り直す。
+
+    python tools/backfill_search_terms.py --dry-run
+    python tools/backfill_search_terms.py --room alice@example.com_bob@example.com
+    python tools/backfill_search_terms.py --force
+"""
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'cloud_functions' / 'chat_api'))
+
+import search_index # noqa: E402 (chat_api のディレクトリをパスに追加した後で読み込む)
+import storage # noqa: E402
+from migrate_message_buckets import FIRESTORE_BATCH_LIMIT, room_ids # noqa: E402
+
+
+def backfill_room(db, room_id, page_size, dry_run=False, force=False):
+    """1 ルームのメッセージに索引語を書き込み、(読んだ件数, 書き込んだ件数) を返す
+
+    force を付けない限り、既に search_terms を持つメッセージは飛ばす。
+    """
+    messages_ref = db.collection('chat_rooms').document(room_id).collection('messages')
+    query = messages_ref.order_by('timestamp').order_by('__name__')
+    scanned = updated = 0
+    last_doc = None
+    while True:
+        page_query = query.start_after(last_doc) if last_doc is not None else query
+        msg_docs = list(page_query.limit(page_size).stream())
+        updates = []
+        for msg_doc in msg_docs:
+            data = msg_doc.to_dict() or {}
+            if not force and 'search_terms' in data:
+                continue
+            updates.append((msg_doc.reference, search_index.index_terms(data.get('content'))))
+        scanned += len(msg_docs)
+        updated += len(updates)
+        if not dry_run:
+            for start in range(0, len(updates), FIRESTORE_BATCH_LIMIT):
+                write_batch = db.batch()
+                for ref, search_terms in updates[start:start + FIRESTORE_BATCH_LIMIT]:
+                    write_batch.update(ref, {'search_terms': search_terms})
+                write_batch.commit()
+        if len(msg_docs) < page_size:
+            return scanned, updated
+        last_doc = msg_docs[-1]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--room', action='append', help='対象のルーム ID (複数指定可。省略時は全ルーム)')
+    parser.add_argument('--page-size', type=int, default=500, help='1 回のクエリで読むメッセージ数')
+    parser.add_argument('--dry-run', action='store_true', help='書き込まずに、索引語を付けるメッセージの数だけを表示する')
+    parser.add_argument('--force', action='store_true', help='search_terms を持つメッセージも索引語を作り直す')
+    args = parser.parse_args(argv)
+
+    db = storage.load_firestore().Client()
+    total_rooms = total_scanned = total_updated = 0
+    for room_id in room_ids(db, args.room):
+        scanned, updated = backfill_room(db, room_id, args.page_size, dry_run=args.dry_run, force=args.force)
+        total_rooms += 1
+        total_scanned += scanned
+        total_updated += updated
+        print(f"{room_id}: {updated} of {scanned} message(s) indexed")
+    action = 'Would index' if args.dry_run else 'Indexed'
+    print(f"{action} {total_updated} of {total_scanned} message(s) across {total_rooms} room(s)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
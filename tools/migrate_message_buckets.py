@@ -0,0 +1,156 @@
+"""既存のルームのメッセージ (chat_rooms/{room_id}/messages) を時間バケット (message_buckets) に変換する
+
+CHAT_STORAGE_BACKEND=firestore_buckets に切り替える前に実行する。ルームごとにメッセージを古い順に
+--page-size 件ずつ読み、BucketedFirestoreStorage と同じ規則 (storage.pack_into_buckets) でバケットに詰めて書き込む。
+メモリに保持するのは 1 ページと書き込み前のバケット 1 つ分だけ。
+
+- 既に bucket_head を持つルーム (変換済み、またはバケット方式で書き込まれたルーム) は --force を付けない限り飛ばす。
+  バケット ID はメッセージの並びから決まるため、--force で同じルームを再変換しても同じバケットが上書きされる。
+- 変換の途中で旧方式に書き込まれたメッセージは取り込まれないので、書き込みを止めてから実行する。
+- 元のメッセージドキュメントは --delete-source を付けた場合だけ、書き込み済みのバケットに入った分を削除する。
+
+    python tools/migrate_message_buckets.py --dry-run
+    python tools/migrate_message_buckets.py --room alice@example.com_bob@example.com
+    python tools/migrate_message_buckets.py --page-size 500 --delete-source
+"""
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'cloud_functions' / 'chat_api'))
+
+import search_index # noqa: E402 (chat_api のディレクトリをパスに追加した後で読み込む)
+import storage # noqa: E402
+
+# Firestore の WriteBatch 1 回あたりの書き込み数の上限
+FIRESTORE_BATCH_LIMIT = 500
+
+
+class RoomMigration:
+    """1 ルーム分の変換 (バケットの書き込みと、書き込み済みの元ドキュメントの削除)"""
+
+    def __init__(self, db, room_id, dry_run=False, delete_source=False):
+        self.db = db
+        self.room_id = room_id
+        self.dry_run = dry_run
+        self.delete_source = delete_source
+        self.room_ref = db.collection('chat_rooms').document(room_id)
+        self.head = None # 最後に開いたバケットの状態
+        self.open_messages = [] # まだ書き込んでいない最新のバケットのメッセージ
+        self.open_refs = [] # open_messages の元ドキュメント
+        self.buckets_written = 0
+        self.messages_migrated = 0
+
+    def add_page(self, msg_docs):
+        """古い順に読んだ 1 ページ分のメッセージドキュメントをバケットに詰め、閉じたバケットを書き込む"""
+        refs = {}
+        messages = []
+        for msg_doc in msg_docs:
+            message = storage.message_from_doc(msg_doc)
+            refs[message['id']] = msg_doc.reference
+            messages.append(message)
+        for bucket, bucket_messages in storage.pack_into_buckets(self.head, messages):
+            if self.head is not None and bucket['id'] != self.head['id']:
+                self._flush() # 新しいバケットが開いたので、前のバケットは完成している
+            self.head = bucket
+            self.open_messages.extend(bucket_messages)
+            self.open_refs.extend(refs[message['id']] for message in bucket_messages)
+
+    def finish(self):
+        """残りのバケットを書き込み、サマリーに追記先のバケットを記録する"""
+        if self.head is None:
+            return
+        self._flush()
+        if not self.dry_run:
+            self.room_ref.set({'bucket_head': self.head}, merge=True)
+
+    def _flush(self):
+        if not self.open_messages:
+            return
+        self.buckets_written += 1
+        self.messages_migrated += len(self.open_messages)
+        if not self.dry_run:
+            # バケットは丸ごと上書きする (再変換しても重複しない)。検索の索引語は本文から作り直す
+            self.room_ref.collection('message_buckets').document(self.head['id']).set({
+                'messages': self.open_messages,
+                'count': len(self.open_messages),
+                'bytes': sum(storage.estimated_message_size(message) for message in self.open_messages),
+                'first_ts': self.head['first_ts'],
+                'last_ts': self.head['last_ts'],
+                'search_terms': list(dict.fromkeys(
+                    term for message in self.open_messages for term in search_index.index_terms(message['content'])
+                )),
+            })
+            if self.delete_source:
+                for start in range(0, len(self.open_refs), FIRESTORE_BATCH_LIMIT):
+                    write_batch = self.db.batch()
+                    for ref in self.open_refs[start:start + FIRESTORE_BATCH_LIMIT]:
+                        write_batch.delete(ref)
+                    write_batch.commit()
+        self.open_messages = []
+        self.open_refs = []
+
+
+def migrate_room(db, room_id, page_size, dry_run=False, force=False, delete_source=False):
+    """1 ルームを変換し、(バケット数, メッセージ数) を返す。変換済みで飛ばした場合は None"""
+    migration = RoomMigration(db, room_id, dry_run=dry_run, delete_source=delete_source)
+    summary_doc = migration.room_ref.get()
+    if not force and summary_doc.exists and (summary_doc.to_dict() or {}).get('bucket_head'):
+        return None
+    messages_ref = migration.room_ref.collection('messages')
+    query = messages_ref.order_by('timestamp').order_by('__name__')
+    last_doc = None
+    while True:
+        page_query = query.start_after(last_doc) if last_doc is not None else query
+        msg_docs = list(page_query.limit(page_size).stream())
+        if msg_docs:
+            migration.add_page(msg_docs)
+        if len(msg_docs) < page_size:
+            break
+        last_doc = msg_docs[-1]
+    migration.finish()
+    return migration.buckets_written, migration.messages_migrated
+
+
+def room_ids(db, rooms=None):
+    """変換するルームの ID (指定がなければ全ルーム。サマリーのないルームも含む)"""
+    if rooms:
+        yield from rooms
+        return
+    # サブコレクションだけを持つ (サマリーのない) ルームも列挙するため、stream() ではなく list_documents() を使う
+    for room_ref in db.collection('chat_rooms').list_documents():
+        if room_ref.id != '_warmup':
+            yield room_ref.id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--room', action='append', help='変換するルーム ID (複数指定可。省略時は全ルーム)')
+    parser.add_argument('--page-size', type=int, default=500, help='1 回のクエリで読むメッセージ数')
+    parser.add_argument('--dry-run', action='store_true', help='書き込まずに、作られるバケットの数だけを表示する')
+    parser.add_argument('--force', action='store_true', help='bucket_head を持つルームも変換し直す')
+    parser.add_argument('--delete-source', action='store_true', help='バケットに書き込んだ元のメッセージドキュメントを削除する')
+    args = parser.parse_args(argv)
+
+    db = storage.load_firestore().Client()
+    total_rooms = total_buckets = total_messages = skipped = 0
+    for room_id in room_ids(db, args.room):
+        result = migrate_room(db, room_id, args.page_size, dry_run=args.dry_run, force=args.force,
+                              delete_source=args.delete_source)
+        if result is None:
+            skipped += 1
+            print(f"{room_id}: already bucketed, skipped")
+            continue
+        buckets, messages = result
+        total_rooms += 1
+        total_buckets += buckets
+        total_messages += messages
+        print(f"{room_id}: {messages} message(s) -> {buckets} bucket(s)")
+    action = 'Would migrate' if args.dry_run else 'Migrated'
+    print(f"{action} {total_messages} message(s) into {total_buckets} bucket(s) across {total_rooms} room(s), "
+          f"{skipped} skipped")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())